@@ -0,0 +1,151 @@
+from __future__ import print_function
+import os
+import unittest
+import tempfile
+
+import numpy as np
+
+from tractor import *
+from tractor.columnar import ColumnarCatalog
+
+class RaDecPixelWCS(NullWCS):
+    # Treats RA,Dec as pixel coordinates (for testing).
+    def hashkey(self):
+        return ('RaDecPixelWCS',)
+    def positionToPixel(self, pos, src=None):
+        return pos.ra, pos.dec
+
+class ColumnarCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        N = 30
+        self.bands = ['g', 'r']
+        self.ra = np.random.uniform(5, 95, N)
+        self.dec = np.random.uniform(5, 75, N)
+        self.flux = np.random.uniform(10, 100, (N, 2))
+        self.types = np.random.choice(['PSF', 'EXP', 'DEV'], N)
+        self.shape = np.vstack([np.random.uniform(0.5, 3, N),
+                                np.random.uniform(-0.3, 0.3, N),
+                                np.random.uniform(-0.3, 0.3, N)]).T
+        self.cat = ColumnarCatalog(self.ra, self.dec, self.flux, self.bands,
+                                   types=self.types, shape=self.shape)
+
+    def sources(self):
+        # The equivalent regular sources
+        srcs = []
+        for r,d,f,t,s in zip(self.ra, self.dec, self.flux, self.types,
+                             self.shape):
+            pos = RaDecPos(r, d)
+            br = NanoMaggies(order=self.bands, g=f[0], r=f[1])
+            if t == 'PSF':
+                srcs.append(PointSource(pos, br))
+            else:
+                cls = dict(EXP=ExpGalaxy, DEV=DevGalaxy)[t]
+                srcs.append(cls(pos, br, EllipseE(*s)))
+        return srcs
+
+    def test_params(self):
+        cat = self.cat
+        ref = Catalog(*self.sources())
+        self.assertEqual(len(cat), len(ref))
+        self.assertEqual(cat.numberOfParams(), ref.numberOfParams())
+        self.assertTrue(np.allclose(cat.getParams(), ref.getParams()))
+        self.assertTrue(np.allclose(cat.getAllParams(), ref.getAllParams()))
+        self.assertEqual(cat.getLowerBounds(), ref.getLowerBounds())
+        self.assertEqual(cat.getMaxStep(), ref.getMaxStep())
+        for src,rsrc in zip(cat, ref):
+            self.assertEqual(type(src), type(rsrc))
+            self.assertEqual(src.getParamNames(), rsrc.getParamNames())
+            self.assertTrue(np.allclose(src.getStepSizes(),
+                                        rsrc.getStepSizes()))
+
+        # Views write through to the arrays, and vice versa.
+        src = cat[3]
+        self.assertIs(cat[3], src)
+        src.pos.ra = 50.
+        src.brightness.setFlux('r', 7.)
+        self.assertEqual(cat.values[3, 0], 50.)
+        self.assertEqual(cat.values[3, 3], 7.)
+        cat.values[3, 1] = 20.
+        self.assertEqual(src.pos.dec, 20.)
+        ref[3].pos.setParams([50., 20.])
+        ref[3].brightness.setFlux('r', 7.)
+
+        # Freezing, by name or on a view
+        for c in [cat, ref]:
+            c.freezeAllRecursive()
+            c.thawPathsTo('r')
+        self.assertEqual(cat.numberOfParams(), len(cat))
+        self.assertTrue(np.allclose(cat.getParams(), ref.getParams()))
+        cat.thawPathsTo('shape')
+        ref.thawPathsTo('shape')
+        cat[1].freezeParam('brightness')
+        ref[1].freezeParam('brightness')
+        cat.freezeParam(2)
+        ref.freezeParam(2)
+        self.assertEqual(cat.getParamNames(), ref.getParamNames())
+        p = np.arange(ref.numberOfParams())
+        cat.setParams(p)
+        ref.setParams(p)
+        self.assertTrue(np.allclose(cat.getAllParams(), ref.getAllParams()))
+
+        # Copies are independent.
+        c2 = cat.copy()
+        c2.setParams(np.zeros(c2.numberOfParams()))
+        self.assertTrue(np.allclose(cat.getParams(), p))
+        s2 = cat[0].copy()
+        s2.pos.ra = 0.
+        self.assertNotEqual(cat.values[0, 0], 0.)
+
+        # Views don't share the templates' cached parameter layouts.
+        cat = ColumnarCatalog(self.ra, self.dec, self.flux, self.bands,
+                              types=self.types, shape=self.shape)
+        for t in cat._templates + cat._paramtemplates:
+            t.getParams()
+        for src, rsrc in zip(cat, self.sources()):
+            self.assertTrue(np.allclose(src.getParams(), rsrc.getParams()))
+            self.assertTrue(np.allclose(src.pos.getParams(),
+                                        rsrc.pos.getParams()))
+
+    def test_model(self):
+        H,W = 80,100
+        tims = [Image(data=np.zeros((H,W), np.float32),
+                      inverr=np.ones((H,W), np.float32),
+                      psf=NCircularGaussianPSF([1.5], [1.]),
+                      wcs=RaDecPixelWCS(), photocal=LinearPhotoCal(1., band=b))
+                for b in self.bands]
+        ref = Tractor(tims, self.sources())
+        tr = Tractor(tims, self.cat)
+        for tim in tims:
+            mod = tr.getModelImage(tim)
+            self.assertLess(np.max(np.abs(mod - ref.getModelImage(tim))),
+                            1e-5)
+        # Forced photometry in the r band
+        tim = tims[1]
+        tim.data = ref.getModelImage(tim) + np.random.normal(
+            size=(H,W)).astype(np.float32)
+        fluxes = []
+        for cat in [self.cat, self.sources()]:
+            tr = Tractor([tim], cat)
+            tr.freezeParam('images')
+            tr.catalog.freezeAllRecursive()
+            tr.catalog.thawPathsTo('r')
+            tr.catalog.setParams(np.array(tr.catalog.getParams()) * 1.1)
+            tr.optimize_forced_photometry()
+            fluxes.append(tr.catalog.getParams())
+        self.assertTrue(np.allclose(fluxes[0], fluxes[1]))
+        self.assertTrue(np.allclose(self.cat.values[:, 3], fluxes[1]))
+
+    def test_fits(self):
+        f,fn = tempfile.mkstemp(suffix='.fits')
+        os.close(f)
+        self.cat.write_fits(fn)
+        cat = ColumnarCatalog.from_fits(fn, self.bands)
+        os.unlink(fn)
+        self.assertEqual(list(cat.getTypes()), list(self.types))
+        self.assertTrue(np.allclose(cat.getAllParams(),
+                                    self.cat.getAllParams(), rtol=1e-6))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -138,7 +138,135 @@ class ForcedPhotTest(unittest.TestCase):
         print('Predicted val:', pval)
         
         self.assertAlmostEqual(src.getParams()[0], pval, 6)
-        
+
+        # Closed-form solver
+        src.setParams([0.])
+        tr.optimize_forced_photometry(priors=True, solver='cholesky')
+        self.assertAlmostEqual(src.getParams()[0], pval, 6)
+
+    def test_linear(self):
+        # The closed-form solver agrees with LSQR.
+        H,W = 40,50
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(2.), sky=ConstantSky(0.))
+        fluxes = [100., 50., 20., -10., 5.]
+        pos = [(10.3, 12.1), (13.1, 13.4), (30., 25.5), (32.2, 24.1),
+               (45., 35.)]
+        srcs = [PointSource(PixPos(x, y), Flux(f))
+                for (x,y),f in zip(pos, fluxes)]
+        tr = Tractor([tim], srcs)
+        np.random.seed(42)
+        tim.data = tr.getModelImage(0) + 3. + np.random.normal(size=(H,W))
+        tr.freezeParamsRecursive('*')
+        tr.thawPathsTo('sky')
+        tr.thawPathsTo('brightness')
+
+        results = []
+        for solver in ['lsqr', 'cholesky']:
+            for src in srcs:
+                src.brightness.setParams([1.])
+            tim.sky.setParams([0.])
+            R = tr.optimize_forced_photometry(sky=True, solver=solver,
+                                              variance=True, fitstats=True)
+            results.append((tr.getParams(), R))
+        (p1, R1), (p2, R2) = results
+        self.assertTrue(np.allclose(p1, p2, atol=1e-3))
+        self.assertTrue(np.allclose(R1.IV, R2.IV))
+        self.assertTrue(np.allclose(R1.fitstats.prochi2, R2.fitstats.prochi2,
+                                    rtol=1e-4))
+        for (im,mod,ie,chi,roi), (im2,mod2,ie2,chi2,roi2) in zip(R1.ims0,
+                                                               R2.ims0):
+            self.assertTrue(np.allclose(mod, mod2))
+
+        # With fluxes constrained to be >= 0: compare with a
+        # bounded least-squares fit of the unit-flux models.
+        from scipy.optimize import lsq_linear
+        tim.sky.setParams([3.])
+        tr.freezeParam('images')
+        for src in srcs:
+            src.brightness.setParams([1.])
+        A = []
+        for src in srcs:
+            col = np.zeros((H,W))
+            src.getUnitFluxModelPatch(tim).addTo(col)
+            A.append(col.ravel() * 2.)
+        A = np.array(A).T
+        b = (tim.data - 3.).ravel()
+        tr.optimize_forced_photometry(solver='cholesky', minFlux=0.)
+        p3 = np.array(tr.getParams())
+        X = lsq_linear(A, b, bounds=(0., np.inf)).x
+        self.assertTrue(np.all(p3 >= 0.))
+        self.assertEqual(p3[3], 0.)
+        self.assertTrue(np.allclose(p3, X, atol=1e-4))
+
+        # The sparse normal equations, solved group by group, give the
+        # same fits (with two sources sharing a brightness, too).
+        srcs[4].brightness = srcs[0].brightness
+        fits = []
+        for dense in [256, 0]:
+            tr.optimizer.denseForcedPhotMax = dense
+            for minFlux in [None, 0.]:
+                for src in srcs:
+                    src.brightness.setParams([1.])
+                tr.optimize_forced_photometry(solver='cholesky',
+                                              minFlux=minFlux)
+                fits.append(np.array(tr.getParams()))
+        self.assertTrue(np.allclose(fits[0], fits[2]))
+        self.assertTrue(np.allclose(fits[1], fits[3]))
+        self.assertEqual(fits[0][0], fits[0][4])
+
+    def test_unit_flux_models(self):
+        from tractor.optimize import UnitFluxModels
+        H,W = 20,30
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+        # including sources hanging off the image edges
+        srcs = [PointSource(PixPos(x, y), Flux(1.))
+                for x,y in [(0.5, 3.), (10., 10.), (12., 11.), (29., 19.5)]]
+        umods = [src.getUnitFluxModelPatch(tim) for src in srcs] + [None]
+        U = UnitFluxModels(umods, tim.shape)
+        counts = np.array([1., 2., -3., 4., 5.])
+        mod = np.zeros((H,W))
+        for um,c in zip(umods, counts):
+            if um is not None:
+                (um * c).addTo(mod)
+        self.assertTrue(np.allclose(U.getModel(counts), mod))
+        ie = np.random.uniform(size=(H,W))
+        for j,um in enumerate(umods):
+            ss = 0.
+            if um is not None:
+                mod[:,:] = 0.
+                um.addTo(mod)
+                ss = np.sum((mod * ie)**2)
+            self.assertAlmostEqual(U.getWeightedSumSq(ie)[j], ss)
+
+        # Forced photometry within a ROI matches the cut-out image
+        # (with sources shifted to the cut-out's pixel coordinates).
+        np.random.seed(42)
+        tim.data = np.random.normal(size=(H,W))
+        for src in srcs:
+            src.brightness.setParams([10.])
+        tim.data += Tractor([tim], srcs).getModelImage(0)
+        roi = (slice(2, 18), slice(3, 25))
+        subtim = tim.subimage(3, 25, 2, 18)
+        subsrcs = [PointSource(PixPos(src.pos.x - 3, src.pos.y - 2), Flux(1.))
+                   for src in srcs]
+        params = []
+        for t,rois,ss in [(tim, [roi], srcs), (subtim, None, subsrcs)]:
+            for src in ss:
+                src.brightness.setParams([1.])
+            tr = Tractor([t], ss)
+            tr.freezeParamsRecursive('*')
+            tr.thawPathsTo('brightness')
+            R = tr.optimize_forced_photometry(rois=rois, fitstats=True,
+                                              variance=True)
+            params.append((tr.getParams(), R.IV, R.fitstats.prochi2))
+        for a,b in zip(*params):
+            self.assertTrue(np.allclose(a, b))
+
+
 if __name__ == '__main__':
     # import sys
     # if '--plots' in sys.argv:
@@ -681,8 +681,97 @@ class GalaxyTest(unittest.TestCase):
         diff = np.diff(m21[imx:])
         self.assertFalse(np.all(np.logical_or(np.abs(diff) < 1e-9, diff < 0)))
 
-        
-            
+    def test_analytic_derivs(self):
+        # Compare analytic derivatives against finite differences
+        # (with small steps).
+        psf = GaussianMixturePSF([0.7, 0.3],
+                                 np.array([[0., 0.], [0.2, -0.1]]),
+                                 np.array([[[4., 0.5], [0.5, 3.]],
+                                           [[16., -1.], [-1., 12.]]]))
+        H,W = 60,70
+        wcs = NullWCS(pixscale=0.5)
+        tim = Image(data=np.zeros((H,W), np.float32),
+                    inverr=np.ones((H,W), np.float32),
+                    psf=psf, wcs=wcs, photocal=LinearPhotoCal(1.))
+        for shape in [EllipseE(3., 0.2, -0.3), EllipseESoft(0.5, 0.3, 0.2),
+                      EllipseE(2., 0., 0.)]:
+            for clazz in [ExpGalaxy, DevGalaxy]:
+                for mm in [None, ModelMask(20, 15, 30, 25)]:
+                    gal = clazz(PixPos(33.3, 28.6), Flux(100.), shape.copy())
+                    derivs = gal.getParamDerivatives(tim, modelMask=mm)
+                    self.assertEqual(len(derivs), 6)
+
+                    gal.analyticDerivs = False
+                    steps = [s * 1e-3 for s in gal.getStepSizes()]
+                    gal.pos.getStepSizes = lambda *a, **k: steps[:2]
+                    gal.shape.getStepSizes = lambda *a, **k: steps[3:]
+                    fd = gal.getParamDerivatives(tim, modelMask=mm)
+
+                    for d,f in zip(derivs, fd):
+                        self.assertEqual(d.name, f.name)
+                        self.assertEqual(d.getExtent(), f.getExtent())
+                        self.assertLess(np.max(np.abs(d.patch - f.patch)),
+                                        1e-4 * np.max(np.abs(f.patch)))
+
+        # Pixelized PSF -> falls back to finite differences.
+        tim.psf = PixelizedPSF(psf.getPointSourcePatch(0., 0., radius=10).patch)
+        gal = ExpGalaxy(PixPos(33.3, 28.6), Flux(100.), EllipseE(3., 0.2, -0.3))
+        self.assertIsNone(gal._getAnalyticParamDerivatives(tim))
+        derivs = gal.getParamDerivatives(tim)
+        self.assertEqual(len(derivs), 6)
+
+    def test_galaxy_cache(self):
+        set_galaxy_cache_size(100)
+        cache = get_galaxy_cache()
+        H,W = 50,50
+        psf = NCircularGaussianPSF([1.5], [1.])
+        pixpsf = PixelizedPSF(psf.getPointSourcePatch(0., 0., radius=8).patch)
+        tim = Image(data=np.zeros((H,W), np.float32),
+                    inverr=np.ones((H,W), np.float32),
+                    psf=pixpsf, photocal=LinearPhotoCal(1.))
+        gal = ExpGalaxy(PixPos(24.3, 25.6), Flux(10.), EllipseE(3., 0.2, 0.1))
+        mask = np.ones((20,20), bool)
+        mask[:5,:] = False
+        for mm in [None, ModelMask(15, 15, 20, 20), ModelMask(15, 15, mask)]:
+            cache.clear()
+            p1 = gal.getModelPatch(tim, modelMask=mm)
+            p2 = gal.getModelPatch(tim, modelMask=mm)
+            self.assertTrue(np.all(p1.patch == p2.patch))
+            self.assertEqual(cache.getStats()['unitpatch']['hits'], 1)
+            # modifying the returned patch doesn't change the cache
+            u = gal.getUnitFluxModelPatch(tim, modelMask=mm)
+            u *= 0.
+            p3 = gal.getModelPatch(tim, modelMask=mm)
+            self.assertTrue(np.all(p1.patch == p3.patch))
+            # changing a parameter changes the key
+            gal.shape.re += 0.1
+            p4 = gal.getModelPatch(tim, modelMask=mm)
+            gal.shape.re -= 0.1
+            self.assertFalse(np.all(p1.patch == p4.patch))
+            self.assertEqual(cache.getStats()['unitpatch']['misses'], 2)
+        # so does changing the PSF
+        tim.psf = HybridPixelizedPSF(pixpsf)
+        p5 = gal.getModelPatch(tim, modelMask=mm)
+        self.assertEqual(cache.getStats()['unitpatch']['misses'], 3)
+        disable_galaxy_cache()
+        p6 = gal.getModelPatch(tim, modelMask=mm)
+        self.assertTrue(np.all(p5.patch == p6.patch))
+
+        # PSF keys are short digests of the pixels
+        k = pixpsf.hashkey()
+        self.assertEqual(len(k), 3)
+        self.assertEqual(pixpsf.copy().hashkey(), k)
+        pixpsf.img = pixpsf.img * 2.
+        k2 = pixpsf.hashkey()
+        self.assertNotEqual(k2, k)
+        # (including in-place changes)
+        pixpsf.img /= pixpsf.img.sum()
+        k3 = pixpsf.hashkey()
+        self.assertNotEqual(k3, k2)
+        pixpsf.img[0, 0] += 1.
+        pixpsf.clear_cache()
+        self.assertNotEqual(pixpsf.hashkey(), k3)
+
         
 if __name__ == '__main__':
     import sys
@@ -75,6 +75,27 @@ class PsfExTest(unittest.TestCase):
 
         os.unlink(tmpfn)
         
+    def test_old_pickles(self):
+        # Pickles made before *img* and *psfbases* became properties
+        # (backed by _img and _psfbases, with cached digests) load.
+        import pickle
+        key = self.psf.hashkey()
+        psf = pickle.loads(pickle.dumps(self.psf))
+        self.assertEqual(psf.hashkey(), key)
+        for obj, attr in [(psf, 'img'), (psf.psfex, 'psfbases')]:
+            state = dict(obj.__dict__)
+            state[attr] = state.pop('_' + attr)
+            del state['_digest']
+            obj.__dict__.clear()
+            obj.__dict__.update(state)
+        psf = pickle.loads(pickle.dumps(psf))
+        self.assertTrue(np.all(psf.img == self.psf.img))
+        self.assertTrue(np.all(psf.psfex.psfbases == self.psf.psfex.psfbases))
+        self.assertEqual(psf.hashkey(), key)
+        # the digests follow the properties again
+        psf.psfex.psfbases = psf.psfex.psfbases * 2.
+        self.assertNotEqual(psf.hashkey(), key)
+
     def test_fourier(self):
         F,(cx,cy),shape,(v,w) = self.psf.getFourierTransform(100., 100., 32)
         print('F', F)
@@ -93,6 +114,95 @@ class PsfExTest(unittest.TestCase):
             ps.savefig()
             
         
+    def test_many(self):
+        # Evaluating the PSF at many positions at once gives the same
+        # results as one at a time.
+        psfex = self.psf.psfex
+        xx = np.array([0., 100.5, 1000., 2040.])
+        yy = np.array([0., 3000., 50.2, 4090.])
+        polys = psfex.polynomials(xx, yy)
+        self.assertEqual(polys.shape, (4, psfex.nbases))
+        ims = self.psf.getImages(xx, yy)
+        self.assertEqual(ims.shape, (4,) + psfex.shape)
+        ffts = self.psf.getFourierTransforms(xx, yy, 32)
+        for i, (x, y) in enumerate(zip(xx, yy)):
+            self.assertTrue(np.allclose(polys[i], psfex.polynomials(x, y)))
+            self.assertTrue(np.allclose(ims[i], self.psf.getImage(x, y)))
+            F = self.psf.getFourierTransform(x, y, 32)
+            self.assertTrue(np.allclose(ffts[i][0], F[0]))
+            self.assertEqual(ffts[i][1], F[1])
+            self.assertEqual(ffts[i][2], F[2])
+
+        # Precomputed PSFs are used when rendering.
+        self.psf.precomputeAt(xx, yy, radius=32)
+        p1 = self.psf.getPointSourcePatch(xx[1], yy[1])
+        self.assertEqual(self.psf.fftcache.getStats()['imageAt']['hits'], 1)
+        self.psf.clear_cache()
+        p2 = self.psf.getPointSourcePatch(xx[1], yy[1])
+        self.assertTrue(np.allclose(p1.patch, p2.patch))
+
+    def test_precomputed_render(self):
+        # Rendering a model (or forced-photometry unit models) evaluates
+        # the PSF at all the source positions together.
+        from tractor.patch import ModelMask
+        np.random.seed(42)
+        H,W = 100,120
+        tim = Image(data=np.zeros((H,W), np.float32),
+                    inverr=np.ones((H,W), np.float32), psf=self.psf,
+                    photocal=LinearPhotoCal(1.))
+        srcs = []
+        for i in range(10):
+            pos = PixPos(np.random.uniform(0, W), np.random.uniform(0, H))
+            if i % 2:
+                srcs.append(PointSource(pos, Flux(100.)))
+            else:
+                srcs.append(ExpGalaxy(pos, Flux(100.), EllipseE(2., 0.1, 0.)))
+        tr = Tractor([tim], srcs)
+        disable_galaxy_cache()
+        self.psf.clear_cache()
+        mod = tr.getModelImage(0)
+        stats = self.psf.fftcache.getStats()
+        self.assertEqual(stats['imageAt']['hits'], 5)
+        self.assertEqual(stats['fftAt']['hits'], 5)
+        # Same as rendering the sources one at a time
+        self.psf.clear_cache()
+        ref = np.zeros((H,W), np.float32)
+        for src in srcs:
+            p = src.getModelPatch(tim)
+            if p is not None:
+                p.addTo(ref)
+        self.assertTrue(np.allclose(mod, ref, atol=1e-6))
+        # With a cache budget too small for all the precomputed
+        # entries (the galaxies' eigen-PSF transforms take ~3.7 MB),
+        # the sources are precomputed in chunks that fit it.
+        self.psf.fftcacheBytes = 4200000
+        self.psf.clear_cache()
+        mod = tr.getModelImage(0)
+        stats = self.psf.fftcache.getStats()
+        del self.psf.fftcacheBytes
+        self.assertEqual(stats['imageAt']['hits'], 5)
+        self.assertEqual(stats['fftAt']['hits'], 5)
+        self.assertEqual(stats['fftbases']['evictions'], 0)
+        self.assertTrue(np.allclose(mod, ref, atol=1e-6))
+        # ... also with model masks
+        tr.setModelMasks([dict([(src, ModelMask(int(src.pos.x) - 10,
+                                                int(src.pos.y) - 10, 21, 21))
+                                for src in srcs])])
+        self.psf.clear_cache()
+        mod = tr.getModelImage(0)
+        self.assertEqual(self.psf.fftcache.getStats()['fftAt']['hits'], 5)
+        tr.setModelMasks(None)
+
+        # Forced photometry
+        tim.data = ref + np.random.normal(size=(H,W)).astype(np.float32)
+        tr.freezeParam('images')
+        tr.catalog.freezeAllRecursive()
+        tr.catalog.thawPathsTo('brightness')
+        self.psf.clear_cache()
+        tr.optimize_forced_photometry()
+        self.assertGreaterEqual(
+            self.psf.fftcache.getStats()['imageAt']['hits'], 5)
+
     def test_psfex(self):
 
         if ps is not None:
@@ -0,0 +1,62 @@
+from __future__ import print_function
+import unittest
+
+import numpy as np
+
+from tractor.sersic import SersicMixture
+
+class SersicMixtureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mix = SersicMixture.get()
+        np.random.seed(42)
+        # including the range ends, the n=1 core switch, range
+        # boundaries, and clamped values outside the range
+        self.sindices = np.append(np.random.uniform(0.29, 6.3, 500),
+                                  [0.29, 0.42, 1.0, 1.5, 3.0, 6.3,
+                                   0.9999, 1.0001, 0.2, 7.])
+
+    def test_table(self):
+        # The tabulated profiles match the spline fits.
+        K,amps,varr = self.mix.evaluate(self.sindices)
+        for i,s in enumerate(self.sindices):
+            p = SersicMixture.getProfile(s)
+            ps = self.mix._getSplineProfile(s)
+            self.assertEqual(p.K, ps.K)
+            self.assertEqual(p.K, K[i])
+            self.assertTrue(np.allclose(p.amp, ps.amp, rtol=0, atol=1e-4))
+            self.assertTrue(np.allclose(p.var, ps.var, rtol=1e-4, atol=1e-8))
+            self.assertTrue(np.allclose(p.amp, amps[i,:K[i]]))
+            self.assertTrue(np.allclose(p.var[:,0,0], varr[i,:K[i]]))
+
+        profs = SersicMixture.getProfiles(self.sindices)
+        self.assertEqual(len(profs), len(self.sindices))
+        for p,s in zip(profs, self.sindices):
+            p2 = SersicMixture.getProfile(s)
+            self.assertTrue(np.all(p.amp == p2.amp))
+            self.assertTrue(np.all(p.var == p2.var))
+
+    def test_derivatives(self):
+        K,amps,varr,damps,dvarr = self.mix.evaluate(self.sindices,
+                                                    derivs=True)
+        eps = 1e-6
+        for i,s in enumerate(self.sindices):
+            if s <= 0.29 or s >= 6.3:
+                # clamped
+                self.assertTrue(np.all(damps[i] == 0))
+                self.assertTrue(np.all(dvarr[i] == 0))
+                continue
+            p1 = self.mix._getSplineProfile(s + eps)
+            p0 = self.mix._getSplineProfile(s - eps)
+            if p1.K != p0.K:
+                continue
+            k = K[i]
+            da = (p1.amp - p0.amp) / (2. * eps)
+            dv = (p1.var[:,0,0] - p0.var[:,0,0]) / (2. * eps)
+            self.assertTrue(np.allclose(damps[i,:k], da, rtol=1e-3,
+                                        atol=1e-3))
+            self.assertTrue(np.allclose(dvarr[i,:k], dv, rtol=1e-3,
+                                        atol=1e-3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+from __future__ import print_function
+import unittest
+import pickle
+
+import numpy as np
+
+from tractor import *
+from tractor.spatial import RaDecIndex
+
+
+class LinearRaDecWCS(NullWCS):
+    # A small-angle RA,Dec <-> pixel mapping near the equator (for
+    # testing), with pixel 0,0 at *ra0*,*dec0*.
+    def __init__(self, ra0, dec0, pixscale=1.):
+        super(LinearRaDecWCS, self).__init__(pixscale=pixscale)
+        self.ra0 = ra0
+        self.dec0 = dec0
+
+    def hashkey(self):
+        return ('LinearRaDecWCS', self.ra0, self.dec0, self.pixscale)
+
+    def positionToPixel(self, pos, src=None):
+        s = self.pixscale / 3600.
+        return (pos.ra - self.ra0) / s, (pos.dec - self.dec0) / s
+
+    def pixelToPosition(self, x, y, src=None):
+        s = self.pixscale / 3600.
+        return RaDecPos(self.ra0 + x * s, self.dec0 + y * s)
+
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(42)
+        H, W = 50, 60
+        s = 1. / 3600.
+        # a 3x2 grid of images, overlapping by 10 pixels
+        self.tims = []
+        for i in range(3):
+            for j in range(2):
+                tim = Image(data=np.zeros((H, W), np.float32),
+                            inverr=np.ones((H, W), np.float32),
+                            psf=NCircularGaussianPSF([1.5], [1.]),
+                            wcs=LinearRaDecWCS(i * (W - 10) * s,
+                                               j * (H - 10) * s),
+                            photocal=LinearPhotoCal(1., band='r'))
+                tim.name = 'tim%i%i' % (i, j)
+                self.tims.append(tim)
+        N = 60
+        ra = np.random.uniform(-20, 3 * W, N) * s
+        dec = np.random.uniform(-20, 2 * H, N) * s
+        flux = np.random.uniform(10, 100, N)
+        self.srcs = []
+        for k, (r, d, f) in enumerate(zip(ra, dec, flux)):
+            if k % 3 == 0:
+                src = ExpGalaxy(RaDecPos(r, d), NanoMaggies(r=f),
+                                EllipseE(np.random.uniform(0.5, 3.),
+                                         0.1, -0.1))
+            else:
+                src = PointSource(RaDecPos(r, d), NanoMaggies(r=f))
+            self.srcs.append(src)
+
+    def test_radec_index(self):
+        ra = np.random.uniform(0, 360, 1000)
+        dec = np.degrees(np.arcsin(np.random.uniform(-1, 1, 1000)))
+        index = RaDecIndex(ra, dec)
+        for r, d in [(0., 0.), (180., 89.), (359.9, -30.)]:
+            I = index.near(r, d, 10.)
+            dist = np.degrees(np.arccos(np.clip(
+                np.sin(np.radians(d)) * np.sin(np.radians(dec)) +
+                np.cos(np.radians(d)) * np.cos(np.radians(dec)) *
+                np.cos(np.radians(ra - r)), -1, 1)))
+            self.assertEqual(list(I), list(np.flatnonzero(dist < 10.)))
+
+    def test_models(self):
+        ref = Tractor(self.tims, self.srcs)
+        tr = Tractor(self.tims, self.srcs)
+        tr.useSpatialIndex = True
+        for tim in self.tims:
+            self.assertTrue(np.array_equal(tr.getModelImage(tim),
+                                           ref.getModelImage(tim)))
+        index = tr.getSpatialIndex()
+        n = [len(index.getSources(tim)) for tim in self.tims]
+        self.assertLess(max(n), len(self.srcs))
+        self.assertLess(index.nchecked, len(self.srcs) * len(self.tims))
+
+        # Moving a source updates the index.
+        src = self.srcs[1]
+        src.pos.ra, src.pos.dec = self.tims[5].getWcs().pixelToPosition(
+            30, 25).getParams()
+        for tim in self.tims:
+            self.assertTrue(np.array_equal(tr.getModelImage(tim),
+                                           ref.getModelImage(tim)))
+        self.assertTrue(src in index.getSources(self.tims[5]))
+
+        # Derivatives
+        tr.freezeParam('images')
+        ref.freezeParam('images')
+        # (galaxy derivatives can include patches lying just outside
+        # the image, which the index skips)
+        def inside(derivs):
+            return [(d, img) for d, img in derivs
+                    if d.x0 < img.shape[1] and d.x1 > 0 and
+                    d.y0 < img.shape[0] and d.y1 > 0]
+        d1 = [inside(p) for p in tr.getDerivs()]
+        d2 = [inside(p) for p in ref.getDerivs()]
+        self.assertEqual(len(d1), len(d2))
+        for p1, p2 in zip(d1, d2):
+            self.assertEqual(len(p1), len(p2))
+            for (deriv1, img1), (deriv2, img2) in zip(p1, p2):
+                self.assertIs(img1, img2)
+                self.assertEqual(deriv1.getExtent(), deriv2.getExtent())
+                self.assertTrue(np.array_equal(deriv1.patch, deriv2.patch))
+
+        # Pickling keeps the setting.
+        tr2 = pickle.loads(pickle.dumps(tr))
+        self.assertTrue(tr2.useSpatialIndex)
+
+    def test_forced_phot(self):
+        ref = Tractor(self.tims, self.srcs)
+        for tim in self.tims:
+            tim.data = ref.getModelImage(tim) + np.random.normal(
+                size=tim.shape).astype(np.float32)
+        fluxes = []
+        for use in [False, True]:
+            tr = Tractor(self.tims, [src.copy() for src in self.srcs])
+            tr.useSpatialIndex = use
+            tr.freezeParam('images')
+            tr.catalog.freezeAllRecursive()
+            tr.catalog.thawPathsTo('r')
+            # (the exact solver: LSQR's iterations can stop at slightly
+            # different points once non-overlapping models are None)
+            tr.optimize_forced_photometry(solver='cholesky')
+            fluxes.append(np.array(tr.catalog.getParams()))
+        self.assertTrue(np.allclose(fluxes[0], fluxes[1], rtol=1e-6))
+
+    def test_model_masks(self):
+        tr = Tractor(self.tims, self.srcs)
+        tr.useSpatialIndex = True
+        mods = [tr.getModelImage(tim) for tim in self.tims]
+        masks = tr.getModelMasks()
+        self.assertEqual(len(masks), len(self.tims))
+        for tim, m in zip(self.tims, masks):
+            self.assertEqual(len(m), len(tr.getSpatialIndex().getSources(tim)))
+            for src, mm in m.items():
+                self.assertTrue(mm.w > 0 and mm.h > 0)
+        tr.setModelMasks(masks)
+        for tim, mod in zip(self.tims, mods):
+            self.assertLess(np.max(np.abs(tr.getModelImage(tim) - mod)),
+                            1e-4)
+
+    def test_oversized_mask(self):
+        # A source's model mask, not its extent, bounds its patch.
+        tr = Tractor(self.tims, self.srcs)
+        tr.useSpatialIndex = True
+        ref = Tractor(self.tims, self.srcs)
+        index = tr.getSpatialIndex()
+        tim = self.tims[0]
+        H, W = tim.shape
+        src = [s for s in index.getSources(tim)
+               if isinstance(s, PointSource)][0]
+        # an image the source is far from
+        far = [t for t in self.tims if src not in index.getSources(t)][-1]
+        masks = [{} for t in self.tims]
+        masks[0][src] = ModelMask(-5, -5, W + 10, H + 10)
+        masks[self.tims.index(far)][src] = ModelMask(0, 0, 20, 10)
+        for t in [tr, ref]:
+            t.setModelMasks(masks, assumeMasks=False)
+        index = tr.getSpatialIndex()
+        self.assertIn(src, index.getSources(far))
+        mm = index.getModelMasks()
+        self.assertEqual(mm[0][src].extent, (0, W, 0, H))
+        self.assertEqual(mm[self.tims.index(far)][src].extent,
+                         (0, 20, 0, 10))
+        for t in self.tims:
+            self.assertTrue(np.array_equal(tr.getModelImage(t),
+                                           ref.getModelImage(t)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+from __future__ import print_function
+import unittest
+
+import numpy as np
+
+from tractor.splinesky import (SplineSky, median_estimator,
+                               sigma_clipped_mean_estimator)
+
+class SplineSkyTest(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(17)
+        H,W = 210, 333
+        self.image = (np.random.normal(size=(H,W)) +
+                      np.linspace(0, 5, W)[np.newaxis,:]).astype(np.float32)
+        self.mask = np.random.uniform(size=(H,W)) > 0.3
+        # a fully-masked region
+        self.mask[:40, :60] = False
+
+    def test_blanton_vectorized(self):
+        # The vectorized estimators give the same grids as calling the
+        # estimator on each cell.
+        def percell(pix, mask, **kwargs):
+            return median_estimator(pix, mask, **kwargs)
+        for kw in [dict(), dict(min_fraction=0.5), dict(min_fraction=20.)]:
+            sky1 = SplineSky.BlantonMethod(self.image, self.mask, 32,
+                                           estimator=percell, **kw)
+            sky2 = SplineSky.BlantonMethod(self.image, self.mask, 32, **kw)
+            sky3 = SplineSky.BlantonMethod(self.image, self.mask, 32,
+                                           threads=4, **kw)
+            g1,g2,g3 = sky1.get_grid(), sky2.get_grid(), sky3.get_grid()
+            self.assertTrue(np.all(g1 == g2))
+            self.assertTrue(np.all(g1 == g3))
+
+        sky1 = SplineSky.BlantonMethod(self.image, None, 50,
+                                       estimator=percell)
+        sky2 = SplineSky.BlantonMethod(self.image, None, 50)
+        self.assertTrue(np.all(sky1.get_grid() == sky2.get_grid()))
+
+    def test_sigma_clipped(self):
+        image = self.image.copy()
+        # outliers
+        image[100:105, 200:205] = 1000.
+        def percell(pix, mask, **kwargs):
+            return sigma_clipped_mean_estimator(pix, mask, **kwargs)
+        sky1 = SplineSky.BlantonMethod(image, self.mask, 40,
+                                       estimator=percell)
+        sky2 = SplineSky.BlantonMethod(
+            image, self.mask, 40, estimator=sigma_clipped_mean_estimator)
+        self.assertTrue(np.allclose(sky1.get_grid(), sky2.get_grid()))
+        # the outliers are clipped
+        sky3 = SplineSky.BlantonMethod(self.image, self.mask, 40,
+                                       estimator=sigma_clipped_mean_estimator)
+        self.assertTrue(np.max(np.abs(sky2.get_grid() - sky3.get_grid()))
+                        < 0.1)
+
+    def test_basis(self):
+        sky = SplineSky.BlantonMethod(self.image, self.mask, 64)
+        H,W = self.image.shape
+        for x0,y0 in [(0,0), (10,-5)]:
+            s = sky.shifted(x0, y0)
+            mod = np.zeros((H,W))
+            s.addTo(mod)
+            S = s.evaluateGrid(np.arange(W), np.arange(H))
+            self.assertTrue(np.allclose(mod, S, rtol=0, atol=1e-10))
+
+        # The sky image is memoized, for the current parameters.
+        S1 = sky.evaluateImage(H, W)
+        self.assertTrue(sky.evaluateImage(H, W) is S1)
+        sky.offset(1.)
+        S2 = sky.evaluateImage(H, W)
+        self.assertTrue(np.allclose(S2, S1 + 1.))
+        p = sky.getParams()
+        sky.setParam(3, p[3] + 1.)
+        S3 = sky.evaluateImage(H, W)
+        self.assertFalse(np.allclose(S3, S2))
+
+        # Derivatives are the basis functions.
+        from tractor import Image
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)), sky=sky)
+        derivs = sky.getParamDerivatives(None, tim, [])
+        self.assertEqual(len(derivs), sky.numberOfParams())
+        for i in [0, 3, 17]:
+            p0 = sky.getParams()[i]
+            sky.setParam(i, p0 + 1.)
+            dS = sky.evaluateImage(H, W) - S3
+            sky.setParam(i, p0)
+            d = np.zeros((H,W))
+            derivs[i].addTo(d)
+            self.assertTrue(np.allclose(d, dS, atol=1e-10))
+
+    def test_fit_sky(self):
+        # Fitting the SplineSky parameters uses the basis derivatives.
+        from tractor import Image, Tractor
+        H,W = self.image.shape
+        truth = SplineSky.BlantonMethod(self.image, self.mask, 64)
+        data = np.zeros((H,W), np.float32)
+        truth.addTo(data)
+        sky = truth.copy()
+        sky.offset(2.)
+        tim = Image(data=data, invvar=np.ones((H,W)), sky=sky)
+        tr = Tractor([tim], [])
+        tr.freezeParam('catalog')
+        tim.freezeAllBut('sky')
+        tr.optimize_loop()
+        self.assertTrue(np.allclose(sky.evaluateImage(H,W),
+                                    truth.evaluateImage(H,W), atol=1e-4))
+
+if __name__ == '__main__':
+    unittest.main()
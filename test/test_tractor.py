@@ -4,10 +4,12 @@ matplotlib.use('Agg')
 import pylab as plt
 
 import unittest
+import sys
 
 from tractor import *
 #from tractor.sdss import *
 from tractor.galaxy import *
+from tractor.cache import TractorCacheMixin
 
 class TractorTest(unittest.TestCase):
     def test_expgal(self):
@@ -124,6 +126,618 @@ class TractorTest(unittest.TestCase):
         self.assertTrue(np.abs(star.getBrightness().getValue() - trueflux)
                         < 5.)
 
+    def test_batch_render(self):
+        from tractor.patch import ModelMask
+        W,H = 60,50
+        psf = GaussianMixturePSF([0.7, 0.3], np.array([[0.,0.],[0.2,-0.1]]),
+                                 np.array([[[4.,0.5],[0.5,3.]],
+                                           [[16.,-1.],[-1.,12.]]]))
+        tim1 = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)), psf=psf,
+                     photocal=LinearPhotoCal(1.))
+        pixpsf = PixelizedPSF(psf.getPointSourcePatch(0., 0., radius=10).patch)
+        tim2 = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)), psf=pixpsf,
+                     photocal=LinearPhotoCal(1.))
+        srcs = [PointSource(PixPos(20.3, 25.6), Flux(100.)),
+                # partly off the edge
+                PointSource(PixPos(-2.2, 10.1), Flux(50.)),
+                # entirely off the image
+                PointSource(PixPos(-100., 10.), Flux(50.)),
+                ExpGalaxy(PixPos(40.1, 20.7), Flux(200.),
+                          GalaxyShape(3., 0.6, 30.)),
+                DevGalaxy(PixPos(35.9, 38.2), Flux(150.),
+                          GalaxyShape(2., 0.8, 120.)),
+                FixedCompositeGalaxy(PixPos(10.5, 40.5), Flux(80.),
+                                     0.4, EllipseE(2., 0.1, -0.2),
+                                     EllipseE(1., 0.2, 0.1)),
+                PointSource(PixPos(55., 45.), Flux(0.)),]
+        tr = Tractor([tim1, tim2], srcs)
+
+        for minsb in [0., 1e-3]:
+            refs = [tr.getModelImage(tim, minsb=minsb) for tim in [tim1, tim2]]
+            tr.batchRender = True
+            mods = [tr.getModelImage(tim, minsb=minsb) for tim in [tim1, tim2]]
+            tr.batchRender = False
+            for ref,mod in zip(refs, mods):
+                self.assertTrue(np.sum(ref) > 500.)
+                self.assertLess(np.max(np.abs(ref - mod)), 1e-5 + minsb)
+
+        # With ModelMasks
+        masks = [dict([(src, ModelMask(x0, y0, 15, 12)) for src,x0,y0
+                       in zip(srcs, [12, 0, 0, 30, 30, 5, 50],
+                              [20, 5, 0, 15, 30, 35, 40])])] * 2
+        tr.setModelMasks(masks)
+        ref = tr.getModelImage(tim1)
+        tr.batchRender = True
+        mod = tr.getModelImage(tim1)
+        self.assertLess(np.max(np.abs(ref - mod)), 1e-5)
+
+    def test_incremental_models(self):
+        W,H = 60,50
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(3.))
+        srcs = [PointSource(PixPos(20.3, 25.6), Flux(100.)),
+                PointSource(PixPos(40.1, 20.7), Flux(200.)),
+                ExpGalaxy(PixPos(35.9, 38.2), Flux(150.),
+                          EllipseE(2., 0.2, 0.1))]
+        tr = Tractor([tim], srcs)
+        tr.freezeParam('images')
+        ref = tr.getModelImage(0)
+
+        tr.incrementalModels = True
+        mod = tr.getModelImage(0)
+        self.assertLess(np.max(np.abs(ref - mod)), 1e-5)
+        acc = tr.getModelAccumulator(tim)
+        self.assertEqual(acc.nrendered, 3)
+
+        # Nothing changed
+        mod = tr.getModelImage(0)
+        self.assertLess(np.max(np.abs(ref - mod)), 1e-5)
+        self.assertEqual(acc.nrendered, 3)
+
+        # Change one source via setParams, another directly.
+        p = tr.getParams()
+        p[0] += 0.5
+        tr.setParams(p)
+        srcs[2].shape.re = 2.5
+        mod = tr.getModelImage(0)
+        self.assertEqual(acc.nrendered, 5)
+        tr.incrementalModels = False
+        ref = tr.getModelImage(0)
+        self.assertLess(np.max(np.abs(ref - mod)), 1e-5)
+
+        # A change to the PSF forces a rebuild.
+        tr.incrementalModels = True
+        tim.psf.sigmas.setParam(0, 2.)
+        mod = tr.getModelImage(0)
+        self.assertEqual(acc.nrendered, 8)
+        tr.incrementalModels = False
+        ref = tr.getModelImage(0)
+        self.assertLess(np.max(np.abs(ref - mod)), 1e-5)
+
+        # The log-likelihood is unchanged.
+        lnl = tr.getLogLikelihood()
+        tr.incrementalModels = True
+        self.assertLess(np.abs(tr.getLogLikelihood() - lnl), 1e-3)
+
+    def test_chi_squared(self):
+        W,H = 200,150
+        np.random.seed(42)
+        tim = Image(data=np.random.normal(size=(H,W)).astype(np.float32),
+                    invvar=np.random.uniform(0.5, 2., size=(H,W)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.1))
+        srcs = [PointSource(PixPos(x, y), Flux(f)) for x,y,f in
+                zip(np.random.uniform(0, W, 20), np.random.uniform(0, H, 20),
+                    np.random.uniform(10., 100., 20))]
+        tr = Tractor([tim], srcs)
+        tr.freezeParam('images')
+
+        def ref_chisq():
+            chi = tr.getChiImage(0)
+            return (chi.astype(float) ** 2).sum()
+
+        chisq = tr.getChiSquared(0)
+        self.assertAlmostEqual(chisq / ref_chisq(), 1., places=8)
+        self.assertAlmostEqual(tr.getLogLikelihood(), -0.5 * chisq)
+
+        tr.incrementalModels = True
+        acc = tr.getModelAccumulator(tim, minsb=0.)
+        self.assertAlmostEqual(tr.getChiSquared(0) / chisq, 1., places=6)
+        for step in range(5):
+            # Move a couple of sources; only their patches are
+            # re-evaluated.
+            for i in np.random.randint(len(srcs), size=2):
+                srcs[i].pos.x += np.random.normal()
+                srcs[i].brightness.setParams([np.random.uniform(10., 100.)])
+            chisq = tr.getChiSquared(0)
+            self.assertEqual(acc.nchiupdates, step + 1)
+            tr.incrementalModels = False
+            ref = ref_chisq()
+            tr.incrementalModels = True
+            self.assertAlmostEqual(chisq / ref, 1., places=5)
+
+        # Changing the sky forces a full recomputation.
+        tim.sky.setParams([0.2])
+        chisq = tr.getChiSquared(0)
+        self.assertEqual(acc.nchiupdates, 0)
+        tr.incrementalModels = False
+        self.assertAlmostEqual(chisq / ref_chisq(), 1., places=5)
+
+        # Rendering the model (via getChiImage, which shares the
+        # accumulator) between chi-squared evaluations, as the LSQR
+        # optimizer does, must not leave a stale chi-squared.
+        tr.incrementalModels = True
+        for step in range(3):
+            lnl = tr.getLogLikelihood()
+            srcs[step].pos.x += 2.
+            tr.getChiImage(0)
+            lnl = tr.getLogLikelihood()
+            tr.incrementalModels = False
+            ref = -0.5 * ref_chisq()
+            tr.incrementalModels = True
+            self.assertAlmostEqual(lnl / ref, 1., places=5)
+
+    def test_param_layout(self):
+        srcs = [PointSource(PixPos(1., 2.), Flux(3.)),
+                ExpGalaxy(PixPos(4., 5.), Flux(6.), EllipseE(7., 0.1, 0.2))]
+        cat = Catalog(*srcs)
+
+        def ref():
+            # the thawed parameters, by recursing through the sources
+            return sum([src.getParams() for src in cat._getActiveSubs()], [])
+
+        self.assertEqual(cat.getParams(), [1., 2., 3., 4., 5., 6., 7., 0.1, 0.2])
+        self.assertEqual(cat.numberOfParams(), 9)
+        cat.setParams(np.arange(9))
+        self.assertEqual(ref(), list(range(9)))
+        cat.setParam(7, 10.)
+        self.assertEqual(srcs[1].shape.e1, 10.)
+
+        # Freezing and thawing, at any level, change the layout.
+        srcs[1].freezeParam('pos')
+        self.assertEqual(cat.numberOfParams(), 7)
+        self.assertEqual(cat.getParams(), ref())
+        srcs[0].pos.freezeParam('x')
+        self.assertEqual(cat.getParams(), [1., 2., 5., 6., 10., 8.])
+        cat.freezeParam(0)
+        self.assertEqual(cat.getParams(), ref())
+        cat.thawAllRecursive()
+        self.assertEqual(cat.numberOfParams(), 9)
+
+        # So does replacing or adding sub-Params.
+        srcs[0].brightness = Flux(20.)
+        self.assertEqual(cat.getParams()[2], 20.)
+        cat.append(PointSource(PixPos(0., 0.), Flux(1.)))
+        self.assertEqual(cat.numberOfParams(), 12)
+        self.assertEqual(cat.getParams(), ref())
+
+        # Shared Params objects appear as shared parameters.
+        cat.append(PointSource(srcs[0].pos, Flux(30.)))
+        I = cat.getSharedParamMap()
+        self.assertEqual(len(I), 15)
+        self.assertEqual(list(I[:2]), list(I[12:14]))
+        self.assertEqual(len(np.unique(I)), 13)
+        self.assertEqual(cat.getParams(), ref())
+
+    def test_linearized_linesearch(self):
+        W,H = 100,100
+        results = []
+        for linesearch in ['exact', 'linear']:
+            tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                        psf=NCircularGaussianPSF([1.5], [1.]),
+                        photocal=LinearPhotoCal(1.))
+            srcs = [PointSource(PixPos(30., 40.), Flux(100.)),
+                    ExpGalaxy(PixPos(60., 60.), Flux(300.),
+                              EllipseESoft(1., 0.2, 0.1))]
+            tr = Tractor([tim], srcs)
+            tr.freezeParam('images')
+            np.random.seed(42)
+            tim.data = tr.getModelImage(0) + np.random.normal(size=(H,W))
+            srcs[0].pos.x += 0.7
+            srcs[0].brightness.setParams([60.])
+            srcs[1].shape.logre = 0.5
+            R = tr.optimizer.optimize_loop(tr, linesearch=linesearch)
+            if linesearch == 'exact':
+                self.assertEqual(R['renders_saved'], 0)
+            else:
+                self.assertGreater(R['renders_saved'], 0)
+            results.append((tr.getLogProb(), np.array(tr.getParams())))
+        (lnp1, p1), (lnp2, p2) = results
+        self.assertLess(np.abs(lnp1 - lnp2), 1e-2)
+        self.assertLess(np.max(np.abs(p1 - p2)), 1e-2)
+
+    def test_cholesky_solver(self):
+        W,H = 80,80
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W))*4.,
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(2.))
+        # Two point sources sharing a brightness (shared params)
+        flux = Flux(50.)
+        srcs = [PointSource(PixPos(30., 40.), Flux(100.)),
+                ExpGalaxy(PixPos(50., 50.), Flux(300.),
+                          EllipseESoft(1., 0.2, 0.1)),
+                PointSource(PixPos(33., 42.), flux),
+                PointSource(PixPos(10., 60.), flux),]
+        srcs[0].pos.addGaussianPrior('x', 30., 0.1)
+        tr = Tractor([tim], srcs)
+        tim.freezeAllBut('sky')
+        np.random.seed(42)
+        tim.data = tr.getModelImage(0) + np.random.normal(size=(H,W)) * 0.5
+        srcs[0].pos.x += 0.5
+        flux.setParams([80.])
+
+        for kwargs in [dict(), dict(scale_columns=False), dict(damp=1.),
+                       dict(priors=False), dict(shared_params=False)]:
+            X1 = tr.optimizer.getUpdateDirection(tr, tr.getDerivs(), **kwargs)
+            X2 = tr.optimizer.getUpdateDirection(tr, tr.getDerivs(),
+                                                 solver='cholesky', **kwargs)
+            self.assertEqual(len(X1), len(X2))
+            self.assertLess(np.max(np.abs(X1 - X2)),
+                            1e-4 * np.max(np.abs(X1)))
+
+        X1,v1 = tr.optimizer.getUpdateDirection(tr, tr.getDerivs(),
+                                                variance=True)
+        X2,v2 = tr.optimizer.getUpdateDirection(tr, tr.getDerivs(),
+                                                variance=True,
+                                                solver='cholesky')
+        self.assertLess(np.max(np.abs(v1 - v2) / v1), 1e-5)
+
+        R = tr.optimizer.optimize_loop(tr, solver='cholesky')
+        self.assertLess(np.abs(flux.getValue() - 50.), 1.)
+
+        # The dense optimizer has only its own solver.
+        from tractor.dense_optimizer import ConstrainedDenseOptimizer
+        opt = ConstrainedDenseOptimizer()
+        self.assertRaises(RuntimeError, opt.getUpdateDirection, tr,
+                          tr.getDerivs(), shared_params=False,
+                          solver='cholesky')
+
+    def test_profiler(self):
+        import json
+        W,H = 50,40
+        tim = Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.), sky=ConstantSky(0.),
+                    name='tim1')
+        srcs = [PointSource(PixPos(10., 12.), Flux(100.)),
+                ExpGalaxy(PixPos(30., 20.), Flux(200.),
+                          EllipseESoft(0.5, 0.1, 0.))]
+        tr = Tractor([tim], srcs)
+        np.random.seed(42)
+        tim.data = tr.getModelImage(0) + np.random.normal(size=(H,W))
+        tr.freezeParam('images')
+        srcs[0].pos.x += 0.3
+
+        prof = tr.enableProfiling(memory=True)
+        tr.optimize_loop()
+        stats = prof.summary()
+        for phase in ['render', 'derivs', 'matrix', 'solve', 'linesearch']:
+            self.assertTrue((phase,) in stats)
+            self.assertGreater(stats[(phase,)]['calls'], 0)
+        # Nested phases: 'solve' (and rendering the chi images) happens
+        # within 'matrix'
+        m,s = stats[('matrix',)], stats[('solve',)]
+        self.assertLess(m['self_time'], m['time'])
+        self.assertGreaterEqual(m['time'] - m['self_time'], s['time'])
+        # Broken down by image and source type
+        bysrc = prof.summary(by=('phase', 'image', 'source'))
+        for src in ['PointSource', 'ExpGalaxy']:
+            self.assertTrue(('render', 'tim1', src) in bysrc)
+            self.assertTrue(('derivs', 'tim1', src) in bysrc)
+        self.assertEqual(len(prof.getStats(source='ExpGalaxy')),
+                         len([k for k in bysrc if k[2] == 'ExpGalaxy']))
+        self.assertGreater(stats[('matrix',)]['peak_bytes'], 0)
+        d = json.loads(prof.toJson())
+        self.assertEqual(len(d['stats']), len(prof.stats))
+        self.assertTrue(tr.disableProfiling() is prof)
+
+        # Forced photometry
+        tr.freezeParamsRecursive('*')
+        tr.thawPathsTo('brightness')
+        prof = tr.enableProfiling()
+        tr.optimize_forced_photometry(variance=True, fitstats=True)
+        stats = prof.summary()
+        for phase in ['unitmodels', 'fitstats', 'variance', 'matrix',
+                      'solve', 'linesearch']:
+            self.assertTrue((phase,) in stats)
+        self.assertEqual(stats[('unitmodels',)]['calls'], 2)
+        self.assertEqual(stats[('matrix',)]['peak_bytes'], 0)
+        # Not pickled
+        import pickle
+        tr2 = pickle.loads(pickle.dumps(tr))
+        self.assertTrue(tr2.profiler is None)
+
+    def test_multiproc(self):
+        from multiprocessing.pool import ThreadPool
+        from multiprocessing import Pool
+        from tractor.multiproc import MultiprocTractor
+        from tractor.patch import ModelMask
+        W,H = 60,50
+        tims = [Image(data=np.zeros((H,W)), invvar=np.ones((H,W)),
+                      psf=NCircularGaussianPSF([s], [1.]),
+                      photocal=LinearPhotoCal(1.), sky=ConstantSky(1.))
+                for s in [1.5, 2.]]
+        srcs = [PointSource(PixPos(20.3, 25.6), Flux(100.)),
+                ExpGalaxy(PixPos(40.1, 20.7), Flux(200.),
+                          EllipseE(3., 0.2, 0.1)),
+                DevGalaxy(PixPos(35.9, 38.2), Flux(150.),
+                          EllipseE(2., -0.1, 0.3)),]
+        np.random.seed(42)
+        for tim in tims:
+            tim.data = np.random.normal(size=(H,W))
+        tims[1].freezeAllBut('sky')
+        srcs[2].freezeAllBut('brightness')
+        tr = Tractor(tims, srcs)
+        masks = [dict([(src, ModelMask(int(src.pos.x) - 10,
+                                       int(src.pos.y) - 10, 21, 21))
+                       for src in srcs[:2]]) for tim in tims]
+
+        for mask in [None, masks]:
+            tr.setModelMasks(mask)
+            mods = list(tr.getModelImages())
+            lnl = tr.getLogLikelihood()
+            derivs = tr.getDerivs()
+            for pool in [None, ThreadPool(2), Pool(2)]:
+                mtr = MultiprocTractor(tims, srcs, mp=pool)
+                mtr.sourceBlockSize = 2
+                mtr.setModelMasks(mask)
+                for m1,m2 in zip(mods, mtr.getModelImages()):
+                    self.assertTrue(np.all(m1 == m2))
+                self.assertEqual(lnl, mtr.getLogLikelihood())
+                mderivs = mtr.getDerivs()
+                self.assertEqual(len(derivs), len(mderivs))
+                for d1,d2 in zip(derivs, mderivs):
+                    self.assertEqual(len(d1), len(d2))
+                    for (p1,im1),(p2,im2) in zip(d1, d2):
+                        self.assertTrue(im1 is im2)
+                        self.assertEqual(p1.getExtent(), p2.getExtent())
+                        self.assertTrue(np.all(p1.patch == p2.patch))
+                if pool is not None:
+                    pool.close()
+
+        # In-process tasks step the sources themselves, not copies.
+        class Counting(PointSource):
+            seen = []
+            def getParamDerivatives(self, *args, **kwargs):
+                Counting.seen.append(id(self))
+                return super(Counting, self).getParamDerivatives(*args,
+                                                                 **kwargs)
+        csrcs = [Counting(PixPos(20.3 + 5*k, 25.6), Flux(100.))
+                 for k in range(5)]
+        p0 = [src.getParams() for src in csrcs]
+        for pool in [None, ThreadPool(2)]:
+            Counting.seen = []
+            mtr = MultiprocTractor(tims, csrcs, mp=pool)
+            mtr.sourceBlockSize = 2
+            mtr.getDerivs()
+            self.assertEqual(sorted(Counting.seen),
+                             sorted([id(src) for src in csrcs] * len(tims)))
+            self.assertEqual([src.getParams() for src in csrcs], p0)
+            if pool is not None:
+                pool.close()
+
+        # Sources sharing a brightness are stepped one at a time.
+        from concurrent.futures import ThreadPoolExecutor
+        flux = Flux(100.)
+        ssrcs = [PointSource(PixPos(20.3 + 5*k, 25.6), flux)
+                 for k in range(5)]
+        derivs = Tractor(tims, ssrcs).getDerivs()
+        for pool in [ThreadPool(2), ThreadPoolExecutor(2)]:
+            mtr = MultiprocTractor(tims, ssrcs, mp=pool)
+            mtr.sourceBlockSize = 2
+            self.assertTrue(mtr._threaded())
+            self.assertTrue(mtr._sharesParams())
+            for d1,d2 in zip(derivs, mtr.getDerivs()):
+                for (p1,im1),(p2,im2) in zip(d1, d2):
+                    self.assertTrue(np.all(p1.patch == p2.patch))
+            if isinstance(pool, ThreadPool):
+                pool.close()
+            else:
+                pool.shutdown()
+
+        # Source-derivative tasks don't ship the pixels.
+        import pickle
+        from tractor.multiproc import ImageGeometry
+        geom = ImageGeometry(tims[0])
+        self.assertEqual(geom.shape, (H,W))
+        self.assertIsNone(geom.getImage())
+        self.assertLess(len(pickle.dumps(geom)),
+                        len(pickle.dumps(tims[0])) - tims[0].data.nbytes)
+
+    def test_lanczos_shift_threads(self):
+        from multiprocessing.pool import ThreadPool
+        from tractor.psf import lanczos_shift_image, _lanczos_work
+        np.random.seed(42)
+        # including one taller than the old 4096-pixel scratch array,
+        # and one as wide
+        imgs = [np.random.normal(size=(H,W)).astype(np.float32)
+                for H,W in [(25,25), (64,33), (17,90), (4200,12),
+                            (12,4200)]]
+        shifts = [(0.3, -0.2), (-0.45, 0.1), (0.05, 0.5)]
+        args = [(img, dx, dy) for img in imgs for dx,dy in shifts] * 4
+        def shift(X):
+            img, dx, dy = X
+            return lanczos_shift_image(img, dx, dy)
+        refs = [shift(X) for X in args]
+        # The scratch buffer is only as big as the largest image.
+        self.assertEqual(_lanczos_work.work.size, 4200 * 12)
+        pool = ThreadPool(4)
+        outs = pool.map(shift, args)
+        pool.close()
+        for ref,out in zip(refs, outs):
+            self.assertTrue(np.all(ref == out))
+        # Agrees with the python version away from the edges
+        for (img,dx,dy),ref in zip(args[:len(shifts)*len(imgs)], refs):
+            py = lanczos_shift_image(img, dx, dy, force_python=True)
+            self.assertLess(np.max(np.abs(ref - py)[3:-3, 3:-3]), 1e-4)
+
+    def test_cache(self):
+        import pickle
+        from tractor.cache import Cache
+        cache = Cache(maxsize=None, maxbytes=10000)
+        for i in range(5):
+            cache.put(('a', i), np.zeros(300))
+        # 5 x 2400 bytes > 10000: the first was evicted
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.totalSize(), 9600)
+        self.assertIsNone(cache.get(('a', 0), None))
+        self.assertIsNotNone(cache.get(('a', 1), None))
+        # ('a', 2) is now the least-recently used
+        cache.put(('b', 0), (Patch(0, 0, np.zeros((10,10))), 'x'))
+        self.assertIsNone(cache.get(('a', 2), None))
+        self.assertEqual(cache.totalSize(), 3 * 2400 + 800)
+        # too big to cache
+        cache.put(('b', 1), np.zeros(2000))
+        self.assertFalse(('b', 1) in cache)
+        # replacing an entry
+        cache.put(('a', 1), np.zeros(10))
+        self.assertEqual(cache.totalSize(), 2 * 2400 + 800 + 80)
+        stats = cache.getStats()
+        self.assertEqual(stats['a'], dict(hits=1, misses=2, evictions=2))
+        self.assertEqual(stats['b'], dict(hits=0, misses=0, evictions=1))
+        self.assertTrue(str(cache).startswith(
+            'Cache: 4 items, total of 1 hits, 2 misses, 3 evictions'))
+        import io
+        from contextlib import redirect_stdout
+        out = io.StringIO()
+        with redirect_stdout(out):
+            cache.printStats()
+        self.assertIn('  a: 1 hits, 2 misses, 2 evictions\n', out.getvalue())
+        self.assertIn('  b: 0 hits, 0 misses, 1 evictions\n', out.getvalue())
+        # Keys that hash equal but are not equal don't collide.
+        cache.put((-1, 'x'), 1)
+        cache.put((-2, 'x'), 2)
+        self.assertEqual(cache.get((-1, 'x')), 1)
+        self.assertEqual(cache.get((-2, 'x')), 2)
+
+        c2 = pickle.loads(pickle.dumps(cache))
+        self.assertEqual(len(c2), 0)
+        self.assertEqual(c2.maxbytes, 10000)
+
+        # PixelizedPSF's Fourier transform cache
+        psf = PixelizedPSF(np.ones((15,15)))
+        f1 = psf.getFourierTransform(0., 0., 10)
+        f2 = psf.getFourierTransform(0., 0., 10)
+        self.assertTrue(f1 is f2)
+        self.assertEqual(psf.fftcache.getStats()['fft']['hits'], 1)
+        psf2 = pickle.loads(pickle.dumps(psf))
+        f3 = psf2.getFourierTransform(0., 0., 10)
+        self.assertTrue(np.all(f1[0] == f3[0]))
+
+    @unittest.skipIf(sys.version_info < (3, 8),
+                     'SharedCache requires Python 3.8')
+    def test_shared_cache(self):
+        import multiprocessing
+        from tractor.mpcache import SharedCache
+        cache = SharedCache(maxbytes=10000, nslots=64)
+        p = Patch(3, 4, np.arange(12.).reshape((3,4)))
+        cache.put(('a', 0), p)
+        p2 = cache.get(('a', 0))
+        self.assertEqual((p2.x0, p2.y0), (3, 4))
+        self.assertTrue(np.all(p2.patch == p.patch))
+        self.assertIsNone(cache.get(('a', 1), None))
+
+        # Entries put in one process are seen in the others.
+        pool = multiprocessing.get_context('fork').Pool(2)
+        sums = pool.map(_shared_cache_task, [(cache, i) for i in range(4)])
+        pool.close()
+        pool.join()
+        self.assertEqual(sums, [66.] * 4)
+        for i in range(4):
+            self.assertTrue(np.all(cache.get(('b', i)) == np.arange(i)))
+        self.assertEqual(cache.getStats()['b']['hits'], 4)
+
+        # The byte budget is respected: the oldest entries are gone.
+        for i in range(5):
+            cache.put(('c', i), np.zeros(300))
+        self.assertTrue(cache.totalSize() <= 10000)
+        self.assertFalse(('c', 0) in cache)
+        self.assertTrue(('c', 4) in cache)
+        # too big to cache
+        cache.put(('c', 5), np.zeros(2000))
+        self.assertFalse(('c', 5) in cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        cache.close()
+
+        # Zero-copy reads
+        cache = SharedCache(maxbytes=10000, copy=False)
+        cache.put('x', np.arange(5.))
+        x = cache.get('x')
+        self.assertTrue(np.all(x == np.arange(5.)))
+        self.assertFalse(x.flags.writeable)
+        del x
+        cache.close()
+
+        # As a Tractor's model-patch cache
+        tim = Image(data=np.zeros((20,20)), invvar=np.ones((20,20)),
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    photocal=LinearPhotoCal(1.))
+        src = PointSource(PixPos(10.2, 9.7), Flux(10.))
+        cache = SharedCache(maxbytes=1000000)
+        tr = _CachedTractor([tim], [src], cache=cache)
+        mod1 = tr.getModelImage(0)
+        mod2 = tr.getModelImage(0)
+        self.assertTrue(np.all(mod1 == mod2))
+        self.assertEqual(cache.getStats()['modelpatch']['hits'], 1)
+        cache.close()
+
+        # A Pool worker hits the model patches, unit-flux galaxy
+        # patches and PSF Fourier transforms put by this process.
+        from tractor.galaxy import set_galaxy_cache
+        from tractor.psf import set_psf_fft_cache
+        cache = SharedCache(maxbytes=10000000, copy=False)
+        set_galaxy_cache(cache)
+        set_psf_fft_cache(cache)
+        try:
+            psf = NCircularGaussianPSF([1.5], [1.])
+            psf = PixelizedPSF(psf.getPointSourcePatch(0., 0., radius=8).patch)
+            tim = Image(data=np.zeros((50,50)), invvar=np.ones((50,50)),
+                        psf=psf, photocal=LinearPhotoCal(1.))
+            gal = ExpGalaxy(PixPos(24.3, 25.6), Flux(10.),
+                            EllipseE(3., 0.2, 0.1))
+            mod1 = _CachedTractor([tim], [gal], cache=cache).getModelImage(0)
+            psf.getFourierTransform(0., 0., 10)
+            # zero-copy: the cached patch is a read-only view
+            u = gal.getUnitFluxModelPatch(tim)
+            self.assertFalse(u.patch.flags.writeable)
+            del u
+            pool = multiprocessing.get_context('fork').Pool(1)
+            mod2, stats = pool.apply(_shared_model_task, ((cache, tim, gal),))
+            pool.close()
+            pool.join()
+        finally:
+            set_galaxy_cache(None)
+            set_psf_fft_cache(None)
+        self.assertTrue(np.all(mod1 == mod2))
+        for k in ['modelpatch', 'unitpatch', 'fft']:
+            self.assertEqual(stats[k]['hits'], 1)
+            self.assertEqual(stats[k]['misses'], 0)
+        cache.close()
+
+
+class _CachedTractor(TractorCacheMixin, Tractor):
+    pass
+
+
+def _shared_cache_task(X):
+    cache, i = X
+    cache.put(('b', i), np.arange(i))
+    return cache.get(('a', 0)).patch.sum()
+
+
+def _shared_model_task(X):
+    # Renders what test_shared_cache put in the shared cache; returns
+    # the model image and this process's cache statistics.
+    from tractor.galaxy import set_galaxy_cache
+    cache, tim, gal = X
+    set_galaxy_cache(cache)
+    mod = _CachedTractor([tim], [gal], cache=cache).getModelImage(0)
+    gal.getUnitFluxModelPatch(tim)
+    tim.psf.getFourierTransform(0., 0., 10)
+    return mod, cache.getStats()
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,64 @@
+from __future__ import print_function
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+
+from wise import unwise
+from wise.unwise import read_unwise_pixels
+
+
+class UnwisePixelsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        unwise.disable_unwise_tile_cache()
+
+    def write_images(self):
+        # Plain and gzipped images of each pixel type
+        np.random.seed(42)
+        H, W = 37, 53
+        imgs = [np.random.randint(-1000, 1000, (H, W)).astype(np.int16),
+                np.random.randint(0, 65535, (H, W)).astype(np.uint16),
+                np.random.normal(size=(H, W)).astype(np.float32)]
+        fns = []
+        for i, img in enumerate(imgs):
+            fn = os.path.join(self.dir, 'img-%i.fits' % i)
+            fitsio.write(fn, img, clobber=True)
+            fns.append(fn)
+            with open(fn, 'rb') as f:
+                with gzip.open(fn + '.gz', 'wb') as g:
+                    g.write(f.read())
+            fns.append(fn + '.gz')
+        return fns
+
+    def test_read_pixels(self):
+        fns = self.write_images()
+        rois = [None, (slice(0, 37), slice(0, 53)),
+                (slice(5, 20), slice(10, 40)), (slice(30, 37), slice(0, 7))]
+        for cache in [True, False]:
+            if cache:
+                unwise.set_unwise_tile_cache_size()
+            else:
+                unwise.disable_unwise_tile_cache()
+            for fn in fns:
+                ref = fitsio.read(fn)
+                for roi in rois:
+                    pix = read_unwise_pixels(fn, roi)
+                    r = ref if roi is None else ref[roi]
+                    self.assertEqual(pix.dtype, r.dtype)
+                    self.assertTrue(np.all(pix == r))
+                    # a new, writable array
+                    pix[:] = 0
+                    self.assertTrue(np.all(read_unwise_pixels(fn, roi) == r))
+
+
+if __name__ == '__main__':
+    unittest.main()
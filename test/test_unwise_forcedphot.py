@@ -0,0 +1,207 @@
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import fitsio
+
+from tractor import *
+from tractor import interpret_roi
+
+from astrometry.util.fits import fits_table
+
+from wise import forcedphot
+from wise.unwise import unwise_tile_wcs
+
+
+class SerialMap(object):
+    # Stands in for an astrometry.util.multiproc object.
+    def imap(self, func, args):
+        return map(func, args)
+
+
+class UnwiseForcedPhotTest(unittest.TestCase):
+    '''
+    Runs unwise_forcedphot on small synthetic unWISE tiles (cut out
+    of the full tiles by the ROI), and compares with the serial
+    tile-by-tile merge it replaced.
+    '''
+
+    def setUp(self):
+        # Tiles (in this order): "a" and "c" overlap the ROI, and "c"'s
+        # center is closest to all of its sources, so "b" (which also
+        # overlaps it) gets skipped; "d" does not overlap the ROI.
+        self.tiles = fits_table()
+        self.tiles.coadd_id = np.array(['a', 'c', 'b', 'd'])
+        self.tiles.ra = np.array([0., 0.75, 1.5, 10.])
+        self.tiles.dec = np.array([0., 0.01, 0., 0.])
+        self.roiradecbox = [0.70, 0.80, -0.03, 0.03]
+
+        rng = np.random.RandomState(42)
+        N = 30
+        self.ra = rng.uniform(0.69, 0.81, N)
+        self.dec = rng.uniform(-0.031, 0.031, N)
+        self.flux = rng.uniform(50., 500., N)
+
+        self.read_tile = forcedphot.get_unwise_tractor_image
+        forcedphot.get_unwise_tractor_image = self.synthetic_tile
+
+    def tearDown(self):
+        forcedphot.get_unwise_tractor_image = self.read_tile
+
+    def catalog(self, flux=None):
+        if flux is None:
+            flux = np.ones(len(self.ra))
+        return [PointSource(RaDecPos(r, d), NanoMaggies(w=f))
+                for r, d, f in zip(self.ra, self.dec, flux)]
+
+    def synthetic_tile(self, basedir, tile, band, bandname=None,
+                       roiradecbox=None):
+        # (as get_unwise_tractor_image)
+        k = list(self.tiles.coadd_id).index(tile)
+        wcs = unwise_tile_wcs(self.tiles.ra[k], self.tiles.dec[k])
+        H, W = int(wcs.get_height()), int(wcs.get_width())
+        roi = interpret_roi(ConstantFitsWcs(wcs), (H, W),
+                            roiradecbox=roiradecbox)
+        if roi is None:
+            return None
+        roi, nil = roi
+        (x0, x1, y0, y1) = roi
+        wcs = wcs.get_subimage(x0, y0, x1 - x0, y1 - y0)
+        sh = (y1 - y0, x1 - x0)
+        sig1 = 1.
+        tim = Image(data=np.zeros(sh, np.float32),
+                    invvar=np.ones(sh, np.float32) / sig1**2,
+                    psf=NCircularGaussianPSF([1.5], [1.]),
+                    sky=ConstantSky(0.),
+                    wcs=ConstantFitsWcs(wcs),
+                    photocal=LinearPhotoCal(1., band=bandname),
+                    name='unWISE %s W%i' % (tile, band))
+        tr = Tractor([tim], self.catalog(self.flux))
+        rng = np.random.RandomState(10 * k + band)
+        tim.data = (tr.getModelImage(0) +
+                    sig1 * rng.normal(size=sh)).astype(np.float32)
+        tim.sig1 = sig1
+        tim.roi = roi
+        tim.nims = np.ones(sh, np.int16)
+        tim.nuims = np.ones(sh, np.int16)
+        return tim
+
+    def serial_merge(self, cat, band):
+        # The per-band loop over tiles of the original unwise_forcedphot
+        # (without Ceres): returns the tile, flux and flux ivar of each
+        # source, and the tiles that were fit.
+        for src in cat:
+            src.fixedRadius = 20
+        Nsrcs = len(cat)
+        tile = np.array(['        '] * Nsrcs)
+        tiledists = np.empty(Nsrcs)
+        tiledists[:] = 1e100
+        flux_invvars = np.zeros(Nsrcs, np.float32)
+        fit = []
+        ra = np.array([src.getPosition().ra for src in cat])
+        dec = np.array([src.getPosition().dec for src in cat])
+        for t in self.tiles:
+            tim = self.synthetic_tile('.', t.coadd_id, band, bandname='w',
+                                      roiradecbox=self.roiradecbox)
+            if tim is None:
+                continue
+            H, W = tim.shape
+            ok, x, y = tim.wcs.wcs.radec2pixelxy(ra, dec)
+            x = (x - 1.).astype(np.float32)
+            y = (y - 1.).astype(np.float32)
+            margin = 10.
+            I = np.flatnonzero((x >= -margin) * (x < W + margin) *
+                               (y >= -margin) * (y < H + margin))
+            inbox = ((x[I] >= -0.5) * (x[I] < (W - 0.5)) *
+                     (y[I] >= -0.5) * (y[I] < (H - 0.5)))
+            tilewcs = unwise_tile_wcs(t.ra, t.dec)
+            cx, cy = tilewcs.crpix
+            ok, tx, ty = tilewcs.radec2pixelxy(ra[I], dec[I])
+            td = np.maximum(np.abs(tx - cx), np.abs(ty - cy))
+            closest = (td < tiledists[I])
+            tiledists[I[closest]] = td[closest]
+            keep = inbox * closest
+            srci = I[keep]
+            if not len(srci):
+                continue
+            tile[srci] = t.coadd_id
+            subcat = [cat[i] for i in srci]
+            subcat.extend([cat[i].copy() for i in I[np.logical_not(keep)]])
+            tractor = Tractor([tim], subcat)
+            tractor.freezeParamsRecursive('*')
+            tractor.thawPathsTo('w')
+            R = tractor.optimize_forced_photometry(
+                minsb=0., mindlnp=1., sky=False, fitstats=True,
+                variance=True, shared_params=False,
+                fitstat_extras=[('pronexp', [tim.nims])])
+            flux_invvars[srci] = R.IV[:len(srci)]
+            fit.append(t.coadd_id)
+        nm = np.array([src.getBrightness().getBand('w') for src in cat])
+        nm[flux_invvars == 0] = 0.
+        return tile, nm, flux_invvars, fit
+
+    def test_merge(self):
+        bands = [1, 2]
+        kwargs = dict(bands=bands, roiradecbox=self.roiradecbox,
+                      use_ceres=False, get_models=True)
+        runs = [dict(), dict(mp=SerialMap(), mp_chunk=1),
+                dict(mp=SerialMap(), mp_chunk=64)]
+        phots = []
+        for run in runs:
+            cat = self.catalog()
+            phot, models = forcedphot.unwise_forcedphot(cat, self.tiles,
+                                                        **dict(kwargs, **run))
+            phots.append(phot)
+            for band in bands:
+                tile, nm, iv, fit = self.serial_merge(self.catalog(), band)
+                self.assertEqual(fit, ['a', 'c'])
+                wb = 'w%i' % band
+                self.assertEqual(list(phot.tile), list(tile))
+                self.assertTrue(np.allclose(phot.get(wb + '_nanomaggies'),
+                                            nm, rtol=1e-3, atol=1e-3))
+                self.assertTrue(np.allclose(phot.get(wb + '_nanomaggies_ivar'),
+                                            iv, rtol=1e-5))
+                self.assertTrue(wb + '_nexp' in phot.get_columns())
+                self.assertTrue(wb + '_prochi2' in phot.get_columns())
+                # Only the tiles the serial loop fits are fit (when
+                # each unit sees all the earlier ones' results).
+                if run.get('mp_chunk', 1) == 1:
+                    self.assertEqual(sorted(c for c, b in models if b == band),
+                                     sorted(fit))
+            # The fitted fluxes are also saved in the catalog (the last
+            # band's).
+            ok = (phot.w2_nanomaggies_ivar > 0)
+            self.assertTrue(np.allclose(
+                np.array([src.getBrightness().getBand('w') for src in cat])[ok],
+                phot.w2_nanomaggies[ok], rtol=1e-3, atol=1e-3))
+
+        # Streaming the rows to a file, as they are finished: the file
+        # has the same rows and columns as the returned table.
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmpdir, 'phot.fits')
+            r = forcedphot.unwise_forcedphot(
+                self.catalog(), self.tiles, bands=bands,
+                roiradecbox=self.roiradecbox, use_ceres=False, outfn=fn,
+                return_phot=False)
+            self.assertIsNone(r)
+            F = fitsio.read(fn)
+        finally:
+            shutil.rmtree(tmpdir)
+        phot = phots[0]
+        self.assertEqual(len(F), len(self.ra))
+        self.assertEqual(list(F.dtype.names), phot.get_columns())
+        self.assertFalse('w1_mjd' in F.dtype.names)
+        for c in phot.get_columns():
+            if c == 'tile':
+                self.assertEqual([t.strip() for t in F[c].astype(str)],
+                                 [t.strip() for t in phot.tile])
+            else:
+                self.assertTrue(np.array_equal(F[c], phot.get(c),
+                                               equal_nan=True))
+
+if __name__ == '__main__':
+    unittest.main()
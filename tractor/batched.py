@@ -0,0 +1,196 @@
+'''
+`batched.py`
+============
+
+Batched rendering of many sources into a model image.
+
+Rather than asking each source for a model Patch and adding the
+patches one by one, here we collect the pixel-space (PSF-convolved)
+mixture-of-Gaussians for each source, group the sources by type, and
+evaluate all the mixture components of a group in one call to the C
+code (mix.c_gauss_2d_batch), which accumulates straight into the model
+image.
+
+Only the cases where the per-source code would also evaluate a
+mixture of Gaussians exactly are handled here: PointSources with a
+GaussianMixturePSF, and Exp, Dev and FixedComposite galaxies with any
+PSF that can be represented as a mixture of Gaussians (but not hybrid
+or pixelized PSFs).  Everything else (and sources with binary
+ModelMask maps) is handed back to the caller to render the usual way.
+
+The per-source code path (Tractor.getModelPatch) remains the
+reference; the pixels rendered here use the same extents, and agree
+with it to within float32 precision when the image's modelMinval (or
+*minsb*) is zero.  When *minsb* is non-zero, galaxies are rendered
+over the same (minsb-dependent) extents, but exactly rather than
+approximately, so the two differ by at most *minsb* per pixel;
+PointSources with non-zero *minsb* are handed back to the caller.
+'''
+from __future__ import print_function
+import numpy as np
+
+
+def render_sources_batched(tractor, img, srcs, mod, minsb=None):
+    '''
+    Adds the models for *srcs* in image *img* to the numpy array *mod*.
+
+    *minsb*: minimum surface brightness, as in Tractor.getModelPatch;
+     defaults to the image's modelMinval.
+
+    Returns the list of sources that were *not* rendered (because
+    they are of a type, or have a PSF or ModelMask, that this code
+    does not handle); the caller must render those itself.
+    '''
+    from tractor.pointsource import PointSource
+    from tractor.galaxy import ExpGalaxy, DevGalaxy, FixedCompositeGalaxy
+
+    handlers = {
+        PointSource: _pointsource_mixture,
+        ExpGalaxy: _galaxy_mixture,
+        DevGalaxy: _galaxy_mixture,
+        FixedCompositeGalaxy: _galaxy_mixture,
+    }
+
+    if minsb is None:
+        minsb = img.modelMinval
+    groups = {}
+    leftover = []
+    for src in srcs:
+        if src is None:
+            continue
+        handler = handlers.get(type(src), None)
+        if handler is None:
+            leftover.append(src)
+            continue
+        mask = tractor._getModelMaskFor(img, src)
+        # HACK -- assume no mask -> no overlap (as in getModelPatch)
+        if tractor.expectModelMasks and mask is None:
+            continue
+        if mask is not None and mask.mask is not None:
+            leftover.append(src)
+            continue
+        counts = img.getPhotoCal().brightnessToCounts(src.getBrightness())
+        if counts == 0 or not np.isfinite(np.float32(counts)):
+            continue
+        r = handler(src, img, mask, minsb / counts)
+        if r is False:
+            leftover.append(src)
+            continue
+        if r is None:
+            # no overlap
+            continue
+        extent, mix = r
+        groups.setdefault(type(src), []).append((extent, mix, counts))
+
+    for clazz, group in groups.items():
+        render_mixtures(mod, [e for e, m, c in group],
+                        [m for e, m, c in group],
+                        [c for e, m, c in group])
+    return leftover
+
+
+def _pointsource_mixture(src, img, modelMask, minval):
+    '''
+    Returns ((x0,x1,y0,y1), MixtureOfGaussians) for a PointSource, None
+    if it does not overlap the image, or False if it can't be
+    rendered by this code.
+
+    Mirrors PointSource.getUnitFluxModelPatch and
+    GaussianMixturePSF.getPointSourcePatch.
+    '''
+    from tractor.psf import GaussianMixturePSF
+    psf = src._getPsf(img)
+    if not isinstance(psf, GaussianMixturePSF):
+        return False
+    if modelMask is None and (minval > 0 or src.minRadius is not None):
+        # approximate rendering with a minval-dependent extent
+        return False
+    (px, py) = img.getWcs().positionToPixel(src.getPosition(), src)
+    H, W = img.shape
+    r = src.fixedRadius
+    if r is None:
+        r = psf.getRadius()
+    if px + r < 0 or px - r > W or py + r < 0 or py - r > H:
+        return None
+
+    if modelMask is not None:
+        extent = modelMask.extent
+    else:
+        x0 = max(int(np.floor(px - r)), 0)
+        x1 = min(int(np.ceil(px + r)) + 1, W)
+        y0 = max(int(np.floor(py - r)), 0)
+        y1 = min(int(np.ceil(py + r)) + 1, H)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        extent = (x0, x1, y0, y1)
+    mog = psf.getMixtureOfGaussians(px=px, py=py)
+    mix = mog.copy()
+    mix.mean = mog.mean + np.array([px, py])[np.newaxis, :]
+    return extent, mix
+
+
+def _galaxy_mixture(src, img, modelMask, minval):
+    '''
+    Returns ((x0,x1,y0,y1), MixtureOfGaussians) for a ProfileGalaxy,
+    None if it does not overlap the image, or False if it can't be
+    rendered by this code.
+
+    Mirrors the mixture-of-Gaussians branch of
+    ProfileGalaxy._realGetUnitFluxModelPatch.
+    '''
+    from tractor.psf import HybridPSF
+    psf = img.getPsf()
+    if isinstance(psf, HybridPSF) or not hasattr(psf, 'getMixtureOfGaussians'):
+        return False
+    (px, py) = img.getWcs().positionToPixel(src.getPosition(), src)
+    if modelMask is not None:
+        extent = modelMask.extent
+    else:
+        extent = src._getUnitFluxPatchExtent(img, px, py, minval)
+        if extent is None:
+            return None
+        extent = extent[:4]
+    amix = src._getAffineProfile(img, px, py)
+    psfmix = psf.getMixtureOfGaussians(px=px, py=py)
+    return extent, amix.convolve(psfmix)
+
+
+def render_mixtures(mod, extents, mixtures, scales):
+    '''
+    Evaluates a list of mixtures of Gaussians, each over its own
+    rectangular extent, and adds them into the image *mod*.
+
+    *extents*: list of (x0, x1, y0, y1) integer pixel ranges, non-inclusive
+     upper bounds.  These are clipped to the image bounds.
+    *mixtures*: list of MixtureOfGaussians in the pixel space of *mod*
+    *scales*: list of floats, the amplitude scaling for each mixture.
+
+    The mixtures are padded with zero-amplitude components to the same
+    size, and evaluated in a single call to the C code; components are
+    truncated at 10 sigma, as when rendering single patches.
+    '''
+    from tractor.mix import c_gauss_2d_batch
+
+    H, W = mod.shape
+    ext = np.array(extents, dtype=np.int32).reshape((-1, 4))
+    ext[:, :2] = np.clip(ext[:, :2], 0, W)
+    ext[:, 2:] = np.clip(ext[:, 2:], 0, H)
+    keep = np.flatnonzero((ext[:, 1] > ext[:, 0]) * (ext[:, 3] > ext[:, 2]))
+    if len(keep) == 0:
+        return
+
+    N = len(keep)
+    K = max(mixtures[i].K for i in keep)
+    amp = np.zeros((N, K))
+    mean = np.zeros((N, K, 2))
+    var = np.zeros((N, K, 2, 2))
+    var[:, :, 0, 0] = var[:, :, 1, 1] = 1.
+    for j, i in enumerate(keep):
+        m = mixtures[i]
+        amp[j, :m.K] = m.amp * scales[i]
+        mean[j, :m.K, :] = m.mean
+        var[j, :m.K, :, :] = m.var
+
+    rtn = c_gauss_2d_batch(np.ascontiguousarray(ext[keep]),
+                           amp, mean, var, mod)
+    assert(rtn == 0)
@@ -8,7 +8,7 @@ class TractorCacheMixin(object):
         cache = kwargs.pop('cache', None)
         super(TractorCacheMixin, self).__init__(*args, **kwargs)
         if cache is None:
-            cache = Cache()
+            cache = Cache(maxsize=None, maxbytes=256 * 1024 * 1024)
         self.cache = cache
 
     def disable_cache(self):
@@ -22,8 +22,9 @@ class TractorCacheMixin(object):
             return super(TractorCacheMixin, self).getModelPatch(
                 img, src, **kwargs)
 
-        deps = (img.hashkey(), src.hashkey())
-        deps = hash(deps)
+        # img.cachekey() rather than img.hashkey(), so that the keys
+        # are the same in every process sharing the cache.
+        deps = ('modelpatch', img.cachekey(), src.hashkey())
         mv, mod = self.cache.get(deps, (0., None))
         if minsb is None:
             minsb = img.modelMinval
@@ -44,12 +45,15 @@ class TractorCacheMixin(object):
         return mod
 
 
+import threading
 try:
     # python 2.7
     from collections import OrderedDict
 except:
     from ordereddict import OrderedDict
 
+import numpy as np
+
 '''
 LRU cache.
 This code is based on: http://code.activestate.com/recipes/498245-lru-and-lfu-cache-decorators/
@@ -58,69 +62,140 @@ License: Python Software Foundation (PSF) license.
 '''
 
 
+def nbytes(val, depth=0):
+    '''
+    Estimates the memory used by *val*: numpy arrays (including those
+    in Patch objects, tuples, lists, dicts and, one level deep, object
+    attributes) are counted; everything else is counted as zero.
+    '''
+    if val is None:
+        return 0
+    if isinstance(val, np.ndarray):
+        return val.nbytes
+    if depth > 3:
+        return 0
+    if isinstance(val, (tuple, list)):
+        return sum([nbytes(v, depth + 1) for v in val])
+    if isinstance(val, dict):
+        return sum([nbytes(v, depth + 1) for v in val.values()])
+    if depth < 2 and hasattr(val, '__dict__'):
+        return sum([nbytes(v, depth + 1) for v in val.__dict__.values()])
+    return 0
+
+
+def key_class(key):
+    '''
+    The class of a cache key, for statistics: the first element of a
+    tuple key if it is a string (eg, ('fft', 64)), otherwise the
+    key's type name.
+    '''
+    if isinstance(key, tuple) and len(key) and isinstance(key[0], str):
+        return key[0]
+    return type(key).__name__
+
+
 class Cache(object):
+    '''
+    A least-recently-used cache, bounded by number of entries
+    (*maxsize*) and/or total size in bytes (*maxbytes*); either can be
+    None for no limit.
+
+    Keys must be hashable and are compared for equality, so (unlike
+    hash values) they can't collide; tuples of hashkey()s are
+    typical.  Entry sizes are computed once, when they are added, by
+    *sizefunc* (default: nbytes), so the total size is known at all
+    times.  Hits, misses and evictions are counted per key class (see
+    key_class).
+
+    The cache is safe to use from multiple threads.  Its contents are
+    not pickled.
+    '''
     class Entry(object):
         pass
 
-    def __init__(self, maxsize=1000, sizeattr='size'):
-        self.clear()
+    def __init__(self, maxsize=1000, maxbytes=None, sizefunc=nbytes):
         self.maxsize = maxsize
-        self.sizeattr = sizeattr
+        self.maxbytes = maxbytes
+        self.sizefunc = sizefunc
+        self.lock = threading.Lock()
+        self.clear()
 
     def __del__(self):
         # OrderedDict objects seem to be prone to leaving garbage around...
         self.clear()
         del self.dict
 
+    def __getstate__(self):
+        return dict(maxsize=self.maxsize, maxbytes=self.maxbytes,
+                    sizefunc=self.sizefunc)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
     def clear(self):
-        if not hasattr(self, 'dict'):
-            self.dict = OrderedDict()
-        else:
-            self.dict.clear()
-            # print 'Clearing Cache object.'
-            # objs = [(k,v) for k,v in self.dict.items()]
-            # self.dict.clear()
-            # while len(objs):
-            #   k,v = objs.pop()
-            #   print 'refcnt key', refcnt(k), 'val', refcnt(v),
-            #   print 'real', refcnt(v.val),
-            #   vv = v.val
-            #   v.val = None
-            #   print 'real', refcnt(vv)
-        self.hits = 0
-        self.misses = 0
+        with self.lock:
+            if not hasattr(self, 'dict'):
+                self.dict = OrderedDict()
+            else:
+                self.dict.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            # key class -> [hits, misses, evictions]
+            self.stats = {}
+
+    def _count(self, key, i):
+        st = self.stats.get(key_class(key), None)
+        if st is None:
+            st = self.stats[key_class(key)] = [0, 0, 0]
+        st[i] += 1
 
     def __setitem__(self, key, val):
-        sz = 0
-        if hasattr(val, self.sizeattr):
-            try:
-                sz = int(getattr(val, self.sizeattr))
-            except:
-                pass
         e = Cache.Entry()
         e.val = val
-        e.size = sz
+        e.size = self.sizefunc(val)
         e.hits = 0
-        # purge LRU item
-        if len(self.dict) >= self.maxsize:
-            self.dict.popitem(0)
-        self.dict[key] = e
+        with self.lock:
+            old = self.dict.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.size
+            if self.maxbytes is not None and e.size > self.maxbytes:
+                # too big to cache at all
+                self._count(key, 2)
+                self.evictions += 1
+                return
+            self.dict[key] = e
+            self.nbytes += e.size
+            # purge LRU items
+            while ((self.maxsize is not None and
+                    len(self.dict) > self.maxsize) or
+                   (self.maxbytes is not None and
+                    self.nbytes > self.maxbytes)):
+                k, old = self.dict.popitem(last=False)
+                self.nbytes -= old.size
+                self._count(k, 2)
+                self.evictions += 1
 
     def __getitem__(self, key):
-        # pop
-        try:
-            e = self.dict.pop(key)
-        except KeyError:
-            self.misses += 1
-            raise
-        self.hits += 1
-        # reinsert (to record recent use)
-        self.dict[key] = e
-        if e is None:
-            return e
+        with self.lock:
+            # pop
+            try:
+                e = self.dict.pop(key)
+            except KeyError:
+                self.misses += 1
+                self._count(key, 1)
+                raise
+            self.hits += 1
+            self._count(key, 0)
+            # reinsert (to record recent use)
+            self.dict[key] = e
         e.hits += 1
         return e.val
 
+    def __contains__(self, key):
+        return key in self.dict
+
     def __len__(self):
         return len(self.dict)
 
@@ -135,70 +210,58 @@ class Cache(object):
         key, default = args
         try:
             return self.__getitem__(key)
-        except:
+        except KeyError:
             return default
 
+    def getStats(self):
+        '''
+        Returns a dict from key class to a dict of hits, misses and
+        evictions.
+        '''
+        with self.lock:
+            return dict([(k, dict(hits=h, misses=m, evictions=e))
+                         for k, (h, m, e) in self.stats.items()])
+
     def about(self):
         print('Cache has', len(self), 'items:')
-        for k, v in self.dict.items():
-            if v is None:
-                continue
+        for k, v in list(self.dict.items()):
             print('  size', v.size, 'hits', v.hits)
 
     def __str__(self):
-        s = 'Cache: %i items, total of %i hits, %i misses' % (
-            len(self), self.hits, self.misses)
+        s = 'Cache: %i items, total of %i hits, %i misses, %i evictions' % (
+            len(self), self.hits, self.misses, self.evictions)
         nnone = 0
         hits = 0
-        size = 0
-        for k, v in self.dict.items():
-            if v is None:
-                nnone += 1
-                continue
+        for k, v in list(self.dict.items()):
             if v.val is None:
                 nnone += 1
                 continue
             hits += v.hits
-            size += v.size
         s += ', %i entries are None' % nnone
-        s += '; current cache entries: %i hits, %i pixels' % (hits, size)
+        s += '; current cache entries: %i hits, %i bytes' % (hits,
+                                                              self.nbytes)
         return s
 
     def printItems(self):
-        for k, v in self.dict.items():
-            val = None
-            hits = None
-            size = None
-            if v is not None:
-                if v.val is not None:
-                    val = v.val
-                    hits = v.hits
-                    size = v.size
-            print('  ', hits, size, k)
+        for k, v in list(self.dict.items()):
+            print('  ', v.hits, v.size, k)
 
     def totalSize(self):
-        sz = 0
-        for k, v in self.dict.items():
-            if v is None:
-                continue
-            sz += v.size
-        return sz
+        '''
+        Returns the total size (in bytes) of the cache entries.
+        '''
+        return self.nbytes
 
     def printStats(self):
         print('Cache has', len(self), 'items')
-        print('Total of', self.hits, 'cache hits and', self.misses, 'misses')
-        nnone = 0
-        hits = 0
-        size = 0
-        for k, v in self.dict.items():
-            if v is None:
-                nnone += 1
-                continue
-            hits += v.hits
-            size += v.size
-        print('  ', nnone, 'entries are None')
-        print('Total number of hits of cache entries:', hits)
-        print(' Total size (pixels) of cache entries:', size)
+        print('Total of', self.hits, 'cache hits,', self.misses, 'misses and',
+              self.evictions, 'evictions')
+        for k, st in sorted(self.getStats().items()):
+            print('  %s: %i hits, %i misses, %i evictions' %
+                  (k, st['hits'], st['misses'], st['evictions']))
+        print('Total number of hits of cache entries:',
+              sum([v.hits for v in list(self.dict.values())]))
+        print(' Total size (bytes) of cache entries:', self.nbytes)
 
 
 class NullCache(object):
@@ -222,5 +285,46 @@ class NullCache(object):
     def totalSize(self):
         return 0
 
+    def __contains__(self, key):
+        return False
+
     def __len__(self):
-        return len(self.dict)
+        return 0
+
+
+class PrefixCache(object):
+    '''
+    One object's entries in a cache that many objects share (eg, a
+    tractor.mpcache.SharedCache given to the workers of a pool): keys
+    are prefixed with *prefix()*, typically the object's hashkey
+    method, which is called on every get and put, so that changing
+    the object changes its keys.
+
+    clear() does nothing, since the other objects' entries must stay;
+    stale entries age out of the shared cache.
+    '''
+    def __init__(self, cache, prefix):
+        self.cache = cache
+        self.prefix = prefix
+
+    def _key(self, key):
+        # keep the key class first, for the statistics
+        return (key_class(key), self.prefix(), key)
+
+    def get(self, *args):
+        return self.cache.get(self._key(args[0]), *args[1:])
+
+    def put(self, k, v):
+        self.cache.put(self._key(k), v)
+
+    def __getitem__(self, key):
+        return self.cache[self._key(key)]
+
+    def __setitem__(self, key, val):
+        self.cache[self._key(key)] = val
+
+    def __contains__(self, key):
+        return self._key(key) in self.cache
+
+    def clear(self):
+        pass
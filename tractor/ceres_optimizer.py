@@ -5,6 +5,7 @@ from astrometry.util.ttime import Time
 
 from tractor.engine import logverb
 from tractor.optimize import Optimizer
+from tractor.profiler import profile_phase
 
 
 class CeresOptimizer(Optimizer):
@@ -126,11 +127,12 @@ class CeresOptimizer(Optimizer):
                           if b is not None])
             #print('lubounds:', lubounds)
 
-        R = ceres_opt(trwrapper, tractor.getNImages(), params, variance_out,
-                      (1 if scale_columns else 0),
-                      (1 if numeric else 0), numeric_stepsize,
-                      dlnp, max_iterations, gpriors, lubounds,
-                      print_progress)
+        with profile_phase(tractor, 'solve'):
+            R = ceres_opt(trwrapper, tractor.getNImages(), params,
+                          variance_out, (1 if scale_columns else 0),
+                          (1 if numeric else 0), numeric_stepsize,
+                          dlnp, max_iterations, gpriors, lubounds,
+                          print_progress)
         if variance:
             R['variance'] = variance_out
 
@@ -361,14 +363,16 @@ class CeresOptimizer(Optimizer):
 
         if nonneg:
             # Initial run with nonneg=False, to get in the ballpark
-            x = ceres_forced_phot(blocks, fluxes, 0, iverbose, ithreads)
+            with profile_phase(tractor, 'solve'):
+                x = ceres_forced_phot(blocks, fluxes, 0, iverbose, ithreads)
             assert(x == 0)
             logverb('forced phot: ceres initial run', Time() - t0)
             t0 = Time()
             if negfluxval is not None:
                 fluxes = np.maximum(fluxes, negfluxval)
 
-        x = ceres_forced_phot(blocks, fluxes, nonneg, iverbose, ithreads)
+        with profile_phase(tractor, 'solve'):
+            x = ceres_forced_phot(blocks, fluxes, nonneg, iverbose, ithreads)
         #print('Ceres forced phot:', x)
         logverb('forced phot: ceres', Time() - t0)
 
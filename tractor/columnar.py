@@ -0,0 +1,424 @@
+'''
+`columnar.py`
+=============
+
+A Catalog stored as columns of NumPy arrays, for large source lists.
+
+A regular Catalog holds a full Python object for every source and
+every one of its parameters (position, brightness, shape), each with
+its own named-parameter dicts and frozen/thawed list; a million-source
+catalog costs gigabytes and seconds just to build.  A ColumnarCatalog
+instead keeps the positions (RaDecPos), per-band fluxes (NanoMaggies),
+shapes (EllipseE), source types and frozen/thawed state in arrays,
+and reads and writes them directly to and from FITS tables.
+
+Sources are exposed as *views*: PointSource, ExpGalaxy and DevGalaxy
+objects (and their RaDecPos, NanoMaggies and EllipseE parameters)
+whose parameter values and frozen/thawed state are rows of the
+catalog's arrays, so that changing a view changes the catalog and
+vice versa.  Views are created on demand and shared with the other
+views of the same type (named parameters, bounds, priors), and are
+only kept while something else refers to them.  Copies of views
+(*copy()*, *copy.deepcopy*, or pickling) are independent sources.
+
+The bulk operations -- getParams, setParams, numberOfParams,
+freezing and thawing by name -- work on the arrays directly.
+'''
+from __future__ import print_function
+import weakref
+
+import numpy as np
+
+from tractor.engine import Catalog
+from tractor.utils import getClassName, _param_structure_changed
+from tractor.pointsource import PointSource
+from tractor.galaxy import ExpGalaxy, DevGalaxy
+from tractor.wcs import RaDecPos
+from tractor.brightness import NanoMaggies
+from tractor.ellipses import EllipseE
+
+
+# Attributes of a template that are caches of its own state, and so
+# are not shared with its views.
+_view_private = ['_paramlayout']
+
+
+def _param_view(template, vals, liquid):
+    # A copy of the Params object *template* sharing its attributes
+    # (named parameters, bounds, priors), with parameter values *vals*
+    # and frozen/thawed state *liquid* (rows of the catalog arrays).
+    v = object.__new__(type(template))
+    d = v.__dict__
+    d.update(template.__dict__)
+    for k in _view_private:
+        d.pop(k, None)
+    if vals is not None:
+        d['vals'] = vals
+    d['liquid'] = liquid
+    ss = d.get('stepsizes', None)
+    if ss is not None:
+        d['stepsizes'] = list(ss)
+    return v
+
+
+class _SourceViews(object):
+    # The list-like "subs" of a ColumnarCatalog.
+    def __init__(self, cat):
+        self.cat = cat
+
+    def __len__(self):
+        return len(self.cat)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.cat.getSource(j)
+                    for j in range(*i.indices(len(self.cat)))]
+        return self.cat.getSource(i)
+
+    def __iter__(self):
+        for i in range(len(self.cat)):
+            yield self.cat.getSource(i)
+
+    def index(self, src):
+        for i, v in self.cat._views.items():
+            if v is src:
+                return i
+        raise ValueError('source is not a view of this catalog')
+
+
+class ColumnarCatalog(Catalog):
+    '''
+    A Catalog of PointSource, ExpGalaxy and DevGalaxy sources with
+    RaDecPos positions, NanoMaggies brightnesses and EllipseE shapes,
+    stored as arrays.
+
+    The parameter values are the columns of *values*: ra, dec, the
+    fluxes in *bands*, and (for galaxies) the shape re, e1, e2.  Their
+    frozen/thawed state is kept at three levels: each source in the
+    catalog (*liquid*), each source's position, brightness and shape
+    (*srcliquid*), and each parameter (*paramliquid*).
+
+    Sources cannot be added or removed.
+    '''
+    # Source type names (as in FITS tables) -> classes
+    source_types = [('PSF', PointSource), ('EXP', ExpGalaxy),
+                    ('DEV', DevGalaxy)]
+
+    def __init__(self, ra, dec, flux, bands, types=None, shape=None):
+        '''
+        ColumnarCatalog(ra, dec, flux, bands, types=None, shape=None)
+
+        *ra*, *dec*: length-N arrays, in degrees
+        *flux*: (N, len(bands)) array of fluxes, in nanomaggies
+        *bands*: list of band names
+        *types*: length-N array of source types (see *source_types*);
+            default all 'PSF'
+        *shape*: (N, 3) array of galaxy shapes (re, e1, e2); required
+            if there are any galaxies
+        '''
+        ra = np.atleast_1d(ra)
+        N = len(ra)
+        self.bands = list(bands)
+        B = len(self.bands)
+        flux = np.asarray(flux, np.float64).reshape((N, B))
+        typenames = [t for t, cls in self.source_types]
+        if types is None:
+            self.typecodes = np.zeros(N, np.int16)
+        else:
+            types = np.char.strip(np.asarray(types).astype(str))
+            self.typecodes = np.array([typenames.index(t) for t in types],
+                                      np.int16).reshape(N)
+        self.hasshape = np.array([cls is not PointSource for t, cls
+                                  in self.source_types])[self.typecodes]
+        if shape is None:
+            if np.any(self.hasshape):
+                raise ValueError('ColumnarCatalog: galaxies need shapes')
+            shape = np.zeros((N, 3))
+            shape[:, 0] = 1.
+
+        # Columns of "values", and which of pos, brightness, shape
+        # they belong to.
+        self.poscols = slice(0, 2)
+        self.fluxcols = slice(2, 2 + B)
+        self.shapecols = slice(2 + B, 5 + B)
+        self.colnames = ['ra', 'dec'] + self.bands + ['re', 'e1', 'e2']
+        self.colcomponent = np.array([0, 0] + [1] * B + [2, 2, 2])
+        self.components = ['pos', 'brightness', 'shape']
+
+        self.values = np.zeros((N, 5 + B))
+        self.values[:, 0] = ra
+        self.values[:, 1] = dec
+        self.values[:, self.fluxcols] = flux
+        self.values[:, self.shapecols] = shape
+        self.liquid = np.ones(N, bool)
+        self.srcliquid = np.ones((N, 3), bool)
+        self.paramliquid = np.ones((N, 5 + B), bool)
+
+        self._makeTemplates()
+        self._views = weakref.WeakValueDictionary()
+
+    def _makeTemplates(self):
+        pos = RaDecPos(0., 0.)
+        br = NanoMaggies(order=self.bands, **dict([(b, 0.)
+                                                   for b in self.bands]))
+        shape = EllipseE(1., 0., 0.)
+        self._templates = []
+        for t, cls in self.source_types:
+            if cls is PointSource:
+                src = cls(pos, br)
+            else:
+                src = cls(pos, br, shape)
+            # Freezing or thawing a view changes the catalog's number
+            # of parameters.
+            src._inlayout = True
+            self._templates.append(src)
+        for p in [pos, br, shape]:
+            p._inlayout = True
+        self._paramtemplates = [pos, br, shape]
+
+        # Per-column parameter bounds
+        def bounds(name):
+            return np.array(sum([list(getattr(p, name)) for p in
+                                 self._paramtemplates], []), dtype=object)
+        self._lowers = bounds('lowers')
+        self._uppers = bounds('uppers')
+        self._maxstep = bounds('maxstep')
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d.pop('_views', None)
+        d.pop('_templates', None)
+        d.pop('_paramtemplates', None)
+        d.pop('_paramlayout', None)
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._makeTemplates()
+        self._views = weakref.WeakValueDictionary()
+
+    @property
+    def subs(self):
+        return _SourceViews(self)
+
+    def getSource(self, i):
+        '''
+        Returns the view of source *i*.
+        '''
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        src = self._views.get(i, None)
+        if src is not None:
+            return src
+        if i < 0 or i >= len(self):
+            raise IndexError('ColumnarCatalog index out of range')
+        template = self._templates[self.typecodes[i]]
+        vals = self.values[i]
+        liq = self.paramliquid[i]
+        pos = _param_view(self._paramtemplates[0], vals[self.poscols],
+                          liq[self.poscols])
+        dec = vals[1]
+        pos.stepsizes = [1e-4 / np.cos(np.deg2rad(dec)), 1e-4]
+        subs = [pos, _param_view(self._paramtemplates[1],
+                                 vals[self.fluxcols], liq[self.fluxcols])]
+        if self.hasshape[i]:
+            subs.append(_param_view(self._paramtemplates[2],
+                                    vals[self.shapecols],
+                                    liq[self.shapecols]))
+        src = _param_view(template, None, self.srcliquid[i, :len(subs)])
+        src.subs = subs
+        self._views[i] = src
+        return src
+
+    def getTypes(self):
+        '''
+        Returns the array of source type names.
+        '''
+        return np.array([t for t, cls in self.source_types])[self.typecodes]
+
+    # Bulk I/O
+
+    def to_fits_table(self):
+        '''
+        Returns a fits_table with columns type, ra, dec, flux_<band>,
+        and shape_r, shape_e1, shape_e2.
+        '''
+        from astrometry.util.fits import fits_table
+        T = fits_table()
+        T.type = self.getTypes()
+        T.ra = self.values[:, 0].copy()
+        T.dec = self.values[:, 1].copy()
+        for j, b in enumerate(self.bands):
+            T.set('flux_%s' % b, self.values[:, 2 + j].astype(np.float32))
+        shape = self.values[:, self.shapecols]
+        T.shape_r = shape[:, 0].astype(np.float32)
+        T.shape_e1 = shape[:, 1].astype(np.float32)
+        T.shape_e2 = shape[:, 2].astype(np.float32)
+        return T
+
+    def write_fits(self, filename, hdr=None):
+        T = self.to_fits_table()
+        T.writeto(filename, header=hdr)
+
+    @classmethod
+    def from_fits_table(cls, T, bands):
+        '''
+        Creates a ColumnarCatalog from a fits_table with the columns
+        written by *to_fits_table*; the *type* and *shape_* columns are
+        optional.
+        '''
+        cols = T.get_columns()
+        flux = np.vstack([T.get('flux_%s' % b) for b in bands]).T
+        types = T.type if 'type' in cols else None
+        shape = None
+        if 'shape_r' in cols:
+            shape = np.vstack([T.shape_r, T.shape_e1, T.shape_e2]).T
+        return cls(T.ra, T.dec, flux, bands, types=types, shape=shape)
+
+    @classmethod
+    def from_fits(cls, filename, bands, ext=1):
+        from astrometry.util.fits import fits_table
+        T = fits_table(filename, ext=ext)
+        return cls.from_fits_table(T, bands)
+
+    # Params
+
+    def _thawedMask(self):
+        # (N, ncols) mask of the thawed parameters
+        m = self.srcliquid[:, self.colcomponent] & self.paramliquid
+        m[:, self.shapecols] &= self.hasshape[:, np.newaxis]
+        m &= self.liquid[:, np.newaxis]
+        return m
+
+    def _allMask(self):
+        m = np.ones(self.values.shape, bool)
+        m[:, self.shapecols] = self.hasshape[:, np.newaxis]
+        return m
+
+    def copy(self):
+        c = self.__class__(self.values[:, 0], self.values[:, 1],
+                           self.values[:, self.fluxcols], self.bands,
+                           types=self.getTypes(),
+                           shape=self.values[:, self.shapecols])
+        c.liquid = self.liquid.copy()
+        c.srcliquid = self.srcliquid.copy()
+        c.paramliquid = self.paramliquid.copy()
+        return c
+    deepcopy = copy
+
+    def hashkey(self):
+        return (getClassName(self), self.typecodes.tobytes(),
+                self.values.tobytes())
+
+    def numberOfParams(self):
+        return int(np.count_nonzero(self._thawedMask()))
+
+    def getParams(self):
+        return self.values[self._thawedMask()].tolist()
+
+    def setParams(self, p):
+        self.values[self._thawedMask()] = p
+
+    def setParam(self, i, p):
+        j = np.flatnonzero(self._thawedMask())[i]
+        old = self.values.flat[j]
+        self.values.flat[j] = p
+        return old
+
+    def getAllParams(self):
+        return self.values[self._allMask()].tolist()
+
+    def setAllParams(self, p):
+        self.values[self._allMask()] = p
+
+    def _getThawedBounds(self, b):
+        return np.broadcast_to(b, self.values.shape)[
+            self._thawedMask()].tolist()
+
+    def getLowerBounds(self):
+        return self._getThawedBounds(self._lowers)
+
+    def getUpperBounds(self):
+        return self._getThawedBounds(self._uppers)
+
+    def getMaxStep(self):
+        return self._getThawedBounds(self._maxstep)
+
+    def _getThings(self):
+        return self.subs
+
+    def _numberOfThings(self):
+        return len(self.typecodes)
+
+    def _setThing(self, i, val):
+        raise RuntimeError('ColumnarCatalog sources cannot be replaced')
+
+    def _getActiveSubs(self):
+        for i in np.flatnonzero(self.liquid):
+            yield self.getSource(i)
+
+    def _getInactiveSubs(self):
+        for i in np.flatnonzero(np.logical_not(self.liquid)):
+            yield self.getSource(i)
+
+    def _enumerateActiveSubs(self):
+        for i in np.flatnonzero(self.liquid):
+            yield i, self.getSource(i)
+
+    def __len__(self):
+        return len(self.typecodes)
+
+    def __getitem__(self, i):
+        return self.subs[i]
+
+    def __setitem__(self, i, val):
+        self._setThing(i, val)
+
+    def __iter__(self):
+        return iter(self.subs)
+
+    def append(self, x):
+        raise RuntimeError('ColumnarCatalog sources cannot be added')
+    prepend = extend = append
+
+    def remove(self, x):
+        raise RuntimeError('ColumnarCatalog sources cannot be removed')
+
+    # Freezing and thawing by name, for all sources at once.
+
+    def _setLiquidByName(self, pnames, val):
+        for nm in pnames:
+            if nm in self.components:
+                self.srcliquid[:, self.components.index(nm)] = val
+            if nm in self.colnames:
+                self.paramliquid[:, self.colnames.index(nm)] = val
+        if '*' in pnames:
+            self.liquid[:] = val
+            self.srcliquid[:] = val
+            self.paramliquid[:] = val
+        _param_structure_changed(self)
+
+    def freezeParamsRecursive(self, *pnames):
+        self._setLiquidByName(pnames, False)
+
+    def thawParamsRecursive(self, *pnames):
+        self._setLiquidByName(pnames, True)
+
+    def thawPathsTo(self, *pnames):
+        thawed = np.zeros(len(self), bool)
+        for c, nm in enumerate(self.components):
+            if nm in pnames:
+                has = self.hasshape if nm == 'shape' else slice(None)
+                self.srcliquid[has, c] = True
+                thawed[has] = True
+        for j, nm in enumerate(self.colnames):
+            if nm in pnames:
+                c = self.colcomponent[j]
+                has = self.hasshape if c == 2 else slice(None)
+                self.paramliquid[has, j] = True
+                self.srcliquid[has, c] = True
+                thawed[has] = True
+        self.liquid[thawed] = True
+        _param_structure_changed(self)
+        return bool(np.any(thawed))
@@ -20,10 +20,14 @@ class ConstrainedOptimizer(LsqrOptimizer):
         R = {}
         self.hit_limit = False
         self.last_step_hit_limit = False
+        saved = 0
         for step in range(steps):
             #print('Optimize_loop: step', step)
             self.stepLimited = False
+            self.linesearch_stats = None
             dlnp,_,_ = self.optimize(tractor, **kwargs)
+            if self.linesearch_stats is not None:
+                saved += self.linesearch_stats['renders_saved']
             #print('Optimize_loop: step', step, 'dlnp', dlnp, 'hit limit:',
             #      self.hit_limit, 'step limit:', self.stepLimited)
             #for s in tractor.catalog:
@@ -33,18 +37,19 @@ class ConstrainedOptimizer(LsqrOptimizer):
                 break
             if self.stepLimited and dlnp <= dchisq_limited:
                 break
-        R.update(steps=step)
+        R.update(steps=step, renders_saved=saved)
         R.update(hit_limit=self.last_step_hit_limit,
                  ever_hit_limit=self.hit_limit)
         return R
 
-    def tryUpdates(self, tractor, X, alphas=None):
+    def tryUpdates(self, tractor, X, alphas=None, pBefore=None):
         #print('Trying parameter updates:', X)
         if alphas is None:
             # 1/1024 to 1 in factors of 2, + sqrt(2.) + 2.
             alphas = np.append(2.**np.arange(-10, 1), [np.sqrt(2.), 2.])
 
-        pBefore = tractor.getLogProb()
+        if pBefore is None:
+            pBefore = tractor.getLogProb()
         #logverb('  log-prob before:', pBefore)
         pBest = pBefore
         alphaBest = None
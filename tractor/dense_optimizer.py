@@ -2,6 +2,7 @@ from __future__ import print_function
 import numpy as np
 from tractor.engine import logverb
 from tractor.constrained_optimizer import ConstrainedOptimizer
+from tractor.profiler import profile_phase
 
 from numpy.linalg import lstsq
 
@@ -18,7 +19,10 @@ class ConstrainedDenseOptimizer(ConstrainedOptimizer):
                            scale_columns=True, scales_only=False,
                            chiImages=None, variance=False,
                            shared_params=True,
-                           get_A_matrix=False):
+                           get_A_matrix=False, solver=None):
+        # (this always uses a dense solve: *solver* must be None)
+        if solver is not None:
+            raise RuntimeError('Not implemented: solver=%s' % solver)
 
         if shared_params or scales_only or damp>0 or variance:
             raise RuntimeError('Not implemented')
@@ -185,7 +189,8 @@ class ConstrainedDenseOptimizer(ConstrainedOptimizer):
             del chi
 
         # X, resids, rank, singular_vals
-        X,_,_,_ = lstsq(A, B, rcond=None)
+        with profile_phase(tractor, 'solve'):
+            X,_,_,_ = lstsq(A, B, rcond=None)
 
         if False:
             Aold = super(ConstrainedDenseOptimizer, self).getUpdateDirection(
@@ -123,6 +123,44 @@ class EllipseE(ParamList):
         GGT = np.dot(G, G.T)
         return GGT
 
+    def getCovarianceDerivatives(self):
+        '''
+        Returns a list of 2x2 matrices: the derivatives of
+        getCovariance() with respect to each of the thawed parameters.
+
+        Writing the covariance as
+
+          C = re^2 / (1+e)^2 * [ (1+e^2) I + 2 [[-e1, e2], [e2, e1]] ]
+
+        it is smooth except at e = 0, where we take the derivative in
+        the positive e1 (or e2) direction.  (The cap on the axis ratio
+        in getRaDecBasis, at e > 0.998, is ignored.)
+        '''
+        return list(self._getLiquidArray(self._getCovarianceDerivs(
+            self.re, self.e1, self.e2)))
+
+    @staticmethod
+    def _getCovarianceDerivs(re, e1, e2):
+        # Derivatives wrt (re, e1, e2).
+        e = math.hypot(e1, e2)
+        if e == 0.:
+            c1 = c2 = 1.
+        else:
+            c1 = e1 / e
+            c2 = e2 / e
+        M = np.array([[-e1, e2], [e2, e1]])
+        S = (1. + e**2) * np.eye(2) + 2. * M
+        # d/de of (1+e^2)/(1+e)^2, and of 2/(1+e)^2
+        da = -2. * (1. - e) / (1. + e)**3
+        db = -4. / (1. + e)**3
+        r2 = re**2
+        dre = 2. * re / (1. + e)**2 * S
+        de1 = r2 * (da * c1 * np.eye(2) + db * c1 * M +
+                    2. / (1. + e)**2 * np.array([[-1., 0.], [0., 1.]]))
+        de2 = r2 * (da * c2 * np.eye(2) + db * c2 * M +
+                    2. / (1. + e)**2 * np.array([[0., 1.], [1., 0.]]))
+        return [dre, de1, de2]
+
     def getRaDecBasis(self):
         ''' Returns a transformation matrix that takes vectors in r_e
         to delta-RA, delta-Dec vectors.
@@ -228,6 +266,29 @@ class EllipseESoft(EllipseE):
     def __repr__(self):
         return 'log r_e=%g, ee1=%g, ee2=%g' % (self.logre, self.ee1, self.ee2)
 
+    def getCovarianceDerivatives(self):
+        '''
+        Returns a list of 2x2 matrices: the derivatives of
+        getCovariance() with respect to each of the thawed parameters.
+        '''
+        ee = self.softe
+        if ee == 0.:
+            s = 1.
+            J = np.eye(2)
+        else:
+            e = 1. - math.exp(-ee)
+            s = e / ee
+            ds = (ee * math.exp(-ee) - e) / ee**2
+            v = np.array([self.ee1, self.ee2])
+            J = s * np.eye(2) + ds * np.outer(v, v) / ee
+        re = self.re
+        dre, de1, de2 = EllipseE._getCovarianceDerivs(
+            re, s * self.ee1, s * self.ee2)
+        return list(self._getLiquidArray([
+            re * dre,
+            J[0, 0] * de1 + J[1, 0] * de2,
+            J[0, 1] * de1 + J[1, 1] * de2]))
+
     @property
     def re(self):
         return math.exp(self.logre)
@@ -16,6 +16,7 @@ import numpy as np
 from tractor.utils import MultiParams, _isint, get_class_from_name
 from tractor.patch import Patch, ModelMask
 from tractor.image import Image
+from tractor.profiler import profile_phase
 
 logger = logging.getLogger('tractor.engine')
 def logverb(*args):
@@ -36,6 +37,33 @@ def set_fp_err():
     '''
     return np.seterr(all='raise')
 
+# Number of pixels per block in chi_squared
+chisq_block_pixels = 65536
+
+def chi_squared(data, mod, inverr, sky=None):
+    '''
+    Returns the chi-squared, sum(((data - mod - sky) * inverr)**2),
+    accumulated in double precision.
+
+    This is equivalent to squaring and summing the chi image, but it
+    works through blocks of rows so that only block-sized temporaries
+    are allocated, rather than several full-image arrays.
+
+    *mod* and *sky* (optional) are arrays of the same shape as *data*.
+    '''
+    data = np.atleast_2d(data)
+    H, W = data.shape
+    step = max(1, chisq_block_pixels // max(W, 1))
+    chisq = 0.
+    for y0 in range(0, H, step):
+        s = slice(y0, y0 + step)
+        r = np.subtract(data[s], mod[s])
+        if sky is not None:
+            r -= sky[s]
+        r *= inverr[s]
+        chisq += np.einsum('ij,ij->', r, r, dtype=np.float64)
+    return float(chisq)
+
 
 class Catalog(MultiParams):
     '''
@@ -129,6 +157,14 @@ class Tractor(MultiParams):
         self.modtype = np.float32
         self.modelMasks = None
         self.expectModelMasks = False
+        # Render supported sources with the vectorized code in batched.py?
+        self.batchRender = False
+        # Maintain model images incrementally (see incremental.py)?
+        self.incrementalModels = False
+        self.modelAccumulators = {}
+        # Only visit the sources that can touch each image (see spatial.py)?
+        self.useSpatialIndex = False
+        self.spatialIndex = None
         if optimizer is None:
             from .lsqr_optimizer import LsqrOptimizer
             self.optimizer = LsqrOptimizer()
@@ -138,6 +174,8 @@ class Tractor(MultiParams):
         if model_kwargs is None:
             model_kwargs = {}
         self.model_kwargs = model_kwargs
+        # Phase timing (see profiler.py), if enabled
+        self.profiler = None
 
     def __str__(self):
         s = ('%s with %i sources and %i images' % (
@@ -158,10 +196,11 @@ class Tractor(MultiParams):
 
     # For pickling
     def __getstate__(self):
-        version = 1
+        version = 4
         S = (version, self.getImages(), self.getCatalog(), self.liquid,
              self.modtype, self.modelMasks, self.expectModelMasks,
-             self.optimizer)
+             self.optimizer, self.batchRender, self.incrementalModels,
+             self.useSpatialIndex)
         return S
 
     def __setstate__(self, state):
@@ -174,8 +213,47 @@ class Tractor(MultiParams):
         elif len(state) == 8:
             (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
              self.expectModelMasks, self.optimizer) = state
+        elif len(state) == 9:
+            (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
+             self.expectModelMasks, self.optimizer, self.batchRender) = state
+        elif len(state) == 10:
+            (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
+             self.expectModelMasks, self.optimizer, self.batchRender,
+             self.incrementalModels) = state
+        elif len(state) == 11:
+            (ver, images, catalog, self.liquid, self.modtype, self.modelMasks,
+             self.expectModelMasks, self.optimizer, self.batchRender,
+             self.incrementalModels, self.useSpatialIndex) = state
+        if len(state) < 9:
+            self.batchRender = False
+        if len(state) < 10:
+            self.incrementalModels = False
+        if len(state) < 11:
+            self.useSpatialIndex = False
+        self.modelAccumulators = {}
+        self.spatialIndex = None
+        self.profiler = None
         self.subs = [images, catalog]
 
+    def enableProfiling(self, memory=False):
+        '''
+        Attaches a new Profiler (see profiler.py) to this Tractor,
+        recording the time spent in each phase of rendering and
+        optimization (and, if *memory*, the peak bytes allocated).
+        Returns the Profiler.
+        '''
+        from .profiler import Profiler
+        self.profiler = Profiler(memory=memory)
+        return self.profiler
+
+    def disableProfiling(self):
+        '''
+        Detaches and returns the Profiler (or None).
+        '''
+        prof = self.profiler
+        self.profiler = None
+        return prof
+
     def getNImages(self):
         return len(self.images)
 
@@ -303,29 +381,24 @@ class Tractor(MultiParams):
         kw = self.model_kwargs.copy()
         kw.update(kwargs)
 
+        index = None
+        if self.useSpatialIndex and len(srcs):
+            index = self.getSpatialIndex()
+
         if not self.isParamFrozen('images'):
             for i in self.images.getThawedParamIndices():
                 img = self.images[i]
-                derivs = img.getParamDerivatives(self, allsrcs, **kw)
-                mod0 = None
-                for di, deriv in enumerate(derivs):
-                    if deriv is False:
-                        if mod0 is None:
-                            mod0 = self.getModelImage(img, **kwargs)
-                            p0 = img.getParams()
-                            stepsizes = img.getStepSizes()
-                            paramnames = img.getParamNames()
-                        oldval = img.setParam(di, p0[di] + stepsizes[di])
-                        mod = self.getModelImage(img, **kwargs)
-                        img.setParam(di, oldval)
-                        deriv = Patch(0, 0, (mod - mod0) / stepsizes[di])
-                        deriv.name = 'd(im%i)/d(%s)' % (i, paramnames[di])
-                    allderivs.append([(deriv, img)])
-                del mod0
+                derivs = self._getImageDerivatives(img, i, allsrcs, kw,
+                                                   **kwargs)
+                allderivs.extend([[(deriv, img)] for deriv in derivs])
 
         for src in srcs:
             srcderivs = [[] for i in range(src.numberOfParams())]
-            for img in self.images:
+            if index is None:
+                imgs = self.images
+            else:
+                imgs = index.getImages(src)
+            for img in imgs:
                 derivs = self._getSourceDerivatives(src, img, **kwargs)
                 for k, deriv in enumerate(derivs):
                     if deriv is None:
@@ -338,6 +411,30 @@ class Tractor(MultiParams):
         assert(len(allderivs) == self.numberOfParams())
         return allderivs
 
+    def _getImageDerivatives(self, img, imgi, srcs, kw, **kwargs):
+        '''
+        Returns the derivatives of the model for Image *img* (number
+        *imgi*) with respect to its (thawed) parameters, computing by
+        finite differences any that the image does not provide.
+        '''
+        with profile_phase(self, 'derivs', img):
+            derivs = img.getParamDerivatives(self, srcs, **kw)
+        mod0 = None
+        for di, deriv in enumerate(derivs):
+            if deriv is False:
+                if mod0 is None:
+                    mod0 = self.getModelImage(img, **kwargs)
+                    p0 = img.getParams()
+                    stepsizes = img.getStepSizes()
+                    paramnames = img.getParamNames()
+                oldval = img.setParam(di, p0[di] + stepsizes[di])
+                mod = self.getModelImage(img, **kwargs)
+                img.setParam(di, oldval)
+                deriv = Patch(0, 0, (mod - mod0) / stepsizes[di])
+                deriv.name = 'd(im%i)/d(%s)' % (imgi, paramnames[di])
+                derivs[di] = deriv
+        return derivs
+
     def setModelMasks(self, masks, assumeMasks=True):
         '''
         A "model mask" is used to define the pixels that are evaluated
@@ -392,7 +489,8 @@ class Tractor(MultiParams):
         # HACK! -- assume no modelMask -> no overlap
         if self.expectModelMasks and mask is None:
             return [None] * src.numberOfParams()
-        derivs = src.getParamDerivatives(img, modelMask=mask, **kwargs)
+        with profile_phase(self, 'derivs', img, src):
+            derivs = src.getParamDerivatives(img, modelMask=mask, **kwargs)
 
         # HACK -- auto-add?
         # if self.expectModelMasks:
@@ -418,7 +516,8 @@ class Tractor(MultiParams):
             return None
         kw = self.model_kwargs.copy()
         kw.update(kwargs)
-        mod = src.getModelPatch(img, modelMask=mask, **kw)
+        with profile_phase(self, 'render', img, src):
+            mod = src.getModelPatch(img, modelMask=mask, **kw)
         return mod
 
     def getModelImage(self, img, srcs=None, sky=True, minsb=None, **kwargs):
@@ -427,14 +526,46 @@ class Tractor(MultiParams):
         the sky level.  If "srcs" is specified (a list of sources),
         then only those sources will be rendered into the image.
         Otherwise, the whole catalog will be.
+
+        If *self.batchRender* is set, the sources that can be are
+        rendered together by the vectorized code in *batched.py*, and
+        the rest one at a time.
+
+        If *self.incrementalModels* is set, the model of the whole
+        catalog is kept between calls, and only the sources whose
+        parameters have changed are re-rendered.
+
+        If *self.useSpatialIndex* is set, only the sources of the
+        catalog that can touch the image are rendered.
         '''
         if _isint(img):
             img = self.getImage(img)
+        if srcs is None and self.incrementalModels and not kwargs:
+            acc = self.getModelAccumulator(img, minsb=minsb)
+            with profile_phase(self, 'render', img, 'incremental'):
+                mod = acc.update(self, self.catalog).astype(self.modtype)
+            if sky:
+                img.getSky().addTo(mod)
+            return mod
         mod = np.zeros(img.getModelShape(), self.modtype)
         if sky:
             img.getSky().addTo(mod)
         if srcs is None:
-            srcs = self.catalog
+            if self.useSpatialIndex:
+                srcs = self.getSpatialIndex().getSources(img)
+            else:
+                srcs = self.catalog
+        if self.batchRender and not kwargs and not self.model_kwargs:
+            from .batched import render_sources_batched
+            with profile_phase(self, 'render', img, 'batched'):
+                srcs = render_sources_batched(self, img, srcs, mod,
+                                              minsb=minsb)
+        if hasattr(img.getPsf(), 'precomputeAt'):
+            # Evaluate a spatially-varying pixelized PSF at many
+            # source positions at once.
+            from .psfex import psf_precomputed_sources
+            srcs = psf_precomputed_sources(
+                img, srcs, getmask=lambda src: self._getModelMaskFor(img, src))
         for src in srcs:
             if src is None:
                 continue
@@ -444,6 +575,43 @@ class Tractor(MultiParams):
             patch.addTo(mod)
         return mod
 
+    def getModelAccumulator(self, img, minsb=None):
+        '''
+        Returns the ModelAccumulator used to maintain the model of the
+        catalog in the given Image (when *incrementalModels* is set),
+        creating it if necessary.
+        '''
+        from .incremental import ModelAccumulator
+        if minsb is None:
+            minsb = img.modelMinval
+        key = (id(img), minsb)
+        acc = self.modelAccumulators.get(key, None)
+        if acc is None or acc.img is not img:
+            acc = ModelAccumulator(img, minsb)
+            self.modelAccumulators[key] = acc
+        return acc
+
+    def getSpatialIndex(self):
+        '''
+        Returns the SpatialIndex (see spatial.py) of which sources can
+        touch each image, brought up to date with the current images
+        and catalog.
+        '''
+        from .spatial import SpatialIndex
+        if self.spatialIndex is None:
+            self.spatialIndex = SpatialIndex()
+        with profile_phase(self, 'spatial'):
+            self.spatialIndex.update(self)
+        return self.spatialIndex
+
+    def getModelMasks(self):
+        '''
+        Returns model masks, for *setModelMasks*, covering the bounding
+        box of each source in each image that it can touch (according
+        to the SpatialIndex).
+        '''
+        return self.getSpatialIndex().getModelMasks()
+
     def getModelImages(self, **kwargs):
         for img in self.images:
             yield self.getModelImage(img, **kwargs)
@@ -472,10 +640,37 @@ class Tractor(MultiParams):
             print('psf:', img.getPsf())
         return chi
 
+    def getChiSquared(self, img, srcs=None, minsb=0., **kwargs):
+        '''
+        Returns the chi-squared of the model of the given Image: the
+        sum of getChiImage(img=img)**2, computed without building the
+        chi image (see *chi_squared*).
+
+        If *self.incrementalModels* is set, the chi-squared is kept
+        between calls, and only the pixels touched by the sources
+        whose parameters have changed are re-evaluated (see
+        *ModelAccumulator.getChiSquared*).
+        '''
+        if _isint(img):
+            img = self.getImage(img)
+        with profile_phase(self, 'chisq', img):
+            if srcs is None and self.incrementalModels and not kwargs:
+                acc = self.getModelAccumulator(img, minsb=minsb)
+                with profile_phase(self, 'render', img, 'incremental'):
+                    chisq = acc.getChiSquared(self, self.catalog)
+            else:
+                mod = self.getModelImage(img, srcs=srcs, minsb=minsb,
+                                         **kwargs)
+                chisq = chi_squared(img.getImage(), mod, img.getInvError())
+        if not np.isfinite(chisq):
+            # print diagnostics
+            self.getChiImage(img=img, srcs=srcs, minsb=minsb, **kwargs)
+        return chisq
+
     def getLogLikelihood(self, **kwargs):
         chisq = 0.
-        for i, chi in enumerate(self.getChiImages(**kwargs)):
-            chisq += (chi.astype(float) ** 2).sum()
+        for img in self.images:
+            chisq += self.getChiSquared(img, **kwargs)
         return -0.5 * chisq
 
     def getLogProb(self, **kwargs):
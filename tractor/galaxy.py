@@ -18,24 +18,53 @@ from tractor import mixture_profiles as mp
 from tractor.utils import ParamList, MultiParams, ScalarParam, BaseParams
 from tractor.patch import Patch, add_patches, ModelMask
 from tractor.basics import SingleProfileSource, BasicSource
+from tractor.cache import Cache
 
 debug_ps = None
 
 
+# The cache of unit-flux galaxy patches (see
+# ProfileGalaxy.getUnitFluxModelPatch), or None if disabled (the
+# default; enable with set_galaxy_cache_size or set_galaxy_cache).
+_galcache = None
+
+# Pixel positions are quantized to this precision (in pixels) in the
+# galaxy cache keys.
+galaxy_cache_quantum = 1e-6
+
+
 def get_galaxy_cache():
-    return None
+    return _galcache
 
 
-def set_galaxy_cache_size(N=10000):
-    # Ugh, dealing with caching + extents / modelMasks was too much
-    pass
+def set_galaxy_cache(cache):
+    '''
+    Installs *cache* as the galaxy cache, or disables it if None.
+    *cache* can be a tractor.cache.Cache or any other object with
+    get(key, default) and put(key, value) methods, eg a
+    tractor.mpcache.SharedCache that the workers of a pool share.
+    With a SharedCache created with copy=False, the patches are
+    returned as read-only views of the shared memory, not copies.
+    '''
+    global _galcache
+    _galcache = cache
+
+
+def set_galaxy_cache_size(N=10000, maxbytes=256 * 1024 * 1024):
+    '''
+    Creates (or replaces) the galaxy cache, a tractor.cache.Cache
+    holding at most *N* entries and *maxbytes* bytes.  The cache is
+    disabled by default; each process (including each pool worker)
+    that enables it holds up to *maxbytes* (by default 256 MB).
+    '''
+    set_galaxy_cache(Cache(maxsize=N, maxbytes=maxbytes))
 
 
 enable_galaxy_cache = set_galaxy_cache_size
 
 
 def disable_galaxy_cache():
-    pass
+    set_galaxy_cache(None)
 
 
 class GalaxyShape(ParamList):
@@ -136,9 +165,29 @@ class Galaxy(MultiParams, SingleProfileSource):
         raise RuntimeError('getUnitFluxModelPatch unimplemented in' +
                            self.getName())
 
+    # Compute position and shape derivatives analytically, when the
+    # subclass supports it (see _getAnalyticParamDerivatives), rather
+    # than by finite differences.
+    analyticDerivs = True
+
+    def _getAnalyticParamDerivatives(self, img, modelMask=None, **kwargs):
+        '''
+        Returns the same thing as getParamDerivatives, or None if
+        analytic derivatives are not available for this galaxy, image
+        and modelMask.
+        '''
+        return None
+
     # returns [ Patch, Patch, ... ] of length numberOfParams().
     # Galaxy.
     def getParamDerivatives(self, img, modelMask=None, **kwargs):
+        if self.analyticDerivs:
+            derivs = self._getAnalyticParamDerivatives(
+                img, modelMask=modelMask, **kwargs)
+            if derivs is not None:
+                return derivs
+
+        # Finite differences.
         pos0 = self.getPosition()
         (px0, py0) = img.getWcs().positionToPixel(pos0, self)
         counts = img.getPhotoCal().brightnessToCounts(self.brightness)
@@ -253,12 +302,118 @@ class ProfileGalaxy(object):
                               modelMask=None, **kwargs):
         if px is None or py is None:
             (px, py) = img.getWcs().positionToPixel(self.getPosition(), self)
+        cache = _galcache
+        key = None
+        if cache is not None:
+            key = self._getUnitFluxCacheKey(img, px, py, minval, modelMask,
+                                            kwargs)
+        # A Cache keeps the patches it is given, and callers may
+        # modify the patch they get, so patches are copied going in
+        # and out; other caches (eg, SharedCache) store their own
+        # copies and return copies or read-only views (of contiguous
+        # arrays, so patches that are views are copied going in).
+        copy = isinstance(cache, Cache)
+        if key is not None:
+            patch = cache.get(key, False)
+            if patch is not False:
+                if copy and patch is not None:
+                    patch = patch.copy()
+                return patch
         patch = self._realGetUnitFluxModelPatch(
             img, px, py, minval, modelMask=modelMask, **kwargs)
         if patch is not None and modelMask is not None:
             assert(patch.shape == modelMask.shape)
+        if key is not None:
+            if patch is not None and (copy or (
+                    patch.patch is not None and
+                    not patch.patch.flags.c_contiguous)):
+                cache.put(key, patch.copy())
+            else:
+                cache.put(key, patch)
         return patch
 
+    def _getUnitFluxCacheKey(self, img, px, py, minval, modelMask, kwargs):
+        '''
+        Returns the galaxy-cache key for the unit-flux patch of this
+        galaxy at pixel position *px*,*py* in *img* (with the given
+        *minval*, *modelMask* and rendering keyword arguments), or
+        None if it can't be cached.
+
+        The key holds the profile parameters, the PSF and WCS
+        hashkeys, the (quantized) pixel position and the ModelMask
+        extent and pixels, so changing any of them changes the key.
+        '''
+        q = galaxy_cache_quantum
+        deps = self._getUnitFluxDeps(img, int(np.round(px / q)),
+                                     int(np.round(py / q)))
+        if deps is None:
+            return None
+        if modelMask is None:
+            mkey = None
+        else:
+            mkey = modelMask.hashkey()
+        key = deps + (img.shape, minval, mkey,
+                      getattr(self, 'halfsize', None),
+                      tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _getUnitFluxPatchExtent(self, img, px, py, minval):
+        '''
+        Returns (x0, x1, y0, y1, halfsize) of the region of *img* that
+        will be rendered for this galaxy centered at pixel *px*,*py*
+        when no ModelMask is given, or None if it does not overlap
+        the image.
+        '''
+        from astrometry.util.miscutils import get_overlapping_region
+        # choose the patch size
+        halfsize = self._getUnitFluxPatchSize(img, px=px, py=py, minval=minval)
+        # find overlapping pixels to render
+        (outx, inx) = get_overlapping_region(
+            int(np.floor(px - halfsize)), int(np.ceil(px + halfsize + 1)),
+            0, img.getWidth())
+        (outy, iny) = get_overlapping_region(
+            int(np.floor(py - halfsize)), int(np.ceil(py + halfsize + 1)),
+            0, img.getHeight())
+        if inx == [] or iny == []:
+            # no overlap
+            return None
+        return outx.start, outx.stop, outy.start, outy.stop, halfsize
+
+    def _getModelMaskHalfsize(self, psf, px, py, modelMask):
+        '''
+        Returns the half-size of the PSF Fourier transform used to
+        render this galaxy at pixel *px*,*py* within *modelMask*.
+        '''
+        mh, mw = modelMask.shape
+        x0, y0 = modelMask.x0, modelMask.y0
+        x1 = x0 + mw
+        y1 = y0 + mh
+        halfsize = max(mh / 2., mw / 2.)
+        # How far from the source center to furthest modelMask edge?
+        # FIXME -- add 1 for Lanczos margin?
+        halfsize = max(halfsize, max(max(1 + px - x0, 1 + x1 - px),
+                                     max(1 + py - y0, 1 + y1 - py)))
+        psfh, psfw = psf.shape
+        return max(halfsize, max(psfw / 2., psfh / 2.))
+
+    def _getFourierHalfsize(self, img, px, py, minval, modelMask=None):
+        '''
+        Returns the half-size of the PSF Fourier transform used to
+        render this galaxy at pixel *px*,*py* in *img* (with a
+        pixelized PSF), or None if it is not rendered.
+        '''
+        if modelMask is not None:
+            return self._getModelMaskHalfsize(img.getPsf(), px, py,
+                                              modelMask)
+        extent = self._getUnitFluxPatchExtent(img, px, py, minval)
+        if extent is None:
+            return None
+        return min(extent[4], max(img.shape))
+
     def _realGetUnitFluxModelPatch(self, img, px, py, minval, modelMask=None,
                                    inner_real_nsigma = 3.,
                                    outer_real_nsigma = 4.,
@@ -268,20 +423,10 @@ class ProfileGalaxy(object):
         if modelMask is not None:
             x0, y0 = modelMask.x0, modelMask.y0
         else:
-            # choose the patch size
-            halfsize = self._getUnitFluxPatchSize(img, px=px, py=py, minval=minval)
-            # find overlapping pixels to render
-            (outx, inx) = get_overlapping_region(
-                int(np.floor(px - halfsize)), int(np.ceil(px + halfsize + 1)),
-                0, img.getWidth())
-            (outy, iny) = get_overlapping_region(
-                int(np.floor(py - halfsize)), int(np.ceil(py + halfsize + 1)),
-                0, img.getHeight())
-            if inx == [] or iny == []:
-                # no overlap
+            extent = self._getUnitFluxPatchExtent(img, px, py, minval)
+            if extent is None:
                 return None
-            x0, x1 = outx.start, outx.stop
-            y0, y1 = outy.start, outy.stop
+            x0, x1, y0, y1, halfsize = extent
 
         psf = img.getPsf()
 
@@ -342,13 +487,7 @@ class ProfileGalaxy(object):
             x1 = x0 + mw
             y1 = y0 + mh
 
-            halfsize = max(mh / 2., mw / 2.)
-            # How far from the source center to furthest modelMask edge?
-            # FIXME -- add 1 for Lanczos margin?
-            halfsize = max(halfsize, max(max(1 + px - x0, 1 + x1 - px),
-                                         max(1 + py - y0, 1 + y1 - py)))
-            psfh, psfw = psf.shape
-            halfsize = max(halfsize, max(psfw / 2., psfh / 2.))
+            halfsize = self._getModelMaskHalfsize(psf, px, py, modelMask)
             #print('Halfsize:', halfsize)
             if force_halfsize is not None:
                 halfsize = force_halfsize
@@ -701,11 +840,9 @@ class HoggGalaxy(ProfileGalaxy, Galaxy):
         return amix
 
     def _getUnitFluxDeps(self, img, px, py):
-        # return ('unitpatch', self.getName(), px, py,
-        return hash(('unitpatch', self.getName(), px, py,
-                     img.getWcs().hashkey(),
-                     img.getPsf().hashkey(), self.shape.hashkey())
-                    )
+        return ('unitpatch', self.getName(), px, py,
+                img.getWcs().hashkey(),
+                img.getPsf().hashkey(), self.shape.hashkey())
 
     def _getUnitFluxPatchSize(self, img, px=0., py=0., minval=0.):
         if hasattr(self, 'halfsize'):
@@ -716,6 +853,124 @@ class HoggGalaxy(ProfileGalaxy, Galaxy):
         halfsize = int(np.ceil(halfsize))
         return halfsize
 
+    def _getAnalyticParamDerivatives(self, img, modelMask=None, **kwargs):
+        '''
+        Computes the derivatives with respect to position and shape
+        by differentiating the PSF-convolved mixture of Gaussians,
+        evaluating the model and all its derivatives in a single pass.
+
+        This requires a mixture-of-Gaussians (not pixelized or hybrid)
+        PSF, a circular profile, a rectangular (or no) modelMask, and
+        a shape that provides getCovarianceDerivatives (eg EllipseE,
+        EllipseESoft).  Otherwise returns None and the caller falls
+        back to finite differences.
+        '''
+        from tractor.psf import HybridPSF
+        psf = img.getPsf()
+        if (isinstance(psf, HybridPSF) or
+                not hasattr(psf, 'getMixtureOfGaussians')):
+            return None
+        if modelMask is not None and modelMask.mask is not None:
+            return None
+        shape_thawed = not self.isParamFrozen('shape')
+        if (shape_thawed and
+                not hasattr(self.shape, 'getCovarianceDerivatives')):
+            return None
+        galmix = self.getProfile()
+        gvar = galmix.var
+        if not (np.all(gvar[:, 0, 1] == 0) and np.all(gvar[:, 1, 0] == 0) and
+                np.all(gvar[:, 0, 0] == gvar[:, 1, 1])):
+            return None
+
+        pos0 = self.getPosition()
+        (px0, py0) = img.getWcs().positionToPixel(pos0, self)
+        counts = img.getPhotoCal().brightnessToCounts(self.brightness)
+        minsb = img.modelMinval
+        if counts > 0:
+            minval = minsb / counts
+        else:
+            minval = None
+
+        # Choose the pixels to evaluate, as in getParamDerivatives.
+        patch0 = None
+        if modelMask is not None:
+            x0, x1, y0, y1 = modelMask.extent
+        elif minval:
+            # The model patch is approximate in this case; use it as-is.
+            patch0 = self.getUnitFluxModelPatch(img, px=px0, py=py0,
+                                                minval=minval, **kwargs)
+            if patch0 is None:
+                return [None] * self.numberOfParams()
+            x0, x1, y0, y1 = patch0.getExtent()
+        else:
+            extent = self._getUnitFluxPatchExtent(img, px0, py0, minval)
+            if extent is None:
+                return [None] * self.numberOfParams()
+            x0, x1, y0, y1 = extent[:4]
+
+        amix = self._getAffineProfile(img, px0, py0)
+        psfmix = psf.getMixtureOfGaussians(px=px0, py=py0)
+        cmix = amix.convolve(psfmix)
+
+        # The (circular) profile component variances v_k are mapped
+        # to pixel space by v_k * cdinv * C * cdinv^T, where C is the
+        # shape's covariance (in deg^2); the convolved mixture has the
+        # galaxy components repeated for each PSF component.
+        dvar = np.zeros((0, cmix.K, 2, 2))
+        if shape_thawed and counts != 0:
+            cdinv = img.getWcs().cdInverseAtPixel(px0, py0)
+            dvar = []
+            for dC in self.shape.getCovarianceDerivatives():
+                dA = np.dot(cdinv, np.dot(dC / 3600.**2, cdinv.T))
+                dv = gvar[:, 0, 0][:, np.newaxis, np.newaxis] * dA
+                dvar.append(np.tile(dv, (psfmix.K, 1, 1)))
+            dvar = np.array(dvar)
+        p, dx, dy, dshape = cmix.evaluate_grid_derivs(x0, x1, y0, y1,
+                                                      0., 0., dvar)
+        if patch0 is None:
+            patch0 = p
+
+        derivs = []
+        # derivatives wrt position, via the change in pixel position
+        if not self.isParamFrozen('pos'):
+            params = pos0.getParams()
+            if counts == 0:
+                derivs.extend([None] * len(params))
+            else:
+                for i, pstep in enumerate(pos0.getStepSizes()):
+                    oldval = pos0.setParam(i, params[i] + pstep)
+                    (px, py) = img.getWcs().positionToPixel(pos0, self)
+                    pos0.setParam(i, oldval)
+                    d = Patch(x0, y0,
+                              (dx.patch * ((px - px0) / pstep) +
+                               dy.patch * ((py - py0) / pstep)) * counts)
+                    d.setName('d(%s)/d(pos%i)' % (self.dname, i))
+                    derivs.append(d)
+
+        # derivatives wrt brightness
+        if not self.isParamFrozen('brightness'):
+            bsteps = self.brightness.getStepSizes()
+            params = self.brightness.getParams()
+            for i, bstep in enumerate(bsteps):
+                oldval = self.brightness.setParam(i, params[i] + bstep)
+                countsi = img.getPhotoCal().brightnessToCounts(self.brightness)
+                self.brightness.setParam(i, oldval)
+                df = patch0 * ((countsi - counts) / bstep)
+                df.setName('d(%s)/d(bright%i)' % (self.dname, i))
+                derivs.append(df)
+
+        # derivatives wrt shape
+        if shape_thawed:
+            if counts == 0:
+                derivs.extend([None] * self.shape.numberOfParams())
+            else:
+                gnames = self.shape.getParamNames()
+                for name, d in zip(gnames, dshape):
+                    d *= counts
+                    d.setName('d(%s)/d(%s)' % (self.dname, name))
+                    derivs.append(d)
+        return derivs
+
 
 class GaussianGalaxy(HoggGalaxy):
     nre = 6.
@@ -943,12 +1198,12 @@ class FixedCompositeGalaxy(MultiParams, ProfileGalaxy, SingleProfileSource):
         return halfsize
 
     def _getUnitFluxDeps(self, img, px, py):
-        return hash(('unitpatch', self.getName(),
-                     px, py, img.getWcs().hashkey(),
-                     img.getPsf().hashkey(),
-                     self.shapeDev.hashkey(),
-                     self.shapeExp.hashkey(),
-                     self.fracDev.hashkey()))
+        return ('unitpatch', self.getName(),
+                px, py, img.getWcs().hashkey(),
+                img.getPsf().hashkey(),
+                self.shapeDev.hashkey(),
+                self.shapeExp.hashkey(),
+                self.fracDev.hashkey())
 
     def getParamDerivatives(self, img, modelMask=None, **kwargs):
         e = ExpGalaxy(self.pos, self.brightness, self.shapeExp)
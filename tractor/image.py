@@ -156,6 +156,39 @@ class Image(MultiParams):
                 self.sky.hashkey(), self.wcs.hashkey(),
                 self.photocal.hashkey())
 
+    def cachekey(self):
+        '''
+        Returns a hashable key for this image that, unlike hashkey()
+        (which holds the ids of the pixel arrays), is the same in
+        every process: a digest of the pixels plus the PSF, sky, WCS
+        and photometric calibration hashkeys.  Use it for the keys of
+        caches shared between processes (eg,
+        tractor.mpcache.SharedCache).
+        '''
+        return ('Image', self.getShape(), self._pixelDigest(),
+                self.psf.hashkey(), self.sky.hashkey(), self.wcs.hashkey(),
+                self.photocal.hashkey())
+
+    def _pixelDigest(self):
+        # A digest of the data and inverr pixels.  Like hashkey(), it
+        # follows assignments to *data* and *inverr*, not in-place
+        # changes to their pixels.
+        data, inverr = self.data, self.inverr
+        cached = self.__dict__.get('_pixeldigest', None)
+        if cached is not None and cached[0] is data and cached[1] is inverr:
+            return cached[2]
+        import hashlib
+        h = hashlib.sha1()
+        for a in [data, inverr]:
+            if a is None:
+                continue
+            a = np.ascontiguousarray(a)
+            h.update(repr((a.dtype.str, a.shape)).encode())
+            h.update(a.view(np.uint8))
+        digest = h.hexdigest()
+        self._pixeldigest = (data, inverr, digest)
+        return digest
+
     def numberOfPixels(self):
         (H, W) = self.data.shape
         return W * H
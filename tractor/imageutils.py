@@ -58,3 +58,40 @@ def interpret_roi(wcs, imgshape, roi=None, roiradecsize=None, roiradecbox=None,
         y1 = H
 
     return (x0, x1, y0, y1), ((x0 != 0) or (y0 != 0) or (x1 != W) or (y1 != H))
+
+
+# numpy types of the FITS BITPIX values
+_fits_dtypes = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8',
+                -32: '>f4', -64: '>f8'}
+
+
+def read_fits_image(fn, ext=0, roislice=None):
+    '''
+    Returns (image, header) for the image in HDU *ext* of FITS file
+    *fn*, or just its *roislice* (a tuple of (y, x) slices).
+
+    Uncompressed, unscaled images are returned as read-only memory
+    maps onto the file (in its big-endian byte order), so that only
+    the pages touched get read, and processes reading the same file
+    share them; other images are read (just the ROI) with fitsio.
+    '''
+    import fitsio
+    F = fitsio.FITS(fn)
+    hdu = F[ext]
+    hdr = hdu.read_header()
+    if (hdu.is_compressed() or hdr.get('BSCALE', 1.) != 1. or
+        hdr.get('BZERO', 0.) != 0. or hdr['NAXIS'] != 2 or
+        not hdr['BITPIX'] in _fits_dtypes):
+        if roislice is None:
+            image = hdu.read()
+        else:
+            image = hdu[roislice]
+        F.close()
+        return image, hdr
+    offset = hdu.get_offsets()['data_start']
+    F.close()
+    image = np.memmap(fn, dtype=_fits_dtypes[hdr['BITPIX']], mode='r',
+                      offset=offset, shape=(hdr['NAXIS2'], hdr['NAXIS1']))
+    if roislice is not None:
+        image = image[roislice]
+    return image, hdr
@@ -0,0 +1,233 @@
+'''
+`incremental.py`
+================
+
+Incremental maintenance of model images.
+
+During optimization, the line search (Optimizer.tryUpdates) and
+getLogLikelihood re-render the model image for every trial set of
+parameters, even though typically only a few sources are thawed and
+most of the catalog doesn't change.
+
+A ModelAccumulator keeps, for one Image, the sum of the model patches
+of all the sources in the catalog, along with each source's patch and
+the parameter values (hashkey) it was rendered with.  When it is
+updated, only the sources whose parameters have changed are
+subtracted and re-rendered, so the cost is proportional to the number
+of changed sources rather than the size of the catalog.
+
+The accumulator is rebuilt from scratch if the Image's PSF, WCS or
+photometric calibration, the Tractor's modelMasks, or the list of
+sources changes.  The sky model is not included; it is added by
+Tractor.getModelImage.
+
+The accumulator also keeps the image's chi-squared (for
+Tractor.getLogLikelihood): when sources change, the chi-squared is
+re-evaluated only within the bounding boxes of their old and new
+patches, and the change is applied to the cached total.  The image
+pixels and inverse-errors are identified by the arrays themselves, so
+they must be replaced, not modified in place, for the change to be
+noticed.
+
+Enable with *Tractor.incrementalModels = True*.
+'''
+from __future__ import print_function
+import numpy as np
+
+
+class ModelAccumulator(object):
+    '''
+    The sky-free model image of an Image, maintained incrementally as
+    a sum of per-source patches.
+
+    The sum is kept in double precision so that repeated
+    subtract-and-add updates do not accumulate significant round-off.
+    '''
+
+    def __init__(self, img, minsb):
+        self.img = img
+        self.minsb = minsb
+        self.mod = None
+        self.imagekey = None
+        self.masks = None
+        # list of (source, hashkey, patch)
+        self.entries = []
+        # statistics: number of patches rendered, and re-used
+        self.nrendered = 0
+        self.nreused = 0
+        # cached chi-squared, the (sky, data, inverr) it was computed
+        # for, the sky model image, and the number of incremental
+        # updates since it was last computed in full
+        self.chisq = None
+        self.chikey = None
+        self.skymod = None
+        self.nchiupdates = 0
+
+    # Recompute the chi-squared in full after this many incremental
+    # updates, to bound the accumulated round-off
+    chisq_refresh = 100
+    # ... or when the changed regions cover more than this fraction of
+    # the image
+    chisq_max_fraction = 0.5
+
+    def _getImageKey(self, tractor):
+        img = self.img
+        return (img.getModelShape(), img.getPsf().hashkey(),
+                img.getWcs().hashkey(), img.getPhotoCal().hashkey(),
+                tractor.expectModelMasks)
+
+    def _render(self, tractor, src):
+        if src is None:
+            return None, None
+        patch = tractor.getModelPatch(self.img, src, minsb=self.minsb)
+        self.nrendered += 1
+        if patch is not None:
+            patch.addTo(self.mod)
+        return src.hashkey(), patch
+
+    def rebuild(self, tractor, srcs):
+        self.imagekey = self._getImageKey(tractor)
+        self.masks = tractor.modelMasks
+        self.mod = np.zeros(self.img.getModelShape(), np.float64)
+        self.entries = []
+        for src in srcs:
+            hashkey, patch = self._render(tractor, src)
+            self.entries.append((src, hashkey, patch))
+
+    def _isCurrent(self, tractor, srcs):
+        if self.mod is None:
+            return False
+        if tractor.modelMasks is not self.masks:
+            return False
+        if len(srcs) != len(self.entries):
+            return False
+        for src, (s, h, p) in zip(srcs, self.entries):
+            if src is not s:
+                return False
+        return self._getImageKey(tractor) == self.imagekey
+
+    def update(self, tractor, srcs):
+        '''
+        Brings the model up to date with the current parameters of
+        *srcs* (the Tractor's catalog); returns the (double-precision,
+        sky-free) model image, which must not be modified.
+        '''
+        if not self._isCurrent(tractor, srcs):
+            self.rebuild(tractor, srcs)
+            self.chisq = None
+            return self.mod
+        changes = self._renderChanges(tractor)
+        if len(changes):
+            # The cached chi-squared no longer matches the model.
+            self.chisq = None
+        self._apply(changes)
+        return self.mod
+
+    def _renderChanges(self, tractor):
+        # Renders the sources whose parameters have changed; returns a
+        # list of (index, new hashkey, new patch).
+        changes = []
+        for i, (src, hashkey, patch) in enumerate(self.entries):
+            if src is None:
+                continue
+            newkey = src.hashkey()
+            if newkey == hashkey:
+                self.nreused += 1
+                continue
+            newpatch = tractor.getModelPatch(self.img, src, minsb=self.minsb)
+            self.nrendered += 1
+            changes.append((i, newkey, newpatch))
+        return changes
+
+    def _apply(self, changes):
+        for i, newkey, newpatch in changes:
+            src, hashkey, patch = self.entries[i]
+            if patch is not None:
+                patch.addTo(self.mod, scale=-1.)
+            if newpatch is not None:
+                newpatch.addTo(self.mod)
+            self.entries[i] = (src, newkey, newpatch)
+
+    def _changedRegions(self, changes):
+        # Returns a list of disjoint (y, x) slices covering the old and
+        # new patches of the changed sources, or None if they cover too
+        # much of the image to be worth treating separately.
+        H, W = self.mod.shape
+        rects = []
+        for i, newkey, newpatch in changes:
+            for p in [self.entries[i][2], newpatch]:
+                if p is None or p.patch is None:
+                    continue
+                h, w = p.patch.shape
+                x0, x1 = max(p.x0, 0), min(p.x0 + w, W)
+                y0, y1 = max(p.y0, 0), min(p.y0 + h, H)
+                if x1 > x0 and y1 > y0:
+                    rects.append((x0, x1, y0, y1))
+        # Merge overlapping rectangles (into their bounding box) so
+        # that no pixel is counted twice.
+        merged = []
+        for r in rects:
+            overlap = True
+            while overlap:
+                overlap = False
+                for j, m in enumerate(merged):
+                    if (r[0] < m[1] and m[0] < r[1] and
+                            r[2] < m[3] and m[2] < r[3]):
+                        r = (min(r[0], m[0]), max(r[1], m[1]),
+                             min(r[2], m[2]), max(r[3], m[3]))
+                        del merged[j]
+                        overlap = True
+                        break
+            merged.append(r)
+        area = sum((x1 - x0) * (y1 - y0) for x0, x1, y0, y1 in merged)
+        if area > self.chisq_max_fraction * H * W:
+            return None
+        return [(slice(y0, y1), slice(x0, x1)) for x0, x1, y0, y1 in merged]
+
+    def _regionChiSquared(self, regions):
+        from .engine import chi_squared
+        data = self.img.getImage()
+        inverr = self.img.getInvError()
+        return sum(chi_squared(data[s], self.mod[s], inverr[s],
+                               sky=self.skymod[s])
+                   for s in regions)
+
+    def getChiSquared(self, tractor, srcs):
+        '''
+        Brings the model up to date with the current parameters of
+        *srcs* (as in *update*), and returns the chi-squared of the
+        Image given the model plus sky.
+        '''
+        from .engine import chi_squared
+        img = self.img
+        sky = img.getSky()
+        data = img.getImage()
+        inverr = img.getInvError()
+        chikey = (sky.hashkey(), id(data), id(inverr))
+        if not self._isCurrent(tractor, srcs):
+            self.rebuild(tractor, srcs)
+        else:
+            changes = self._renderChanges(tractor)
+            regions = None
+            if (self.chisq is not None and np.isfinite(self.chisq) and
+                    chikey == self.chikey and
+                    self.nchiupdates < self.chisq_refresh):
+                regions = self._changedRegions(changes)
+            if regions is None:
+                self._apply(changes)
+            else:
+                before = self._regionChiSquared(regions)
+                self._apply(changes)
+                after = self._regionChiSquared(regions)
+                self.chisq += after - before
+                if len(changes):
+                    self.nchiupdates += 1
+                return self.chisq
+        if (self.skymod is None or self.skymod.shape != self.mod.shape or
+                chikey[0] != self.chikey[0]):
+            self.skymod = np.zeros(self.mod.shape, np.float32)
+            sky.addTo(self.skymod)
+        self.chisq = chi_squared(data, self.mod, inverr, sky=self.skymod)
+        self.chikey = chikey
+        self.nchiupdates = 0
+        return self.chisq
@@ -3,18 +3,24 @@ import numpy as np
 from astrometry.util.ttime import Time
 from tractor.engine import logverb, isverbose, logmsg
 from tractor.optimize import Optimizer
+from tractor.profiler import profile_phase
 from tractor.utils import listmax
 
 
 class LsqrOptimizer(Optimizer):
 
+    # Closed-form forced photometry with more parameters than this
+    # builds sparse normal equations and solves them block by block
+    # (see solve_sparse_bounded_normal_equations).
+    denseForcedPhotMax = 256
+
     def _optimize_forcedphot_core(
             self, tractor,
             result, umodels, imlist, mod0, scales, skyderivs, minFlux,
             nonneg=None, wantims0=None, wantims1=None,
             negfluxval=None, rois=None, priors=None, sky=None,
             justims0=None, subimgs=None, damp=None, alphas=None,
-            Nsky=None, mindlnp=None, shared_params=None):
+            Nsky=None, mindlnp=None, shared_params=None, solver=None):
 
         # print(len(umodels), 'umodels, lengths', [len(x) for x in umodels])
         if len(umodels) == 0:
@@ -35,11 +41,142 @@ class LsqrOptimizer(Optimizer):
             # first in the derivative list.
             derivs = skyderivs + derivs
         assert(len(derivs) == tractor.numberOfParams())
+        if solver is None:
+            solver = 'lsqr'
+        assert(solver in ['lsqr', 'cholesky'])
+        if solver == 'cholesky':
+            self._linear_forced_photom(
+                tractor, result, derivs, mod0, imgs, umodels,
+                rois, scales, priors, sky, minFlux, nonneg, justims0,
+                subimgs, damp, Nsky, shared_params, wantims1)
+            return
         self._lsqr_forced_photom(
             tractor, result, derivs, mod0, imgs, umodels,
             rois, scales, priors, sky, minFlux, justims0, subimgs,
             damp, alphas, Nsky, mindlnp, shared_params)
 
+    def _linear_forced_photom(self, tractor, result, derivs, mod0, imgs,
+                              umodels, rois, scales, priors, sky, minFlux,
+                              nonneg, justims0, subimgs, damp, Nsky,
+                              shared_params, wantims1):
+        '''
+        Forced photometry in closed form.  The model is linear in the
+        fluxes (and sky levels), so a single solve of the normal
+        equations, built from the unit-flux model patches (see
+        getNormalEquations), gives the best fit; there is no need to
+        iterate or line-search.
+
+        If *minFlux* is set (or *nonneg*, meaning minFlux = 0), the
+        fluxes are constrained to be >= minFlux, and the constrained
+        problem is solved by an active-set method (see
+        solve_bounded_normal_equations).
+
+        With more than *denseForcedPhotMax* parameters, the normal
+        equations are built as a sparse matrix, and each group of
+        parameters that they couple (eg, a group of overlapping
+        sources) is solved separately.
+
+        The model images are rendered only for the initial and final
+        parameters (result.ims0, and result.ims1 if *wantims1*).
+        '''
+        p0 = np.array(tractor.getParams())
+        if sky:
+            p0sky = p0[:Nsky]
+            p0 = p0[Nsky:]
+        else:
+            p0sky = None
+
+        lnp0, chis0, ims0 = self._lnp_for_update(
+            tractor, mod0, imgs, umodels, None, None, p0, rois, scales,
+            None, None, priors, sky, minFlux)
+        assert(np.isfinite(lnp0))
+        result.ims0 = ims0
+        if justims0:
+            result.lnp0 = lnp0
+            result.chis0 = chis0
+            return
+
+        # Lower bounds on the parameter updates
+        lower = np.empty(Nsky + len(p0))
+        lower[:] = -np.inf
+        if nonneg:
+            minFlux = max(0., minFlux) if minFlux is not None else 0.
+        if minFlux is not None:
+            lower[Nsky:] = minFlux - p0
+
+        # See _lsqr_forced_photom: getNormalEquations matches chi
+        # images to tractor.images.
+        if rois is not None:
+            realims = tractor.images
+            tractor.images = subimgs
+        sparse = len(derivs) > self.denseForcedPhotMax
+        try:
+            with profile_phase(tractor, 'matrix'):
+                X = self.getNormalEquations(tractor, derivs, priors=priors,
+                                            scale_columns=False,
+                                            chiImages=chis0,
+                                            shared_params=shared_params,
+                                            sparse=sparse)
+        finally:
+            if rois is not None:
+                tractor.images = realims
+        if X is None:
+            print('Error getting update direction')
+            return
+        if len(X) == 0:
+            X = np.zeros(len(lower))
+        else:
+            ATA, ATb, colscales, paramindexmap = X
+            if shared_params:
+                # the tightest bound on each shared parameter
+                lo = np.empty(len(ATb))
+                lo[:] = -np.inf
+                np.maximum.at(lo, paramindexmap, lower)
+            else:
+                lo = lower
+            X = np.zeros(len(ATb))
+            if sparse:
+                from scipy.sparse import identity
+                I = np.flatnonzero(ATA.diagonal() > 0)
+                ATA = ATA[I, :][:, I] + damp**2 * identity(len(I))
+                with profile_phase(tractor, 'solve'):
+                    X[I] = solve_sparse_bounded_normal_equations(
+                        ATA, ATb[I], lo[I])
+            else:
+                I = np.flatnonzero(np.diag(ATA) > 0)
+                ATA = ATA[np.ix_(I, I)]
+                ATA[np.diag_indices(len(I))] += damp**2
+                with profile_phase(tractor, 'solve'):
+                    X[I] = solve_bounded_normal_equations(ATA, ATb[I],
+                                                          lo[I])
+            if shared_params:
+                X = X[paramindexmap]
+            if not np.all(np.isfinite(X)):
+                print('Error getting update direction')
+                return
+        logverb('Forced phot: update', X)
+
+        if sky:
+            Xsky = X[:Nsky]
+            X = X[Nsky:]
+        else:
+            Xsky = None
+        pa = p0 + X
+        if minFlux is not None:
+            pa = np.maximum(minFlux, pa)
+        tractor.catalog.setParams(pa)
+        if sky:
+            tractor.images.setParams(p0sky + Xsky)
+
+        if wantims1:
+            lnp1, chis1, ims1 = self._lnp_for_update(
+                tractor, mod0, imgs, umodels, pa - p0, 1., p0, rois, scales,
+                p0sky, Xsky, priors, sky, minFlux)
+            logverb('Forced phot: lnp', lnp0, '->', lnp1)
+            result.ims1 = ims1
+        else:
+            result.ims1 = None
+
     def _lsqr_forced_photom(self, tractor, result, derivs, mod0, imgs, umodels,
                             rois, scales,
                             priors, sky, minFlux, justims0, subimgs,
@@ -106,10 +243,12 @@ class LsqrOptimizer(Optimizer):
 
             #logverb('forced phot: getting update with damp=', damping)
             #t0 = Time()
-            X = self.getUpdateDirection(tractor, derivs, damp=damping,
-                                        priors=priors,
-                                        scale_columns=False, chiImages=chis0,
-                                        shared_params=shared_params)
+            with profile_phase(tractor, 'matrix'):
+                X = self.getUpdateDirection(tractor, derivs, damp=damping,
+                                            priors=priors,
+                                            scale_columns=False,
+                                            chiImages=chis0,
+                                            shared_params=shared_params)
             if X is None or len(X) == 0:
                 print('Error getting update direction')
                 break
@@ -157,25 +296,26 @@ class LsqrOptimizer(Optimizer):
             alphaBest = None
             chiBest = None
 
-            for alpha in alphas:
-                #t0 = Time()
-                lnp, chis, ims = self._lnp_for_update(
-                    tractor,
-                    mod0, imgs, umodels, X, alpha, p0, rois, scales,
-                    p0sky, Xsky, priors, sky, minFlux)
-                logverb('Forced phot: stepped with alpha', alpha,
-                        'for lnp', lnp, ', dlnp', lnp - lnp0)
-                #logverb('Took', Time() - t0)
-                if lnp < (lnpBest - 1.):
-                    logverb('lnp', lnp, '< lnpBest-1', lnpBest - 1.)
-                    break
-                if not np.isfinite(lnp):
-                    break
-                if lnp > lnpBest:
-                    alphaBest = alpha
-                    lnpBest = lnp
-                    chiBest = chis
-                    imsBest = ims
+            with profile_phase(tractor, 'linesearch'):
+                for alpha in alphas:
+                    #t0 = Time()
+                    lnp, chis, ims = self._lnp_for_update(
+                        tractor,
+                        mod0, imgs, umodels, X, alpha, p0, rois, scales,
+                        p0sky, Xsky, priors, sky, minFlux)
+                    logverb('Forced phot: stepped with alpha', alpha,
+                            'for lnp', lnp, ', dlnp', lnp - lnp0)
+                    #logverb('Took', Time() - t0)
+                    if lnp < (lnpBest - 1.):
+                        logverb('lnp', lnp, '< lnpBest-1', lnpBest - 1.)
+                        break
+                    if not np.isfinite(lnp):
+                        break
+                    if lnp > lnpBest:
+                        alphaBest = alpha
+                        lnpBest = lnp
+                        chiBest = chis
+                        imsBest = ims
 
             if alphaBest is not None:
                 # Clamp fluxes up to zero
@@ -253,7 +393,16 @@ class LsqrOptimizer(Optimizer):
     def optimize(self, tractor, alphas=None, damp=0, priors=True,
                  scale_columns=True,
                  shared_params=True, variance=False, just_variance=False,
+                 linesearch='exact', solver=None,
                  **nil):
+        '''
+        *linesearch*: 'exact' to render the model for each step size
+        in turn; 'linear' to use the linearized model to choose the
+        step sizes to try (see Optimizer.tryUpdatesLinearized).
+
+        *solver*: 'lsqr' (the default) or 'cholesky'; see
+        getUpdateDirection.
+        '''
         #logverb(tractor.getName() + ': Finding derivs...')
         #t0 = Time()
         allderivs = tractor.getDerivs()
@@ -265,11 +414,12 @@ class LsqrOptimizer(Optimizer):
         #       print('patch mean', np.mean(p.patch))
         #logverb('Finding optimal update direction...')
         #t0 = Time()
-        X = self.getUpdateDirection(tractor, allderivs, damp=damp,
-                                    priors=priors,
-                                    scale_columns=scale_columns,
-                                    shared_params=shared_params,
-                                    variance=variance)
+        with profile_phase(tractor, 'matrix'):
+            X = self.getUpdateDirection(tractor, allderivs, damp=damp,
+                                        priors=priors,
+                                        scale_columns=scale_columns,
+                                        shared_params=shared_params,
+                                        variance=variance, solver=solver)
         #print('Update:', X)
         if X is None:
             # Failure
@@ -288,7 +438,14 @@ class LsqrOptimizer(Optimizer):
         #logverb('X: len', len(X), '; non-zero entries:', np.count_nonzero(X))
         logverb('Finding optimal step size...')
         #t0 = Time()
-        (dlogprob, alpha) = self.tryUpdates(tractor, X, alphas=alphas)
+        with profile_phase(tractor, 'linesearch'):
+            if linesearch == 'linear':
+                (dlogprob, alpha) = self.tryUpdatesLinearized(
+                    tractor, X, allderivs, alphas=alphas)
+            else:
+                assert(linesearch == 'exact')
+                (dlogprob, alpha) = self.tryUpdates(tractor, X,
+                                                    alphas=alphas)
         #tstep = Time() - t0
         #logverb('Finished opt2.')
         #logverb('  alpha =', alpha)
@@ -302,20 +459,39 @@ class LsqrOptimizer(Optimizer):
 
     def optimize_loop(self, tractor, dchisq=0., steps=50, **kwargs):
         R = {}
+        saved = 0
         for step in range(steps):
+            self.linesearch_stats = None
             dlnp, X, alpha = self.optimize(tractor, **kwargs)
+            if self.linesearch_stats is not None:
+                saved += self.linesearch_stats['renders_saved']
             # print('Opt step: dlnp', dlnp,
             #      ', '.join([str(src) for src in tractor.getCatalog()]))
             if dlnp <= dchisq:
                 break
-        R.update(steps=step)
+        R.update(steps=step, renders_saved=saved)
         return R
 
     def getUpdateDirection(self, tractor, allderivs, damp=0., priors=True,
                            scale_columns=True, scales_only=False,
                            chiImages=None, variance=False,
                            shared_params=True,
-                           get_A_matrix=False):
+                           get_A_matrix=False, solver=None):
+        #
+        # *solver*: 'lsqr' (the default) to build the sparse
+        # derivatives matrix and run scipy's LSQR; 'cholesky' to
+        # accumulate the normal equations directly from the derivative
+        # patches and solve them densely (see
+        # getUpdateDirectionCholesky).
+        #
+        if solver is None:
+            solver = 'lsqr'
+        if solver == 'cholesky' and not (scales_only or get_A_matrix):
+            return self.getUpdateDirectionCholesky(
+                tractor, allderivs, damp=damp, priors=priors,
+                scale_columns=scale_columns, chiImages=chiImages,
+                variance=variance, shared_params=shared_params)
+        assert(solver in ['lsqr', 'cholesky'])
         #
         # Returns: numpy array containing update direction.
         # If *variance* is True, return    (update,variance)
@@ -350,13 +526,10 @@ class LsqrOptimizer(Optimizer):
 
         if shared_params:
             # Find shared parameters
-            p0 = tractor.getParams()
-            tractor.setParams(np.arange(len(p0)))
-            p1 = tractor.getParams()
-            tractor.setParams(p0)
-            U, I = np.unique(p1, return_inverse=True)
-            logverb(len(p0), 'params;', len(U), 'unique')
-            paramindexmap = I
+            paramindexmap = tractor.getSharedParamMap()
+            logverb(len(paramindexmap), 'params;',
+                    paramindexmap.max() + 1 if len(paramindexmap) else 0,
+                    'unique')
             #print('paramindexmap:', paramindexmap)
             #print('p1:', p1)
 
@@ -614,8 +787,9 @@ class LsqrOptimizer(Optimizer):
         try:
             # lsqr can trigger floating-point errors
             oldsettings = np.seterr(all='print')
-            (X, istop, niters, r1norm, r2norm, anorm, acond,
-             arnorm, xnorm, lsqrvar) = lsqr(A, b, **lsqropts)
+            with profile_phase(tractor, 'solve'):
+                (X, istop, niters, r1norm, r2norm, anorm, acond,
+                 arnorm, xnorm, lsqrvar) = lsqr(A, b, **lsqropts)
         except ZeroDivisionError:
             print('ZeroDivisionError caught.  Returning zero.')
             bail = True
@@ -670,9 +844,405 @@ class LsqrOptimizer(Optimizer):
 
         return X
 
+    def getUpdateDirectionCholesky(self, tractor, allderivs, damp=0.,
+                                   priors=True, scale_columns=True,
+                                   chiImages=None, variance=False,
+                                   shared_params=True):
+        '''
+        Computes the update direction by solving the normal equations,
+
+            (A^T A + damp^2 I) x = A^T b
+
+        with a Cholesky decomposition.  A^T A and A^T b are
+        accumulated directly from the derivative Patches: each element
+        of A^T A is a dot product over the overlap of two patches, so
+        the (Npixels x Nparams) matrix A is never built.  This is much
+        cheaper than LSQR when there are few parameters and many
+        pixels.
+
+        Takes the same arguments, and returns the same results, as
+        getUpdateDirection (with the same column scaling, priors,
+        damping and shared-parameter handling).
+        '''
+        X = self.getNormalEquations(tractor, allderivs, priors=priors,
+                                    scale_columns=scale_columns,
+                                    chiImages=chiImages,
+                                    shared_params=shared_params)
+        if X is None or len(X) == 0:
+            return X
+        ATA, ATb, colscales, paramindexmap = X
+
+        # Solve only for the parameters that affect the likelihood;
+        # others get zero update (as with LSQR).
+        I = np.flatnonzero(np.diag(ATA) > 0)
+        if len(I) == 0:
+            return []
+        ATA = ATA[np.ix_(I, I)]
+        ATA[np.diag_indices(len(I))] += damp**2
+        logverb('Cholesky: %i cols (%i non-empty)' % (len(ATb), len(I)))
+        X = np.zeros(len(ATb))
+        with profile_phase(tractor, 'solve'):
+            X[I] = solve_normal_equations(ATA, ATb[I])
+        if not np.all(np.isfinite(X)):
+            return None
+        logverb('scaled  X=', X)
+
+        if shared_params:
+            # Unapply shared parameter map.
+            X = X[paramindexmap]
+        if scale_columns:
+            X[colscales > 0] /= colscales[colscales > 0]
+        logverb('  X=', X)
+
+        if variance:
+            var = (colscales**2).astype(np.float32)
+            if shared_params:
+                var = var[paramindexmap]
+            return X, 1./var
+        return X
+
+    def getNormalEquations(self, tractor, allderivs, priors=True,
+                           scale_columns=True, chiImages=None,
+                           shared_params=True, sparse=False):
+        '''
+        Builds the normal equations of the linearized least-squares
+        problem for the derivatives *allderivs*: returns (ATA, ATb,
+        colscales, paramindexmap), where *colscales* are the column
+        norms of A (the columns are divided by them if
+        *scale_columns*), and, if *shared_params*, the rows and
+        columns of ATA and ATb are those of the unique parameters,
+        and parameter *i* is unique parameter *paramindexmap[i]*.
+
+        If *sparse*, ATA is a scipy.sparse CSC matrix, built from the
+        (pixel x parameter) matrix A of each image, so that only the
+        elements of overlapping derivatives are stored.
+
+        Returns [] if there are no non-zero derivatives, or None if
+        any are infinite.
+        '''
+        Ncols = len(allderivs)
+        paramindexmap = None
+        if shared_params:
+            # Find shared parameters
+            paramindexmap = tractor.getSharedParamMap()
+            Nshared = paramindexmap.max() + 1 if len(paramindexmap) else 0
+            logverb(len(paramindexmap), 'params;', Nshared, 'unique')
+
+        chimap = {}
+        if chiImages is not None:
+            for img, chi in zip(tractor.getImages(), chiImages):
+                chimap[img] = chi
+
+        # For each image, lists of the columns and extents of the
+        # (clipped) derivative patches, and their A matrix elements
+        # (derivative * inverse-error).
+        imgblocks = {}
+        colscales = np.zeros(Ncols)
+        for col, param in enumerate(allderivs):
+            blocks = []
+            for deriv, img in param:
+                (H, W) = img.shape
+                deriv.clipTo(W, H)
+                if deriv.patch is None or deriv.patch.size == 0:
+                    continue
+                slc = deriv.getSlice(img)
+                vals = deriv.patch * img.getInvError()[slc]
+                blocks.append((img, deriv.getExtent(), vals))
+            if len(blocks) == 0:
+                continue
+            mx = max([np.max(np.abs(vals)) for img, ext, vals in blocks])
+            if not np.isfinite(mx):
+                print('Warning: infinite derivatives; bailing out')
+                return None
+            if mx == 0:
+                continue
+            # MAGIC number: near-zero matrix elements -> 0, as in
+            # getUpdateDirection.
+            FACTOR = 1.e-10
+            scale = 0.
+            for img, ext, vals in blocks:
+                vals[np.abs(vals) <= (FACTOR * mx)] = 0.
+                scale += np.sum(vals**2)
+            scale = np.sqrt(scale)
+            colscales[col] = scale
+            for img, ext, vals in blocks:
+                if scale_columns:
+                    vals = vals / scale
+                imgblocks.setdefault(img, []).append((col, ext, vals))
+
+        if len(imgblocks) == 0:
+            logverb('No non-zero derivatives')
+            return []
+
+        if sparse:
+            from scipy.sparse import csc_matrix
+            ATA = csc_matrix((Ncols, Ncols))
+        else:
+            ATA = np.zeros((Ncols, Ncols))
+        ATb = np.zeros(Ncols)
+        for img, blocks in imgblocks.items():
+            chi = chimap.get(img, None)
+            if chi is None:
+                chi = tractor.getChiImage(img=img)
+            assert(np.all(np.isfinite(chi)))
+            if sparse:
+                A = _sparse_derivs_matrix(img.shape, blocks, Ncols)
+                ATA = ATA + A.T.dot(A)
+                ATb += A.T.dot(chi.ravel().astype(np.float64))
+                continue
+            cols = np.array([col for col, ext, vals in blocks])
+            ext = np.array([ext for col, ext, vals in blocks])
+            x0, x1, y0, y1 = [ext[:, i] for i in range(4)]
+            for i, (ci, (xi0, xi1, yi0, yi1), vi) in enumerate(blocks):
+                ATb[ci] += np.sum(vi * chi[yi0:yi1, xi0:xi1])
+                # Patches (including this one) that overlap this one
+                ox0 = np.maximum(x0[i:], xi0)
+                ox1 = np.minimum(x1[i:], xi1)
+                oy0 = np.maximum(y0[i:], yi0)
+                oy1 = np.minimum(y1[i:], yi1)
+                J = np.flatnonzero((ox0 < ox1) * (oy0 < oy1))
+                for j in J:
+                    cj = cols[i + j]
+                    vj = blocks[i + j][2]
+                    xj0, yj0 = x0[i + j], y0[i + j]
+                    d = np.sum(vi[oy0[j] - yi0: oy1[j] - yi0,
+                                  ox0[j] - xi0: ox1[j] - xi0] *
+                               vj[oy0[j] - yj0: oy1[j] - yj0,
+                                  ox0[j] - xj0: ox1[j] - xj0])
+                    ATA[ci, cj] += d
+                    if j > 0:
+                        ATA[cj, ci] += d
+
+        if priors:
+            X = tractor.getLogPriorDerivatives()
+            if X is not None:
+                rA, cA, vA, pb, mub = X
+                nr = listmax(rA, -1) + 1
+                prows, pcols, pvals = [], [], []
+                for ri, ci, vi in zip(rA, cA, vA):
+                    if scale_columns and colscales[ci] > 0:
+                        vi = np.array(vi) / colscales[ci]
+                    ri = np.atleast_1d(ri)
+                    prows.append(ri)
+                    pcols.append(np.zeros(len(ri), int) + ci)
+                    pvals.append(np.zeros(len(ri)) + vi)
+                pb = np.hstack(pb)
+                if sparse:
+                    from scipy.sparse import csc_matrix
+                    P = csc_matrix((np.hstack(pvals), (np.hstack(prows),
+                                                       np.hstack(pcols))),
+                                   shape=(nr, Ncols))
+                    ATA = ATA + P.T.dot(P)
+                    ATb += P.T.dot(pb)
+                else:
+                    P = np.zeros((nr, Ncols))
+                    np.add.at(P, (np.hstack(prows), np.hstack(pcols)),
+                              np.hstack(pvals))
+                    ATA += np.dot(P.T, P)
+                    ATb += np.dot(P.T, pb)
+
+        if shared_params:
+            ATA, ATb = reduce_shared_params(ATA, ATb, paramindexmap, Nshared)
+
+        return ATA, ATb, colscales, paramindexmap
+
     # def getParameterScales(self):
     #     print(self.getName()+': Finding derivs...')
     #     allderivs = self.getDerivs()
     #     print('Finding column scales...')
     #     s = self.getUpdateDirection(allderivs, scales_only=True)
     #     return s
+
+
+def reduce_shared_params(ATA, ATb, paramindexmap, Nshared):
+    '''
+    Applies the shared-parameter map to the normal equations ATA x =
+    ATb: parameter *i* is unique parameter *paramindexmap[i]*, so the
+    rows and columns of the parameters that are the same are summed.
+    Returns the (Nshared x Nshared) ATA and (Nshared) ATb; ATA may be
+    a numpy array or a scipy.sparse matrix.
+    '''
+    I = paramindexmap
+    N = len(I)
+    if Nshared == N and np.all(I == np.arange(N)):
+        # Nothing is shared.
+        return ATA, ATb
+    if not isinstance(ATA, np.ndarray):
+        from scipy.sparse import csc_matrix
+        ATA = ATA.tocoo()
+        # (duplicate elements are summed)
+        ATAs = csc_matrix((ATA.data, (I[ATA.row], I[ATA.col])),
+                          shape=(Nshared, Nshared))
+        return ATAs, np.bincount(I, weights=ATb, minlength=Nshared)
+    if Nshared == N:
+        ATAs = np.empty_like(ATA)
+        ATAs[np.ix_(I, I)] = ATA
+        ATbs = np.empty_like(ATb)
+        ATbs[I] = ATb
+        return ATAs, ATbs
+    ATAs = np.zeros((Nshared, Nshared))
+    np.add.at(ATAs, (I[:, np.newaxis], I[np.newaxis, :]), ATA)
+    return ATAs, np.bincount(I, weights=ATb, minlength=Nshared)
+
+
+def _sparse_derivs_matrix(shape, blocks, Ncols):
+    # The (H*W x Ncols) scipy.sparse CSC matrix of an image's
+    # derivative *blocks* (column, extent, values), as built in
+    # getNormalEquations; as for UnitFluxModels.getMatrix, only
+    # nonzero pixels are stored.
+    from scipy.sparse import csc_matrix
+    H, W = shape
+    rows, cols, vals = [], [], []
+    for col, (x0, x1, y0, y1), v in blocks:
+        I = np.flatnonzero(v)
+        y, x = np.unravel_index(I, v.shape)
+        rows.append((y + y0) * W + (x + x0))
+        cols.append(np.zeros(len(I), int) + col)
+        vals.append(v.flat[I])
+    return csc_matrix((np.hstack(vals).astype(np.float64),
+                       (np.hstack(rows), np.hstack(cols))),
+                      shape=(H * W, Ncols))
+
+
+def solve_normal_equations(ATA, ATb):
+    '''
+    Solves the normal equations ATA x = ATb (with ATA symmetric and
+    positive semi-definite) by Cholesky decomposition, falling back
+    to the minimum-norm least-squares solution (like LSQR) if ATA is
+    singular or ill-conditioned.
+    '''
+    from scipy.linalg import cho_factor, cho_solve
+    # MAGIC number: relative eigenvalue of A^T A below which
+    # parameter combinations are treated as degenerate.
+    RCOND = 1e-9
+    try:
+        C = cho_factor(ATA)
+        # With (nearly) degenerate parameters, Cholesky will happily
+        # return a huge update.
+        dC = np.diag(C[0])**2
+        if dC.min() < RCOND * dC.max():
+            raise np.linalg.LinAlgError('ill-conditioned')
+        return cho_solve(C, ATb)
+    except np.linalg.LinAlgError:
+        logverb('Cholesky decomposition failed; using least-squares')
+        return np.linalg.lstsq(ATA, ATb, rcond=RCOND)[0]
+
+
+def solve_bounded_normal_equations(ATA, ATb, lower):
+    '''
+    Solves the least-squares problem with normal equations ATA x =
+    ATb, subject to the bounds x >= *lower* (whose elements can be
+    -inf for unbounded parameters), using the active-set method of
+    Lawson & Hanson (as for non-negative least squares).
+
+    When the unconstrained solution satisfies the bounds, it is
+    returned directly.
+    '''
+    n = len(ATb)
+    x = solve_normal_equations(ATA, ATb)
+    bounded = np.isfinite(lower)
+    if np.all(x[bounded] >= lower[bounded]):
+        return x
+
+    def solve_free(free, x):
+        # Minimize over the free parameters, holding the rest fixed.
+        F = np.flatnonzero(free)
+        A = np.flatnonzero(np.logical_not(free))
+        z = x.copy()
+        if len(F):
+            z[F] = solve_normal_equations(
+                ATA[np.ix_(F, F)], ATb[F] - np.dot(ATA[np.ix_(F, A)], x[A]))
+        return z
+
+    # Start with all the bounded parameters at their bounds.
+    free = np.logical_not(bounded)
+    x = np.where(bounded, lower, 0.)
+    x = solve_free(free, x)
+    # MAGIC number: gradient below which a parameter at its bound is
+    # considered optimal.
+    tol = 1e-10 * max(1., np.max(np.abs(ATb)))
+    niter = 0
+    while niter < 3 * n:
+        # (negative) gradient
+        w = ATb - np.dot(ATA, x)
+        cand = np.logical_not(free) * (w > tol)
+        if not np.any(cand):
+            break
+        free[np.argmax(np.where(cand, w, -np.inf))] = True
+        while niter < 3 * n:
+            niter += 1
+            z = solve_free(free, x)
+            bad = free * bounded * (z < lower)
+            if not np.any(bad):
+                x = z
+                break
+            # Step as far towards z as possible, and fix the
+            # parameters that hit their bounds.
+            alpha = np.min((x[bad] - lower[bad]) / (x[bad] - z[bad]))
+            x = x + alpha * (z - x)
+            hit = free * bounded * (x <= lower)
+            hit[np.flatnonzero(bad)[np.argmin(
+                (x[bad] - lower[bad]))]] = True
+            x[hit] = lower[hit]
+            free[hit] = False
+    return np.maximum(x, lower)
+
+
+def solve_sparse_bounded_normal_equations(ATA, ATb, lower, maxdense=1000):
+    '''
+    Solves the normal equations ATA x = ATb, with ATA a scipy.sparse
+    matrix, subject to the bounds x >= *lower* (as in
+    solve_bounded_normal_equations).
+
+    The parameters fall into groups that ATA does not couple (eg,
+    groups of overlapping sources), which are solved separately:
+    those of up to *maxdense* parameters densely, with
+    solve_bounded_normal_equations; larger ones with a sparse LU
+    decomposition (falling back to LSQR if ATA is singular) and, if
+    that solution violates the bounds, with L-BFGS-B.
+    '''
+    from scipy.sparse.csgraph import connected_components
+    ATA = ATA.tocsc()
+    n = len(ATb)
+    x = np.zeros(n)
+    if n == 0:
+        return x
+    ngroups, labels = connected_components(ATA, directed=False)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(ngroups + 1))
+    for g in range(ngroups):
+        I = order[bounds[g]: bounds[g + 1]]
+        if len(I) <= maxdense:
+            x[I] = solve_bounded_normal_equations(
+                ATA[I, :][:, I].toarray(), ATb[I], lower[I])
+        else:
+            x[I] = _solve_large_sparse_block(ATA[I, :][:, I], ATb[I],
+                                             lower[I])
+    return x
+
+
+def _solve_large_sparse_block(ATA, ATb, lower):
+    from scipy.sparse.linalg import splu, lsqr
+    x = None
+    try:
+        x = splu(ATA.tocsc()).solve(ATb)
+    except RuntimeError:
+        # singular
+        pass
+    if x is None or not np.all(np.isfinite(x)):
+        logverb('Sparse LU decomposition failed; using LSQR')
+        x = lsqr(ATA, ATb, atol=1e-12, btol=1e-12)[0]
+    bounded = np.isfinite(lower)
+    if np.all(x[bounded] >= lower[bounded]):
+        return x
+
+    from scipy.optimize import minimize
+
+    def f(x):
+        g = ATA.dot(x)
+        return 0.5 * np.dot(x, g) - np.dot(ATb, x), g - ATb
+    R = minimize(f, np.maximum(x, lower), jac=True, method='L-BFGS-B',
+                 bounds=[(lo if b else None, None)
+                         for lo, b in zip(lower, bounded)],
+                 options=dict(maxiter=10000, ftol=1e-15, gtol=1e-12))
+    return np.maximum(R.x, lower)
@@ -523,6 +523,292 @@ bailout:
     return rtn;
 }
 
+// Like c_gauss_2d_grid, but also computes the derivatives of the
+// mixture with respect to its center position (fx,fy) and with
+// respect to P parameters that change the variances of the
+// components, given d(var)/d(param) for each component:
+//
+// ob_dvar: P x K x 2 x 2
+// ob_xderiv, ob_yderiv: NY x NX
+// ob_dresult: P x NY x NX
+static int c_gauss_2d_grid_derivs(int x0, int x1, int y0, int y1,
+                                  double fx, double fy,
+                                  PyObject* ob_amp, PyObject* ob_mean,
+                                  PyObject* ob_var, PyObject* ob_dvar,
+                                  PyObject* ob_result,
+                                  PyObject* ob_xderiv, PyObject* ob_yderiv,
+                                  PyObject* ob_dresult) {
+    int i, K, k, P, p;
+    const int D = 2;
+    double *amp, *mean, *var, *dvar, *result, *xderiv, *yderiv, *dresult;
+    double tpd;
+    int req = NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ALIGNED;
+    int reqout = req | NPY_ARRAY_WRITEABLE | NPY_ARRAY_WRITEBACKIFCOPY;
+    PyArray_Descr* dtype = PyArray_DescrFromType(NPY_DOUBLE);
+    PyArrayObject *np_amp=NULL, *np_mean=NULL, *np_var=NULL, *np_result=NULL,
+        *np_xderiv=NULL, *np_yderiv=NULL, *np_dvar=NULL, *np_dresult=NULL;
+    int rtn = -1;
+    int NX = x1 - x0;
+    int NY = y1 - y0;
+
+    tpd = pow(2.*M_PI, D);
+
+    if (get_np(ob_amp, ob_mean, ob_var, ob_result, ob_xderiv, ob_yderiv,
+               Py_None, NX, NY, &K, &np_amp, &np_mean, &np_var, &np_result,
+               &np_xderiv, &np_yderiv, NULL, NULL))
+        goto bailout;
+    if (!np_xderiv || !np_yderiv) {
+        ERR("c_gauss_2d_grid_derivs: xderiv and yderiv are required\n");
+        goto bailout;
+    }
+    Py_INCREF(dtype);
+    np_dvar    = (PyArrayObject*)PyArray_FromAny(ob_dvar, dtype, 4, 4, req, NULL);
+    np_dresult = (PyArrayObject*)PyArray_FromAny(ob_dresult, dtype, 3, 3,
+                                                 reqout, NULL);
+    dtype = NULL;
+    if (!np_dvar || !np_dresult) {
+        ERR("c_gauss_2d_grid_derivs: dvar or dresult wasn't the type expected\n");
+        goto bailout;
+    }
+    P = (int)PyArray_DIM(np_dvar, 0);
+    if ((PyArray_DIM(np_dvar, 1) != K) || (PyArray_DIM(np_dvar, 2) != D) ||
+        (PyArray_DIM(np_dvar, 3) != D) ||
+        (PyArray_DIM(np_dresult, 0) != P) ||
+        (PyArray_DIM(np_dresult, 1) != NY) ||
+        (PyArray_DIM(np_dresult, 2) != NX)) {
+        ERR("c_gauss_2d_grid_derivs: dvar must be P x K x 2 x 2, "
+            "dresult P x NY x NX\n");
+        goto bailout;
+    }
+
+    amp     = PyArray_DATA(np_amp);
+    mean    = PyArray_DATA(np_mean);
+    var     = PyArray_DATA(np_var);
+    dvar    = PyArray_DATA(np_dvar);
+    result  = PyArray_DATA(np_result);
+    xderiv  = PyArray_DATA(np_xderiv);
+    yderiv  = PyArray_DATA(np_yderiv);
+    dresult = PyArray_DATA(np_dresult);
+
+    {
+        double scale[K];
+        double ivar[K*3];
+        // For each param and component: ivar * dvar * ivar (3 terms,
+        // with the cross term doubled) and trace(ivar * dvar).
+        double B[(P ? P : 1)*K*3];
+        double tr[(P ? P : 1)*K];
+        int ix,iy;
+        int NP = NX*NY;
+
+        for (k=0; k<K; k++) {
+            double* V = var + k*D*D;
+            double* I = ivar + k*3;
+            double det;
+            double i00, i01, i11;
+            det = V[0]*V[3] - V[1]*V[2];
+            I[0] =  V[3] / det;
+            I[1] = -(V[1]+V[2]) / det;
+            I[2] =  V[0] / det;
+            scale[k] = amp[k] / sqrt(tpd * det);
+            i00 = I[0];
+            i01 = I[1] * 0.5;
+            i11 = I[2];
+            for (p=0; p<P; p++) {
+                double* dV = dvar + (p*K + k)*D*D;
+                double d00 = dV[0];
+                double d01 = 0.5 * (dV[1] + dV[2]);
+                double d11 = dV[3];
+                // M = I dV
+                double m00 = i00*d00 + i01*d01;
+                double m01 = i00*d01 + i01*d11;
+                double m10 = i01*d00 + i11*d01;
+                double m11 = i01*d01 + i11*d11;
+                double* b = B + (p*K + k)*3;
+                // M I
+                b[0] = m00*i00 + m01*i01;
+                b[1] = 2. * (m00*i01 + m01*i11);
+                b[2] = m10*i01 + m11*i11;
+                tr[p*K + k] = m00 + m11;
+            }
+        }
+
+        i = 0;
+        for (iy=y0; iy<y1; iy++) {
+            for (ix=x0; ix<x1; ix++) {
+                for (k=0; k<K; k++) {
+                    double dsq;
+                    double dx,dy;
+                    double g;
+                    double* I = ivar + k*3;
+                    dx = ix - fx - mean[k*D+0];
+                    dy = iy - fy - mean[k*D+1];
+                    dsq = I[0] * dx * dx + I[1] * dx * dy + I[2] * dy * dy;
+                    if (dsq >= 100)
+                        continue;
+                    g = scale[k] * exp(-0.5 * dsq);
+                    result[i] += g;
+                    // d/d(fx) = g * (ivar * d)_x
+                    xderiv[i] += g * (I[0] * dx + 0.5 * I[1] * dy);
+                    yderiv[i] += g * (0.5 * I[1] * dx + I[2] * dy);
+                    for (p=0; p<P; p++) {
+                        double* b = B + (p*K + k)*3;
+                        dresult[p*NP + i] += g * 0.5 *
+                            (b[0] * dx * dx + b[1] * dx * dy + b[2] * dy * dy
+                             - tr[p*K + k]);
+                    }
+                }
+                i++;
+            }
+        }
+        rtn = 0;
+    }
+
+    if (finish_np(np_result, np_xderiv, np_yderiv))
+        rtn = -1;
+    if (finish_np(np_dresult, NULL, NULL))
+        rtn = -1;
+
+bailout:
+    Py_XDECREF(dtype);
+    Py_XDECREF(np_amp);
+    Py_XDECREF(np_mean);
+    Py_XDECREF(np_var);
+    Py_XDECREF(np_dvar);
+    Py_XDECREF(np_result);
+    Py_XDECREF(np_xderiv);
+    Py_XDECREF(np_yderiv);
+    Py_XDECREF(np_dresult);
+    return rtn;
+}
+
+// Evaluates N mixtures of K Gaussians, each over its own rectangular
+// extent, adding them into the (float32 or float64) image "ob_result".
+// ob_extents: int32, N x 4: x0,x1,y0,y1 (must be within the image)
+// ob_amp: N x K; ob_mean: N x K x 2; ob_var: N x K x 2 x 2
+// (zero-amplitude components are skipped, so mixtures can be padded)
+static int c_gauss_2d_batch(PyObject* ob_extents, PyObject* ob_amp,
+                            PyObject* ob_mean, PyObject* ob_var,
+                            PyObject* ob_result) {
+    const int D = 2;
+    int req = NPY_ARRAY_C_CONTIGUOUS | NPY_ARRAY_ALIGNED;
+    int reqout = req | NPY_ARRAY_WRITEABLE | NPY_ARRAY_WRITEBACKIFCOPY;
+    PyArrayObject *np_ext=NULL, *np_amp=NULL, *np_mean=NULL, *np_var=NULL,
+        *np_result=NULL;
+    PyArray_Descr* itype = PyArray_DescrFromType(NPY_INT32);
+    PyArray_Descr* dtype = PyArray_DescrFromType(NPY_DOUBLE);
+    PyArray_Descr* rtype;
+    int isfloat;
+    int N, K, W, H;
+    int n, k;
+    int32_t *ext;
+    double *amp, *mean, *var;
+    double tpd;
+    int rtn = -1;
+
+    isfloat = !(PyArray_Check(ob_result) &&
+                PyArray_TYPE((PyArrayObject*)ob_result) == NPY_DOUBLE);
+    rtype = PyArray_DescrFromType(isfloat ? NPY_FLOAT32 : NPY_DOUBLE);
+
+    Py_INCREF(dtype);
+    Py_INCREF(dtype);
+    np_ext    = (PyArrayObject*)PyArray_FromAny(ob_extents, itype, 2, 2, req, NULL);
+    np_amp    = (PyArrayObject*)PyArray_FromAny(ob_amp,  dtype, 2, 2, req, NULL);
+    np_mean   = (PyArrayObject*)PyArray_FromAny(ob_mean, dtype, 3, 3, req, NULL);
+    np_var    = (PyArrayObject*)PyArray_FromAny(ob_var,  dtype, 4, 4, req, NULL);
+    np_result = (PyArrayObject*)PyArray_FromAny(ob_result, rtype, 2, 2, reqout, NULL);
+    if (!np_ext || !np_amp || !np_mean || !np_var || !np_result) {
+        ERR("c_gauss_2d_batch: arrays weren't the type expected\n");
+        goto bailout;
+    }
+    N = (int)PyArray_DIM(np_amp, 0);
+    K = (int)PyArray_DIM(np_amp, 1);
+    H = (int)PyArray_DIM(np_result, 0);
+    W = (int)PyArray_DIM(np_result, 1);
+    if ((PyArray_DIM(np_ext, 0) != N) || (PyArray_DIM(np_ext, 1) != 4) ||
+        (PyArray_DIM(np_mean, 0) != N) || (PyArray_DIM(np_mean, 1) != K) ||
+        (PyArray_DIM(np_mean, 2) != D) ||
+        (PyArray_DIM(np_var, 0) != N) || (PyArray_DIM(np_var, 1) != K) ||
+        (PyArray_DIM(np_var, 2) != D) || (PyArray_DIM(np_var, 3) != D)) {
+        ERR("c_gauss_2d_batch: extents must be N x 4, amp N x K, "
+            "mean N x K x 2, var N x K x 2 x 2\n");
+        goto bailout;
+    }
+    ext  = PyArray_DATA(np_ext);
+    amp  = PyArray_DATA(np_amp);
+    mean = PyArray_DATA(np_mean);
+    var  = PyArray_DATA(np_var);
+    tpd = pow(2.*M_PI, D);
+
+    {
+        float*  fresult = isfloat ? PyArray_DATA(np_result) : NULL;
+        double* dresult = isfloat ? NULL : PyArray_DATA(np_result);
+        double scale[K];
+        double ivar[K*3];
+        double mx[K], my[K];
+
+        for (n=0; n<N; n++) {
+            int x0 = ext[n*4 + 0];
+            int x1 = ext[n*4 + 1];
+            int y0 = ext[n*4 + 2];
+            int y1 = ext[n*4 + 3];
+            int ix, iy, nk;
+            if (x0 < 0 || y0 < 0 || x1 > W || y1 > H) {
+                ERR("c_gauss_2d_batch: extent %i is outside the image\n", n);
+                goto bailout;
+            }
+            // Collect the non-zero components.
+            nk = 0;
+            for (k=0; k<K; k++) {
+                double* V = var + (n*K + k)*D*D;
+                double* I = ivar + nk*3;
+                double det;
+                if (amp[n*K + k] == 0.)
+                    continue;
+                det = V[0]*V[3] - V[1]*V[2];
+                I[0] =  V[3] / det;
+                I[1] = -(V[1]+V[2]) / det;
+                I[2] =  V[0] / det;
+                scale[nk] = amp[n*K + k] / sqrt(tpd * det);
+                mx[nk] = mean[(n*K + k)*D + 0];
+                my[nk] = mean[(n*K + k)*D + 1];
+                nk++;
+            }
+            for (iy=y0; iy<y1; iy++) {
+                for (ix=x0; ix<x1; ix++) {
+                    double v = 0.;
+                    for (k=0; k<nk; k++) {
+                        double dsq;
+                        double dx,dy;
+                        dx = ix - mx[k];
+                        dy = iy - my[k];
+                        dsq = ivar[k*3 + 0] * dx * dx
+                            + ivar[k*3 + 1] * dx * dy
+                            + ivar[k*3 + 2] * dy * dy;
+                        if (dsq >= 100)
+                            continue;
+                        v += scale[k] * exp(-0.5 * dsq);
+                    }
+                    if (isfloat)
+                        fresult[iy*W + ix] += v;
+                    else
+                        dresult[iy*W + ix] += v;
+                }
+            }
+        }
+        rtn = 0;
+    }
+
+ bailout:
+    if (np_result && finish_np(np_result, NULL, NULL))
+        rtn = -1;
+    Py_XDECREF(np_ext);
+    Py_XDECREF(np_amp);
+    Py_XDECREF(np_mean);
+    Py_XDECREF(np_var);
+    Py_XDECREF(np_result);
+    return rtn;
+}
+
 static int c_gauss_2d_approx(int x0, int x1, int y0, int y1,
                              double fx, double fy,
                              double minval,
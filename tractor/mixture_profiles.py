@@ -305,6 +305,37 @@ class MixtureOfGaussians(object):
             raise RuntimeError('c_gauss_2d_grid failed')
         return Patch(x0, y0, result)
 
+    def evaluate_grid_derivs(self, x0, x1, y0, y1, cx, cy, dvar):
+        '''
+        Like evaluate_grid, but also computes derivatives.
+
+        [x0,x1): (int) X values to evaluate
+        [y0,y1): (int) Y values to evaluate
+        (cx,cy): (float) pixel center of the MoG
+        dvar: numpy array of shape (P, K, D, D): the derivatives of
+              this mixture's variances with respect to P parameters.
+
+        Returns (patch, xderiv, yderiv, [dpatch, ...]): Patch objects for
+        the mixture and its derivatives with respect to cx, cy, and
+        each of the P parameters.
+        '''
+        from tractor.mix import c_gauss_2d_grid_derivs
+        assert(self.D == 2)
+        dvar = np.ascontiguousarray(dvar, dtype=float)
+        assert(dvar.shape[1:] == (self.K, self.D, self.D))
+        result = np.zeros((y1 - y0, x1 - x0))
+        xderiv = np.zeros_like(result)
+        yderiv = np.zeros_like(result)
+        dresult = np.zeros((len(dvar), y1 - y0, x1 - x0))
+        rtn = c_gauss_2d_grid_derivs(int(x0), int(x1), int(y0), int(y1),
+                                     float(cx), float(cy),
+                                     self.amp, self.mean, self.var, dvar,
+                                     result, xderiv, yderiv, dresult)
+        if rtn == -1:
+            raise RuntimeError('c_gauss_2d_grid_derivs failed')
+        return (Patch(x0, y0, result), Patch(x0, y0, xderiv),
+                Patch(x0, y0, yderiv), [Patch(x0, y0, d) for d in dresult])
+
     def evaluate_grid_approx(self, x0, x1, y0, y1, cx, cy, minval):
         '''
         minval: small value at which to stop evaluating
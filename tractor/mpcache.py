@@ -1,8 +1,391 @@
+'''
+`mpcache.py`
+============
+
+A cache shared between processes, for use with multiprocessing pools.
+
+SharedCache keeps its entries in a block of shared memory
+(multiprocessing.shared_memory), so a Pool worker that is handed the
+cache (it pickles to just the name of the block) reads entries that
+any other process has put, without any inter-process communication:
+the numpy arrays in a value (eg, the pixels of a unit-flux Patch, or
+a PSF's FFT) are stored as out-of-band pickle buffers and come back
+as arrays backed by the shared block.  Lookups take no locks; puts
+take a (file) lock.
+
+The block holds a fixed-size hash table of entries and a ring buffer
+of data, *maxbytes* long; new entries overwrite the oldest ones, so
+the total size of the cache is bounded across all processes.
+
+SharedCache needs Python 3.8 (for multiprocessing.shared_memory and
+pickle protocol 5).  On older Pythons, createCache() falls back to the
+old CacheManager, which serves a Cache through a multiprocessing
+Manager proxy, making every get and put a pickled round-trip to the
+manager process.
+'''
 from __future__ import print_function
-from multiprocessing import Manager
+import os
+import threading
+import pickle
+import hashlib
 from multiprocessing.managers import BaseManager
-#from .cache import Cache
-from cache import Cache
+
+import numpy as np
+
+from tractor.cache import Cache, key_class
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+# index entry: sequence number (odd while being written), 128-bit key
+# digest, start of the data (position in the ring buffer, not
+# wrapped), and size of the data (zero for an unused entry).
+_entry_dtype = np.dtype([('seq', np.uint64), ('k0', np.uint64),
+                         ('k1', np.uint64), ('pos', np.uint64),
+                         ('size', np.uint64)])
+
+_ALIGN = 64
+
+
+def _aligned(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class SharedCache(object):
+    '''
+    A cache in shared memory, usable from any process it is pickled
+    to, with a byte budget (*maxbytes*) over all processes and room
+    for at most *nslots* entries.
+
+    Keys are hashed (with a 128-bit digest of their pickle), so they
+    must pickle identically in every process; tuples of hashkey()s
+    are typical.  Values can be anything picklable; those that are
+    larger than *maxbytes* are not cached.
+
+    If *copy* is False, arrays in the values returned by get() are
+    read-only views of the shared memory rather than copies.  Such
+    a view is valid until the ring buffer wraps around to it, ie,
+    until another *maxbytes* of entries have been put, so it should
+    be used immediately, not kept.
+
+    The creating process owns the shared memory, and releases it in
+    close() (or when the cache is garbage-collected).  Hit, miss and
+    eviction statistics are per process.
+    '''
+
+    # number of index entries probed for each key
+    maxprobe = 16
+
+    def __init__(self, maxbytes=256 * 1024 * 1024, nslots=65536, copy=True,
+                 name=None, lockfile=None):
+        if shared_memory is None:
+            raise RuntimeError('SharedCache requires Python 3.8 or later')
+        self.copy = copy
+        self.owner = name is None
+        if self.owner:
+            import tempfile
+            nslots = max(int(nslots), self.maxprobe)
+            maxbytes = _aligned(int(maxbytes))
+            off = _aligned(8 * 8 + nslots * _entry_dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=off + maxbytes)
+            hdr = np.ndarray(8, np.uint64, buffer=self.shm.buf)
+            hdr[:] = 0
+            hdr[:3] = [nslots, maxbytes, off]
+            fd, lockfile = tempfile.mkstemp(prefix='tractor-cache-',
+                                            suffix='.lock')
+            os.close(fd)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Attaching registers the block with this process's
+            # resource tracker, which would unlink it (warning of a
+            # "leak") when this process exits; only the owner may.
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name = self.shm.name
+        self.lockfile = lockfile
+
+        self.hdr = np.ndarray(8, np.uint64, buffer=self.shm.buf)
+        self.nslots, self.maxbytes, off = [int(x) for x in self.hdr[:3]]
+        self.index = np.ndarray(self.nslots, _entry_dtype,
+                                buffer=self.shm.buf, offset=8 * 8)
+        self.data = self.shm.buf[off: off + self.maxbytes]
+        self.rodata = self.data.toreadonly()
+
+        self.tlock = threading.Lock()
+        self.lockfd = None
+        self._clearStats()
+
+    def __getstate__(self):
+        return dict(name=self.name, lockfile=self.lockfile, copy=self.copy)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        '''
+        Detaches from the shared memory; in the creating process,
+        also releases it.
+        '''
+        if getattr(self, 'shm', None) is None:
+            return
+        if self.lockfd is not None:
+            os.close(self.lockfd)
+            self.lockfd = None
+        # views must be released before the memory can be (but values
+        # returned by get() with copy=False may still be using it)
+        del self.hdr
+        del self.index
+        try:
+            self.data.release()
+            self.rodata.release()
+            self.shm.close()
+        except BufferError:
+            pass
+        del self.data
+        del self.rodata
+        if self.owner:
+            # a forked process shares our resource tracker, so its
+            # unregistering (above) may have dropped our registration;
+            # restore it so that unlink() can remove it.
+            resource_tracker.register(self.shm._name, 'shared_memory')
+            self.shm.unlink()
+            try:
+                os.remove(self.lockfile)
+            except OSError:
+                pass
+        self.shm = None
+
+    def _clearStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key class -> [hits, misses, evictions]
+        self.stats = {}
+
+    def _count(self, key, i):
+        st = self.stats.get(key_class(key), None)
+        if st is None:
+            st = self.stats[key_class(key)] = [0, 0, 0]
+        st[i] += 1
+
+    def _lock(self):
+        import fcntl
+        self.tlock.acquire()
+        if self.lockfd is None:
+            self.lockfd = os.open(self.lockfile, os.O_RDWR)
+        fcntl.flock(self.lockfd, fcntl.LOCK_EX)
+
+    def _unlock(self):
+        import fcntl
+        fcntl.flock(self.lockfd, fcntl.LOCK_UN)
+        self.tlock.release()
+
+    def _digest(self, key):
+        d = hashlib.blake2b(pickle.dumps(key, protocol=2), digest_size=16)
+        k0, k1 = np.frombuffer(d.digest(), np.uint64)
+        return k0, k1
+
+    def _slots(self, k0):
+        i0 = int(k0) % self.nslots
+        return (i0 + np.arange(self.maxprobe)) % self.nslots
+
+    def _isLive(self, pos):
+        # an entry's data are intact until the ring buffer wraps
+        # around to them.
+        return int(self.hdr[3]) <= pos + self.maxbytes
+
+    def _lookup(self, key, copy):
+        # Returns the value for *key*, or raises KeyError.  Takes no
+        # lock: each index entry is read between two reads of its
+        # sequence number, and the data are checked not to have been
+        # overwritten after they have been read.
+        k0, k1 = self._digest(key)
+        for i in self._slots(k0):
+            e = self.index[i]
+            seq = int(e['seq'])
+            if seq & 1:
+                # being written
+                continue
+            size = int(e['size'])
+            if size == 0 or e['k0'] != k0 or e['k1'] != k1:
+                continue
+            pos = int(e['pos'])
+            if not self._isLive(pos):
+                continue
+            try:
+                val = self._unpack(pos % self.maxbytes, copy)
+            except Exception:
+                # overwritten while we were reading it
+                continue
+            if int(self.index[i]['seq']) != seq or not self._isLive(pos):
+                continue
+            return val
+        raise KeyError(key)
+
+    def _unpack(self, off, copy):
+        data = self.rodata
+        lens = np.frombuffer(data, np.int64, count=2, offset=off)
+        metalen, nbufs = int(lens[0]), int(lens[1])
+        lens = np.frombuffer(data, np.int64, count=nbufs, offset=off + 16)
+        off += _aligned(16 + 8 * nbufs)
+        meta = bytes(data[off: off + metalen])
+        off += _aligned(metalen)
+        bufs = []
+        for n in lens:
+            n = int(n)
+            buf = data[off: off + n]
+            if copy:
+                buf = bytearray(buf)
+            bufs.append(buf)
+            off += _aligned(n)
+        return pickle.loads(meta, buffers=bufs)
+
+    def __getitem__(self, key):
+        try:
+            val = self._lookup(key, self.copy)
+        except KeyError:
+            self.misses += 1
+            self._count(key, 1)
+            raise
+        self.hits += 1
+        self._count(key, 0)
+        return val
+
+    def __contains__(self, key):
+        try:
+            self._lookup(key, False)
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key, val):
+        bufs = []
+        meta = pickle.dumps(val, protocol=5, buffer_callback=bufs.append)
+        bufs = [b.raw() for b in bufs]
+        size = (_aligned(16 + 8 * len(bufs)) + _aligned(len(meta)) +
+                sum([_aligned(b.nbytes) for b in bufs]))
+        if size > self.maxbytes:
+            # too big to cache at all
+            self._count(key, 2)
+            self.evictions += 1
+            return
+        k0, k1 = self._digest(key)
+        self._lock()
+        try:
+            # allocate, without wrapping around the end of the buffer
+            head = int(self.hdr[3])
+            off = head % self.maxbytes
+            if off + size > self.maxbytes:
+                head += self.maxbytes - off
+                off = 0
+            pos = head
+            # mark the space as taken before overwriting it
+            self.hdr[3] = head + size
+            self._pack(off, meta, bufs)
+
+            # choose an index entry: this key's, an unused or dead
+            # one, or else the oldest.
+            slots = self._slots(k0)
+            ents = self.index[slots]
+            live = ((ents['size'] > 0) &
+                    (ents['pos'] + np.uint64(self.maxbytes) >=
+                     np.uint64(head + size)))
+            same = live & (ents['k0'] == k0) & (ents['k1'] == k1)
+            if np.any(same):
+                i = slots[np.flatnonzero(same)[0]]
+            elif not np.all(live):
+                i = slots[np.flatnonzero(~live)[0]]
+            else:
+                i = slots[np.argmin(ents['pos'])]
+                self._count(key, 2)
+                self.evictions += 1
+            e = self.index[i:i + 1]
+            e['seq'] += 1
+            e['k0'] = k0
+            e['k1'] = k1
+            e['pos'] = pos
+            e['size'] = size
+            e['seq'] += 1
+        finally:
+            self._unlock()
+
+    def _pack(self, off, meta, bufs):
+        data = self.data
+        hdr = np.ndarray(2 + len(bufs), np.int64, buffer=data, offset=off)
+        hdr[:2] = [len(meta), len(bufs)]
+        hdr[2:] = [b.nbytes for b in bufs]
+        off += _aligned(16 + 8 * len(bufs))
+        data[off: off + len(meta)] = meta
+        off += _aligned(len(meta))
+        for b in bufs:
+            data[off: off + b.nbytes] = b.cast('B')
+            off += _aligned(b.nbytes)
+
+    def put(self, k, v):
+        self[k] = v
+
+    def get(self, *args):
+        if len(args) == 1:
+            key = args[0]
+            return self.__getitem__(key)
+        assert(len(args) == 2)
+        key, default = args
+        try:
+            return self.__getitem__(key)
+        except KeyError:
+            return default
+
+    def clear(self):
+        '''
+        Removes all entries (for all processes).
+        '''
+        self._lock()
+        try:
+            self.index['seq'] += 1
+            self.index['size'] = 0
+            self.index['seq'] += 1
+        finally:
+            self._unlock()
+        self._clearStats()
+
+    def _live(self):
+        ents = self.index
+        return ents[(ents['size'] > 0) &
+                    (ents['pos'] + np.uint64(self.maxbytes) >= self.hdr[3])]
+
+    def __len__(self):
+        return len(self._live())
+
+    def totalSize(self):
+        '''
+        Returns the total size (in bytes) of the cache entries.
+        '''
+        return int(np.sum(self._live()['size']))
+
+    def getStats(self):
+        '''
+        Returns a dict from key class to a dict of hits, misses and
+        evictions (in this process).
+        '''
+        return dict([(k, dict(hits=h, misses=m, evictions=e))
+                     for k, (h, m, e) in self.stats.items()])
+
+    def __str__(self):
+        return ('SharedCache: %i items, %i bytes; %i hits, %i misses, '
+                '%i evictions' % (len(self), self.totalSize(), self.hits,
+                                  self.misses, self.evictions))
+
+    def printStats(self):
+        print(self)
+        for k, st in sorted(self.getStats().items()):
+            print('  %s: %i hits, %i misses, %i evictions' %
+                  (k, st['hits'], st['misses'], st['evictions']))
 
 
 class CacheManager(BaseManager):
@@ -19,22 +402,23 @@ def createManager():
 
 
 def createCache(**kwargs):
-    man = createManager()
-    #kwargs = {}
-    # if maxsize is not None:
-    #		kwargs['maxsize'] = maxsize
-    cache = man.Cache(**kwargs)
-    return cache
+    '''
+    Returns a SharedCache, or, on Python < 3.8, a Cache served by a
+    CacheManager; *kwargs* (eg, *maxbytes*) go to its constructor.
+    '''
+    if shared_memory is None:
+        man = createManager()
+        return man.Cache(**kwargs)
+    return SharedCache(**kwargs)
 
 
 def testProcess(cache):
     import time
-    import os
     for i in range(10):
         time.sleep(1)
         print(os.getpid(), 'get', i, cache.get(i, None))
         print(os.getpid(), 'put', i)
-        cache.put(i, i**3)
+        cache.put(i, np.arange(i))
 
 
 if __name__ == '__main__':
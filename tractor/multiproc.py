@@ -1,156 +1,187 @@
+'''
+`multiproc.py`
+==============
+
+Parallel evaluation of Tractor model images, likelihoods and
+derivatives.
+
+TractorMultiprocMixin (and the ready-made MultiprocTractor) fans the
+work of *getModelImages*, *getLogLikelihood* and *getDerivs* out over
+a pool: one task per Image, and, for source derivatives, one task per
+block of sources in each Image.  Each task is shipped only its Image,
+the sources it needs and their model masks -- never the whole Tractor
+-- and the results are identical to those of the serial Tractor
+methods.  Rendering models and source derivatives doesn't need the
+image pixels, so those tasks get the Image without its data and
+inverse-error arrays (an *ImageGeometry*); only the likelihood and
+Image-derivative tasks ship the pixels.
+
+The pool, *mp*, can be anything with a *map(func, iterable)* method:
+an astrometry.util.multiproc.multiproc, a multiprocessing.Pool, a
+multiprocessing.pool.ThreadPool or a concurrent.futures executor.  If
+it is None, the tasks are run serially in this process.
+'''
 from __future__ import print_function
 
+from tractor.engine import Tractor
+from tractor.image import Image
+
+
+class ImageGeometry(Image):
+    '''
+    An Image without its pixels (data and inverse-error): its shape,
+    PSF, WCS, photometric calibration and sky, which are all that
+    rendering models and computing source derivatives need.
+    '''
+    def __init__(self, img):
+        # (the digest of the pixels stands in for them in cachekey())
+        pixeldigest = img._pixelDigest()
+        self.__dict__.update(img.__dict__)
+        self.__dict__.pop('_pixeldigest', None)
+        self.pixelDigest = pixeldigest
+        self.geometryShape = img.getShape()
+        self.data = None
+        self.inverr = None
+
+    def getShape(self):
+        return self.geometryShape
+
+    def _pixelDigest(self):
+        return self.pixelDigest
+
 
 class TractorMultiprocMixin(object):
 
-    def __init__(self, mp=None, **kwargs):
-        super(TractorMultiprocMixin, self).__init__(**kwargs)
-        if mp is None:
-            from astrometry.util.multiproc import multiproc
-            mp = multiproc()
-
-    def _map(self, func, iterable):
-        return self.mp.map(func, iterable)
-
-    def _map_async(self, func, iterable):
-        return self.mp.map_async(func, iterable)
-
-    def getModelImages(self):
-        # avoid shipping my images...
-        allimages = self.getImages()
-        self.images = Images()
-        args = [(self, im) for im in allimages]
-        # print 'Calling _map:', getmodelimagefunc2
-        # print 'args:', args
-        mods = self._map(getmodelimagefunc2, args)
-        self.images = allimages
-
-    def getDerivs(self):
+    # Number of sources per source-derivatives task.
+    sourceBlockSize = 10
+
+    def __init__(self, *args, **kwargs):
+        self.mp = kwargs.pop('mp', None)
+        super(TractorMultiprocMixin, self).__init__(*args, **kwargs)
+
+    def __setstate__(self, state):
+        super(TractorMultiprocMixin, self).__setstate__(state)
+        self.mp = None
+
+    def _map(self, func, iterable, serial=False):
+        if self.mp is None or serial:
+            return list(map(func, iterable))
+        return list(self.mp.map(func, list(iterable)))
+
+    def _threaded(self):
+        # Whether the pool runs tasks in threads of this process (so
+        # that they share the sources, rather than getting copies).
+        from multiprocessing.pool import ThreadPool
+        from concurrent.futures import ThreadPoolExecutor
+        pools = (ThreadPool, ThreadPoolExecutor)
+        return (isinstance(self.mp, pools) or
+                isinstance(getattr(self.mp, 'pool', None), pools))
+
+    def _sharesParams(self):
+        # Whether any thawed parameter belongs to a Params object that
+        # is shared (eg, a brightness shared between sources, or a PSF
+        # between images).
+        sharedmap = self.getSharedParamMap()
+        return len(sharedmap) > 0 and sharedmap.max() + 1 < len(sharedmap)
+
+    def _getTaskSettings(self):
+        return (self.modtype, self.expectModelMasks, self.batchRender,
+                self.model_kwargs)
+
+    def _getTaskMasks(self, imgi, srcs):
+        # The model masks of *srcs* in image *imgi*, as a list.
+        if self.modelMasks is None:
+            return None
+        masks = self.modelMasks[imgi]
+        return [masks.get(src, None) for src in srcs]
+
+    def _getTaskArgs(self, imgi, srcs, kwargs, img=None):
+        # *img*: the Image (or ImageGeometry) to ship; by default the
+        # Image itself, pixels and all.
+        if img is None:
+            img = self.images[imgi]
+        return (img, srcs, self._getTaskMasks(imgi, srcs),
+                self._getTaskSettings(), kwargs)
+
+    def getModelImages(self, **kwargs):
+        srcs = list(self.catalog)
+        return self._map(_model_image_task,
+                         [self._getTaskArgs(i, srcs, kwargs,
+                                            img=ImageGeometry(img))
+                          for i, img in enumerate(self.images)])
+
+    def getLogLikelihood(self, **kwargs):
+        srcs = list(self.catalog)
+        chisqs = self._map(_chisq_task,
+                           [self._getTaskArgs(i, srcs, kwargs)
+                            for i in range(len(self.images))])
+        chisq = 0.
+        for c in chisqs:
+            chisq += c
+        return -0.5 * chisq
+
+    def getDerivs(self, **kwargs):
+        '''
+        Computes model-image derivatives for each parameter, in
+        parallel; see Tractor.getDerivs.
+
+        The Image derivatives are computed first (one task per thawed
+        Image), then the source derivatives (one task per block of
+        *sourceBlockSize* thawed sources per Image).  As in
+        Tractor.getDerivs, computing derivatives steps the parameters
+        and restores them; with a pool of threads, each task does one
+        block of sources in all the Images, so that no two tasks step
+        the same source at once, and if any parameters are shared
+        between sources or Images (see getSharedParamMap), the tasks
+        are run serially instead.  The source tasks are shipped the
+        Images without their pixels.
+        '''
         allderivs = []
+        threaded = self._threaded()
+        # Threads stepping a shared parameter would race.
+        serial = threaded and self._sharesParams()
 
         if self.isParamFrozen('catalog'):
             srcs = []
         else:
             srcs = list(self.catalog.getThawedSources())
-
-        allsrcs = self.catalog
-
-        # First, derivs for Image parameters (because 'images'
-        # comes first in the tractor's parameters)
-        if self.isParamFrozen('images'):
-            ims = []
-            imjs = []
+        allsrcs = list(self.catalog)
+
+        if not self.isParamFrozen('images'):
+            imis = list(self.images.getThawedParamIndices())
+            args = [self._getTaskArgs(i, allsrcs, kwargs) + (i,)
+                    for i in imis]
+            imderivs = self._map(_image_derivs_task, args, serial=serial)
+            for i, derivs in zip(imis, imderivs):
+                img = self.images[i]
+                allderivs.extend([[(deriv, img)] for deriv in derivs])
+
+        nb = max(1, self.sourceBlockSize)
+        blocks = [srcs[j: j + nb] for j in range(0, len(srcs), nb)]
+        geoms = [ImageGeometry(img) for img in self.images]
+        # Each task is a list of (image, block) index pairs
+        if threaded:
+            tasks = [[(i, b) for i in range(len(geoms))]
+                     for b in range(len(blocks))]
         else:
-            imjs = [i for i in self.images.getThawedParamIndices()]
-            ims = [self.images[j] for j in imjs]
-        imderivs = self._map(getimagederivs, [(imj, im, self, allsrcs)
-                                              for im, imj in zip(ims, imjs)])
-
-        needimjs = []
-        needims = []
-        needparams = []
-
-        for derivs, im, imj in zip(imderivs, ims, imjs):
-            need = []
-            for k, d in enumerate(derivs):
-                if d is False:
-                    need.append(k)
-            if len(need):
-                needimjs.append(imj)
-                needims.append(im)
-                needparams.append(need)
-
-        # initial models...
-        logverb('Getting', len(needimjs),
-                'initial models for image derivatives')
-        mod0s = self._map_async(
-            getmodelimagefunc, [(self, imj) for imj in needimjs])
-        # stepping each (needed) param...
-        args = []
-        # for j,im in enumerate(ims):
-        #   p0 = im.getParams()
-        #   #print 'Image', im
-        #   #print 'Step sizes:', im.getStepSizes()
-        #   #print 'p0:', p0
-        #   for k,step in enumerate(im.getStepSizes()):
-        #       args.append((self, j, k, p0[k], step))
-        for im, imj, params in zip(needims, needimjs, needparams):
-            p0 = im.getParams()
-            ss = im.getStepSizes()
-            for i in params:
-                args.append((self, imj, i, p0[i], ss[i]))
-        # reverse the args so we can pop() below.
-        logverb('Stepping in', len(args), 'model parameters for derivatives')
-        mod1s = self._map_async(getmodelimagestep, reversed(args))
-
-        # Next, derivs for the sources.
-        args = []
-        for j, src in enumerate(srcs):
-            for i, img in enumerate(self.images):
-                args.append((src, img))
-
-        # if modelMasks are set, need to send those across the multiprocessing...
-        assert(self.modelMasks is None)
-        sderivs = self._map_async(getsrcderivs, reversed(args))
-
-        # Wait for and unpack the image derivatives...
-        mod0s = mod0s.get()
-        mod1s = mod1s.get()
-        # convert to a imj->mod0 map
-        assert(len(mod0s) == len(needimjs))
-        mod0s = dict(zip(needimjs, mod0s))
-
-        for derivs, im, imj in zip(imderivs, ims, imjs):
-            for k, d in enumerate(derivs):
-                if d is False:
-                    mod0 = mod0s[imj]
-                    nm = im.getParamNames()[k]
-                    step = im.getStepSizes()[k]
-                    mod1 = mod1s.pop()
-                    d = Patch(0, 0, (mod1 - mod0) / step)
-                    d.name = 'd(im%i)/d(%s)' % (j, nm)
-                allderivs.append([(d, im)])
-        # popped all
-        assert(len(mod1s) == 0)
-
-        # for i,(j,im) in enumerate(zip(imjs,ims)):
-        #   mod0 = mod0s[i]
-        #   p0 = im.getParams()
-        #   for k,(nm,step) in enumerate(zip(im.getParamNames(), im.getStepSizes())):
-        #       mod1 = mod1s.pop()
-        #       deriv = Patch(0, 0, (mod1 - mod0) / step)
-        #       deriv.name = 'd(im%i)/d(%s)' % (j,nm)
-        #       allderivs.append([(deriv, im)])
-
-        # Wait for source derivs...
-        sderivs = sderivs.get()
+            tasks = [[(i, b)] for i in range(len(geoms))
+                     for b in range(len(blocks))]
+        args = [[self._getTaskArgs(i, blocks[b], kwargs, img=geoms[i])
+                 for i, b in task] for task in tasks]
+        results = self._map(_source_derivs_task, args, serial=serial)
+        blockderivs = [[None] * len(blocks) for geom in geoms]
+        for task, res in zip(tasks, results):
+            for (i, b), derivs in zip(task, res):
+                blockderivs[i][b] = derivs
+        # srcimderivs[i][j]: derivatives of srcs[j] in image i
+        srcimderivs = [sum(derivs, []) for derivs in blockderivs]
 
         for j, src in enumerate(srcs):
             srcderivs = [[] for i in range(src.numberOfParams())]
-            for i, img in enumerate(self.images):
-                # Get derivatives (in this image) of params
-                derivs = sderivs.pop()
-                # derivs is a list of Patch objects or None, one per parameter.
-                assert(len(derivs) == src.numberOfParams())
-                for k, deriv in enumerate(derivs):
+            for img, derivs in zip(self.images, srcimderivs):
+                for k, deriv in enumerate(derivs[j]):
                     if deriv is None:
                         continue
-                    # if deriv is False:
-                    #     # compute it now
-                    #   (THIS IS WRONG; mod0s only has initial models for images
-                    #    that need it -- those that are unfrozen)
-                    #     mod0 = mod0s[i]
-                    #     nm = src.getParamNames()[k]
-                    #     step = src.getStepSizes()[k]
-                    #     mod1 = tra.getModelImage(img)
-                    #     d = Patch(0, 0, (mod1 - mod0) / step)
-                    #     d.name = 'd(src(im%i))/d(%s)' % (i, nm)
-                    #     deriv = d
-
-                    if not np.all(np.isfinite(deriv.patch.ravel())):
-                        print('Derivative for source', src)
-                        print('deriv index', i)
-                        assert(False)
                     srcderivs[k].append((deriv, img))
             allderivs.extend(srcderivs)
 
@@ -158,38 +189,53 @@ class TractorMultiprocMixin(object):
         return allderivs
 
 
-# These are free functions for multiprocessing in "getderivs2()"
-def getmodelimagestep(X):
-    (tr, j, k, p0, step) = X
-    im = tr.getImage(j)
-    im.setParam(k, p0 + step)
-    mod = tr.getModelImage(im)
-    im.setParam(k, p0)
-    return mod
+class MultiprocTractor(TractorMultiprocMixin, Tractor):
+    '''
+    A Tractor that evaluates model images, likelihoods and
+    derivatives in parallel over the pool given as the *mp* keyword
+    argument.
+    '''
+    pass
+
+
+# These are free functions so that they can be pickled for
+# multiprocessing.  Each task builds a single-image Tractor.
+
+def _task_tractor(X):
+    (img, srcs, masks, settings, kwargs) = X[:5]
+    tr = Tractor([img], srcs)
+    (tr.modtype, tr.expectModelMasks, tr.batchRender,
+     tr.model_kwargs) = settings
+    if masks is not None:
+        tr.modelMasks = [dict([(src, mask) for src, mask in zip(srcs, masks)
+                               if mask is not None])]
+    return tr, img, kwargs
 
 
-def getmodelimagefunc2(X):
-    (tr, im) = X
-    try:
-        return tr.getModelImage(im)
-    except:
-        import traceback
-        print('Exception in getmodelimagefun2:')
-        traceback.print_exc()
-        raise
+def _model_image_task(X):
+    tr, img, kwargs = _task_tractor(X)
+    return tr.getModelImage(img, **kwargs)
 
 
-def getimagederivs(X):
-    (imj, img, tractor, srcs) = X
-    # FIXME -- avoid shipping all images...
-    return img.getParamDerivatives(tractor, srcs)
+def _chisq_task(X):
+    tr, img, kwargs = _task_tractor(X)
+    return tr.getChiSquared(img, **kwargs)
 
 
-def getsrcderivs(X):
-    (src, img) = X
-    return src.getParamDerivatives(img)
+def _image_derivs_task(X):
+    imgi = X[5]
+    tr, img, kwargs = _task_tractor(X)
+    kw = tr.model_kwargs.copy()
+    kw.update(kwargs)
+    return tr._getImageDerivatives(img, imgi, tr.catalog, kw, **kwargs)
 
 
-def getmodelimagefunc(X):
-    (tr, imj) = X
-    return tr.getModelImage(imj)
+def _source_derivs_task(Xs):
+    # *Xs*: a list of task arguments, each for one block of sources in
+    # one image.
+    results = []
+    for X in Xs:
+        tr, img, kwargs = _task_tractor(X)
+        results.append([tr._getSourceDerivatives(src, img, **kwargs)
+                        for src in tr.catalog])
+    return results
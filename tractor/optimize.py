@@ -2,9 +2,13 @@ from __future__ import print_function
 import numpy as np
 from astrometry.util.ttime import Time
 from tractor.engine import logverb, OptResult, logmsg
+from tractor.profiler import profile_phase
 
 
 class Optimizer(object):
+    # Set by tryUpdatesLinearized
+    linesearch_stats = None
+
     def optimize(self, tractor, alphas=None, damp=0, priors=True,
                  scale_columns=True, shared_params=True, variance=False,
                  just_variance=False):
@@ -30,8 +34,21 @@ class Optimizer(object):
                           nilcounts=-1e30,
                           wantims=True,
                           negfluxval=None,
+                          solver=None,
                           **kwargs
                           ):
+        '''
+        Fits for the fluxes (and, if *sky*, the sky levels) of the
+        thawed sources, holding all their other parameters fixed.
+        Since the fluxes enter the model linearly, the unit-flux
+        models of the sources are rendered once, and the model images
+        are built from them.
+
+        *solver*: for LsqrOptimizer, 'lsqr' (the default) to iterate
+        LSQR updates with a line search, or 'cholesky' to solve the
+        (linear) least-squares problem in one shot from its normal
+        equations (see LsqrOptimizer._linear_forced_photom).
+        '''
         from tractor.basics import LinearPhotoCal, ShiftedWcs
 
         result = OptResult()
@@ -81,6 +98,10 @@ class Optimizer(object):
         else:
             imlist = imgs
 
+        # Pack the unit-flux models into sparse operators (per image).
+        umodels = [UnitFluxModels(umods, img.shape)
+                   for umods, img in zip(umodels, imlist)]
+
         #t0 = Time()
         fsrcs = list(tractor.catalog.getFrozenSources())
         mod0 = []
@@ -122,14 +143,17 @@ class Optimizer(object):
             nonneg=nonneg, wantims0=wantims0, wantims1=wantims1,
             negfluxval=negfluxval, rois=rois, priors=priors, sky=sky,
             justims0=justims0, subimgs=subimgs, damp=damp, alphas=alphas,
-            Nsky=Nsky, mindlnp=mindlnp, shared_params=shared_params, **kwargs)
+            Nsky=Nsky, mindlnp=mindlnp, shared_params=shared_params,
+            solver=solver, **kwargs)
         #print('Optimize_forcedphot_core:', Time()-t0)
 
         if variance:
             # Inverse variance
             #t0 = Time()
-            result.IV = self._get_iv(sky, skyvariance, Nsky, skyderivs, Nsourceparams,
-                                     imlist, umodels, scales)
+            with profile_phase(tractor, 'variance'):
+                result.IV = self._get_iv(sky, skyvariance, Nsky, skyderivs,
+                                         Nsourceparams, imlist, umodels,
+                                         scales)
             #logverb('forced phot: variance:', Time() - t0)
 
         imsBest = getattr(result, 'ims1', None)
@@ -138,9 +162,10 @@ class Optimizer(object):
             result.fitstats = None
         elif fitstats:
             #t0 = Time()
-            result.fitstats = self._get_fitstats(
-                tractor.catalog, imsBest, srcs, imlist, umodsforsource,
-                umodels, scales, nilcounts, extras=fitstat_extras)
+            with profile_phase(tractor, 'fitstats'):
+                result.fitstats = self._get_fitstats(
+                    tractor.catalog, imsBest, srcs, imlist, umodsforsource,
+                    umodels, scales, nilcounts, extras=fitstat_extras)
             #logverb('forced phot: fit stats:', Time() - t0)
         return result
 
@@ -153,9 +178,15 @@ class Optimizer(object):
         # For sources that have a single brightness param, Nsrcparams
         # = Nsources.
         #
+        # If the Tractor keeps a SpatialIndex, the (image, source)
+        # pairs that don't overlap get None models without rendering.
+        #
         umodels = []
         umodtosource = {}
         umodsforsource = [[] for s in srcs]
+        index = None
+        if getattr(tractor, 'useSpatialIndex', False):
+            index = tractor.getSpatialIndex()
 
         for i, img in enumerate(imgs):
             umods = []
@@ -169,18 +200,20 @@ class Optimizer(object):
                 x0 = roi[1].start
             else:
                 x0 = y0 = 0
-            for si, src in enumerate(srcs):
-                counts = sum([pcal.brightnessToCounts(b)
-                              for b in src.getBrightnesses()])
-                if counts <= 0:
-                    mv = 1e-3
+            isrcs = srcs
+            if hasattr(img.getPsf(), 'precomputeAt'):
+                # Evaluate a spatially-varying pixelized PSF at all
+                # the source positions at once.
+                from tractor.psfex import psf_precomputed_sources
+                isrcs = psf_precomputed_sources(
+                    img, srcs,
+                    getmask=lambda src: tractor._getModelMaskFor(img, src))
+            for si, src in enumerate(isrcs):
+                if index is not None and not index.overlaps(img, src):
+                    ums = [None] * src.numberOfParams()
                 else:
-                    # we will scale the PSF by counts and we want that
-                    # scaled min val to be less than minsb
-                    mv = minsb / counts
-                mask = tractor._getModelMaskFor(img, src)
-                ums = src.getUnitFluxModelPatches(
-                    img, minval=mv, modelMask=mask, **kwargs)
+                    ums = self._get_source_umodels(tractor, img, src,
+                                                   pcal, minsb, **kwargs)
 
                 isvalid = False
                 isallzero = False
@@ -221,13 +254,27 @@ class Optimizer(object):
             umodels.append(umods)
         return umodels, umodtosource, umodsforsource
 
+    def _get_source_umodels(self, tractor, img, src, pcal, minsb, **kwargs):
+        counts = sum([pcal.brightnessToCounts(b)
+                      for b in src.getBrightnesses()])
+        if counts <= 0:
+            mv = 1e-3
+        else:
+            # we will scale the PSF by counts and we want that
+            # scaled min val to be less than minsb
+            mv = minsb / counts
+        mask = tractor._getModelMaskFor(img, src)
+        with profile_phase(tractor, 'unitmodels', img, src):
+            return src.getUnitFluxModelPatches(
+                img, minval=mv, modelMask=mask, **kwargs)
+
     def _optimize_forcedphot_core(
             self, tractor,
             result, umodels, imlist, mod0, scales, skyderivs, minFlux,
             nonneg=None, wantims0=None, wantims1=None,
             negfluxval=None, rois=None, priors=None, sky=None,
             justims0=None, subimgs=None, damp=None, alphas=None,
-            Nsky=None, mindlnp=None, shared_params=None):
+            Nsky=None, mindlnp=None, shared_params=None, solver=None):
         raise RuntimeError('Unimplemented')
 
     def _get_fitstats(self, catalog, imsBest, srcs, imlist, umodsforsource,
@@ -287,8 +334,9 @@ class Optimizer(object):
         # Some fancy footwork to convert from umods to sources
         # (eg, composite galaxies that can have multiple umods)
 
-        # keep reusing these arrays
-        srcmods = [np.zeros_like(chi) for (img, mod, ie, chi, roi) in imsBest]
+        umodels = [umods if isinstance(umods, UnitFluxModels)
+                   else UnitFluxModels(umods, chi.shape)
+                   for umods, (img, mod, ie, chi, roi) in zip(umodels, imsBest)]
 
         # for each source:
         for si, uis in enumerate(umodsforsource):
@@ -308,63 +356,57 @@ class Optimizer(object):
                 # if csum < nilcounts:
                 #     continue
 
-                srcmod = srcmods[imi]
-                xlo, xhi, ylo, yhi = None, None, None, None
+                # Gather the (nonzero) pixels of this source's
+                # unit-flux models: pix, srcmod.
+                pix = []
+                srcmod = []
                 # for each component (usually just one)
                 for ui, counts in zip(uis, cc):
                     if counts == 0:
                         continue
-                    um = umods[ui]
-                    if um is None:
-                        continue
-                    # track total ROI.
-                    x0, y0 = um.x0, um.y0
-                    uh, uw = um.shape
-                    if xlo is None or x0 < xlo:
-                        xlo = x0
-                    if xhi is None or x0 + uw > xhi:
-                        xhi = x0 + uw
-                    if ylo is None or y0 < ylo:
-                        ylo = y0
-                    if yhi is None or y0 + uh > yhi:
-                        yhi = y0 + uh
-                    # accumulate this unit-flux model into srcmod
-                    (um * counts).addTo(srcmod)
-                # Divide by total flux, not flux within this image; sum <= 1.
-                if xlo is None or xhi is None or ylo is None or yhi is None:
+                    I, v = umods.getColumn(ui)
+                    pix.append(I)
+                    srcmod.append(v * counts)
+                if len(pix) == 0:
                     continue
-                slc = slice(ylo, yhi), slice(xlo, xhi)
-
-                srcmod[slc] /= sourcecounts
+                if len(pix) == 1:
+                    pix, srcmod = pix[0], srcmod[0]
+                else:
+                    pix, J = np.unique(np.hstack(pix), return_inverse=True)
+                    srcmod = np.bincount(J, weights=np.hstack(srcmod))
+                if len(pix) == 0:
+                    continue
+                # Divide by total flux, not flux within this image; sum <= 1.
+                srcmod = srcmod / sourcecounts
+                pixy, pixx = np.unravel_index(pix, umods.shape)
+                iepix = ie[pixy, pixx]
 
-                nz = np.flatnonzero((srcmod[slc] != 0) * (ie[slc] > 0))
+                nz = np.flatnonzero((srcmod != 0) * (iepix > 0))
                 if len(nz) == 0:
-                    srcmod[slc] = 0.
                     continue
+                asrc = np.abs(srcmod[nz])
+                modnz = mod[pixy[nz], pixx[nz]]
 
-                fs.prochi2[si] += np.sum(np.abs(srcmod[slc].flat[nz])
-                                         * chi[slc].flat[nz]**2)
-                fs.pronpix[si] += np.sum(np.abs(srcmod[slc].flat[nz]))
-                fs.promasked[si] += np.sum(np.abs(srcmod[slc][ie[slc] == 0]))
+                fs.prochi2[si] += np.sum(asrc * chi[pixy[nz], pixx[nz]]**2)
+                fs.pronpix[si] += np.sum(asrc)
+                fs.promasked[si] += np.sum(np.abs(srcmod[iepix == 0]))
                 # (mod - srcmod*sourcecounts) is the model for everybody else
-                fracflux_num[si] += (np.sum((np.abs(mod[slc] / sourcecounts - srcmod[slc]) * np.abs(srcmod[slc])).flat[nz])
-                                     / np.sum((srcmod[slc]**2).flat[nz]))
-                fracflux_den[si] += np.sum(np.abs(srcmod[slc]
-                                                  ).flat[nz] / np.abs(sourcecounts))
+                fracflux_num[si] += (np.sum(np.abs(modnz / sourcecounts -
+                                                   srcmod[nz]) * asrc)
+                                     / np.sum(srcmod[nz]**2))
+                fracflux_den[si] += np.sum(asrc / np.abs(sourcecounts))
                 # scale to nanomaggies, weight by profile
-                fs.proflux[si] += np.sum((np.abs((mod[slc] - srcmod[slc]
-                                                  * sourcecounts) / scale) * np.abs(srcmod[slc])).flat[nz])
+                fs.proflux[si] += np.sum(np.abs((modnz - srcmod[nz]
+                                                 * sourcecounts) / scale)
+                                         * asrc)
                 fs.npix[si] += len(nz)
 
-                fracin_num[si] += np.sum(np.abs(srcmod[slc]))
+                fracin_num[si] += np.sum(np.abs(srcmod))
                 fracin_den[si] += 1.
 
                 for key, extraims in extras:
                     x = getattr(fs, key)
-                    x[si] += np.sum(np.abs(srcmod[slc].flat[nz])
-                                    * extraims[imi][slc].flat[nz])
-
-                srcmod[slc] = 0.
+                    x[si] += np.sum(asrc * extraims[imi][pixy[nz], pixx[nz]])
 
         fs.profracflux = fracflux_num / np.maximum(1, fracflux_den)
         fs.fracin = fracin_num / np.maximum(1, fracin_den)
@@ -396,38 +438,19 @@ class Optimizer(object):
                 IV[di] = dchi2
 
         # source params next
-        for i, (tim, umods, scale) in enumerate(zip(imlist, umodels, scales)):
-            mm = np.zeros(tim.shape)
-            ie = tim.getInvError()
-            for ui, um in enumerate(umods):
-                if um is None:
-                    continue
-                # print 'deriv: sum', um.patch.sum(), 'scale', scale, 'shape', um.shape,
-                um.addTo(mm)
-                x0, y0 = um.x0, um.y0
-                uh, uw = um.shape
-                # If the unit-flux model stars off this image (x0,y0<0),
-                # trim the slice.
-                # (slice indexing correctly handles when the umod extends off
-                # the positive end)
-                if x0 < 0:
-                    uw += x0
-                    x0 = 0
-                if y0 < 0:
-                    uh += y0
-                    y0 = 0
-                slc = slice(y0, y0 + uh), slice(x0, x0 + uw)
-                dchi2 = np.sum((mm[slc] * scale * ie[slc]) ** 2)
-                IV[Nsky + ui] += dchi2
-                mm[slc] = 0.
+        for tim, umods, scale in zip(imlist, umodels, scales):
+            if not isinstance(umods, UnitFluxModels):
+                umods = UnitFluxModels(umods, tim.shape)
+            IV[Nsky:] += umods.getWeightedSumSq(tim.getInvError()) * scale**2
         return IV
 
-    def tryUpdates(self, tractor, X, alphas=None):
+    def tryUpdates(self, tractor, X, alphas=None, pBefore=None):
         if alphas is None:
             # 1/1024 to 1 in factors of 2, + sqrt(2.) + 2.
             alphas = np.append(2.**np.arange(-10, 1), [np.sqrt(2.), 2.])
 
-        pBefore = tractor.getLogProb()
+        if pBefore is None:
+            pBefore = tractor.getLogProb()
         logverb('  log-prob before:', pBefore)
         pBest = pBefore
         alphaBest = None
@@ -469,40 +492,125 @@ class Optimizer(object):
         tractor.setParams(pa)
         return pBest - pBefore, alphaBest
 
+    def tryUpdatesLinearized(self, tractor, X, allderivs, alphas=None,
+                             nexact=2):
+        '''
+        A line search that uses the linearized model to avoid
+        rendering the model images for every step size.
+
+        With the model derivatives *allderivs* (as returned by
+        Tractor.getDerivs) and the update direction *X*, the change in
+        the model for step size *alpha* is approximately alpha * D,
+        where D = sum_j X_j dModel/dParam_j, so chi-squared is a
+        quadratic in alpha.  We predict the log-prob (with the exact
+        prior) for each of the *alphas*, and evaluate exactly (via
+        tryUpdates) only the *nexact* most promising ones.  If none of
+        those improve the log-prob, the remaining alphas are tried the
+        usual way.
+
+        Returns (dlogprob, alpha), like tryUpdates.  The number of
+        step sizes evaluated and of full model renders saved are
+        recorded in *self.linesearch_stats*.
+        '''
+        if alphas is None:
+            alphas = np.append(2.**np.arange(-10, 1), [np.sqrt(2.), 2.])
+        alphas = np.array(alphas)
+
+        # Residuals and model change, in chi units.
+        imgs = tractor.getImages()
+        chis = [tractor.getChiImage(img=img) for img in imgs]
+        dmods = [None] * len(imgs)
+        imgindex = dict([(id(img), i) for i, img in enumerate(imgs)])
+        for x, derivs in zip(X, allderivs):
+            if x == 0:
+                continue
+            for deriv, img in derivs:
+                if deriv is None:
+                    continue
+                i = imgindex[id(img)]
+                if dmods[i] is None:
+                    dmods[i] = np.zeros(chis[i].shape)
+                deriv.addTo(dmods[i], scale=x)
+        chisq0 = 0.
+        cd = 0.
+        dd = 0.
+        for chi, dmod, img in zip(chis, dmods, imgs):
+            chisq0 += np.sum(chi.astype(float)**2)
+            if dmod is None:
+                continue
+            dchi = dmod * img.getInvError()
+            cd += np.sum(chi * dchi)
+            dd += np.sum(dchi**2)
+
+        lnprior0 = tractor.getLogPrior()
+        if lnprior0 == -np.inf:
+            pBefore = lnprior0
+        else:
+            pBefore = lnprior0 - 0.5 * chisq0
+
+        # Predicted log-prob for each alpha.
+        p0 = tractor.getParams()
+        pred = np.zeros(len(alphas))
+        for i, alpha in enumerate(alphas):
+            tractor.setParams([p + alpha * d for p, d in zip(p0, X)])
+            pred[i] = (tractor.getLogPrior() -
+                       0.5 * (chisq0 - 2. * alpha * cd + alpha**2 * dd))
+        tractor.setParams(p0)
+        pred[np.logical_not(np.isfinite(pred))] = -np.inf
+
+        I = np.argsort(-pred)[:nexact]
+        best = np.sort(alphas[I])
+        logverb('  Linearized line search: trying alphas', best,
+                'of', len(alphas))
+        dlnp, alpha = self.tryUpdates(tractor, X, alphas=best,
+                                      pBefore=pBefore)
+        ntried = len(best)
+        if alpha == 0:
+            rest = np.array([a for a in alphas if a not in best])
+            if len(rest):
+                logverb('  Linearized line search failed; trying',
+                        len(rest), 'more alphas')
+                dlnp, alpha = self.tryUpdates(tractor, X, alphas=rest,
+                                              pBefore=pBefore)
+                ntried += len(rest)
+        saved = len(alphas) - ntried
+        logverb('  Linearized line search: saved', saved, 'of', len(alphas),
+                'model renders')
+        self.linesearch_stats = dict(nalphas=len(alphas), ntried=ntried,
+                                     renders_saved=saved)
+        return dlnp, alpha
+
     def _getims(self, fluxes, imgs, umodels, mod0, scales, sky, minFlux, rois):
         ims = []
+        fluxes = np.array(fluxes, np.float64)
+        if minFlux is not None:
+            fluxes = np.maximum(fluxes, minFlux)
         for i, (img, umods, m0, scale
                 ) in enumerate(zip(imgs, umodels, mod0, scales)):
             roi = None
             if rois:
                 roi = rois[i]
+            if not isinstance(umods, UnitFluxModels):
+                umods = UnitFluxModels(umods, m0.shape)
+            counts = fluxes * scale
+            if not np.all(np.isfinite(counts)):
+                print('Warning: counts', counts, 'fluxes', fluxes, 'scale', scale)
+            # (only finite counts for the models present in this image)
+            assert(np.all(np.isfinite(
+                counts[np.diff(umods.getMatrix().indptr) > 0])))
+            counts[np.logical_not(np.isfinite(counts))] = 0.
             mod = m0.copy()
             assert(np.all(np.isfinite(mod)))
             if sky:
                 img.getSky().addTo(mod)
                 assert(np.all(np.isfinite(mod)))
-            for f, um in zip(fluxes, umods):
-                if um is None:
-                    continue
-                if um.patch is None:
-                    continue
-                if minFlux is not None:
-                    f = max(f, minFlux)
-                counts = f * scale
-                if counts == 0.:
-                    continue
-                if not np.isfinite(counts):
-                    print('Warning: counts', counts, 'f', f, 'scale', scale)
-                assert(np.isfinite(counts))
-                assert(np.all(np.isfinite(um.patch)))
-                # print 'Adding umod', um, 'with counts', counts, 'to mod', mod.shape
-                (um * counts).addTo(mod)
+            mod += umods.getModel(counts)
 
             ie = img.getInvError()
             im = img.getImage()
             if roi is not None:
                 ie = ie[roi]
-                im = ie[roi]
+                im = im[roi]
             chi = (im - mod) * ie
 
             # DEBUG
@@ -518,3 +626,93 @@ class Optimizer(object):
             assert(np.all(np.isfinite(chi)))
             ims.append((im, mod, ie, chi, roi))
         return ims
+
+
+class UnitFluxModels(list):
+    '''
+    The unit-flux models of the sources in one image, as built by
+    Optimizer._get_umodels: a list with one element per source
+    brightness parameter, each None or a Patch (in the coordinates of
+    an image of the given *shape*).
+
+    The models are also packed into a sparse (pixel x parameter)
+    matrix, built on first use, so that a model image can be
+    synthesized with a single matrix-vector product rather than by
+    adding each (scaled) Patch in turn.
+    '''
+    def __init__(self, umods, shape):
+        super(UnitFluxModels, self).__init__(umods)
+        self.shape = tuple(shape)
+        self._matrix = None
+        self._columns = None
+
+    def getMatrix(self):
+        '''
+        Returns the (H*W x len(self)) scipy.sparse CSC matrix whose
+        columns are the (raveled, clipped to the image) unit-flux
+        models.  Only nonzero pixels are stored.
+        '''
+        if self._matrix is not None:
+            return self._matrix
+        from scipy.sparse import csc_matrix
+        H, W = self.shape
+        rows = []
+        cols = []
+        vals = []
+        for j, um in enumerate(self):
+            if um is None or um.patch is None:
+                continue
+            spatch, sparent = um.getSlices(self.shape)
+            p = um.patch[spatch]
+            I = np.flatnonzero(p)
+            if len(I) == 0:
+                continue
+            y, x = np.unravel_index(I, p.shape)
+            rows.append((y + sparent[0].start) * W + (x + sparent[1].start))
+            cols.append(np.zeros(len(I), np.int32) + j)
+            vals.append(p.flat[I])
+        if len(rows):
+            rows = np.hstack(rows)
+            cols = np.hstack(cols)
+            vals = np.hstack(vals).astype(np.float64)
+        else:
+            rows = cols = np.array([], np.int32)
+            vals = np.array([], np.float64)
+        self._matrix = csc_matrix((vals, (rows, cols)), shape=(H * W, len(self)))
+        self._matrix.sort_indices()
+        return self._matrix
+
+    def getColumnIds(self):
+        '''
+        Returns the column (parameter) index of each stored element of
+        getMatrix().data.
+        '''
+        if self._columns is None:
+            A = self.getMatrix()
+            self._columns = np.repeat(np.arange(A.shape[1]), np.diff(A.indptr))
+        return self._columns
+
+    def getColumn(self, j):
+        '''
+        Returns (pixel indices, values) of the nonzero pixels of
+        unit-flux model *j*.
+        '''
+        A = self.getMatrix()
+        s = slice(A.indptr[j], A.indptr[j + 1])
+        return A.indices[s], A.data[s]
+
+    def getModel(self, counts):
+        '''
+        Returns the (H,W) float64 image sum_j counts[j] * umodel[j].
+        '''
+        return self.getMatrix().dot(counts).reshape(self.shape)
+
+    def getWeightedSumSq(self, weights):
+        '''
+        Returns, for each unit-flux model, sum(weights * umodel)**2,
+        where *weights* is an image (eg, the inverse-error).
+        '''
+        A = self.getMatrix()
+        w = np.asarray(weights, np.float64).ravel()[A.indices]
+        return np.bincount(self.getColumnIds(), weights=(A.data * w)**2,
+                           minlength=A.shape[1])
@@ -55,6 +55,20 @@ class ModelMask(object):
     def extent(self):
         return (self.x0, self.x0 + self.w, self.y0, self.y0 + self.h)
 
+    def hashkey(self):
+        '''
+        Returns a hashable key for this mask: its extent, plus a
+        digest of the mask pixels, if any.
+        '''
+        key = ('ModelMask', int(self.x0), int(self.y0), int(self.w),
+               int(self.h))
+        if self.mask is None:
+            return key
+        import hashlib
+        mask = np.ascontiguousarray(self.mask)
+        return key + (mask.dtype.str,
+                      hashlib.sha1(mask.view(np.uint8)).hexdigest())
+
 # Adds two patches, handling the case when one is None
 
 
@@ -0,0 +1,237 @@
+'''
+`profiler.py`
+=============
+
+Phase timing and counters for the Tractor's hot paths.
+
+A *Profiler* attached to a Tractor (see *Tractor.enableProfiling*)
+records, for each phase of the computation -- rendering, derivatives,
+matrix assembly, solving, line search, unit-flux model construction,
+fit statistics -- the number of calls and the wall-clock time spent,
+broken down by image and by source type.  Optionally it also records
+the peak memory allocated within each phase (via *tracemalloc*, which
+is much more expensive than the timing).  Before Python 3.9,
+*tracemalloc* cannot reset its peak, so a phase's peak is only seen
+when it sets a new all-time high; otherwise the memory in use at the
+phase boundaries is reported.
+
+The phases are:
+
+- `render`: rendering a source's model patch (or a batch of sources,
+  source type "batched"; or updating an incremental model, source type
+  "incremental")
+- `derivs`: computing a source's (or image's) parameter derivatives
+- `matrix`: building and solving the linearized least-squares system
+  for a parameter update; its *self_time* (excluding the nested
+  `solve`, and any rendering of chi images) is the matrix assembly
+- `solve`: the linear solve (LSQR, Cholesky, dense, bounded, or Ceres)
+- `linesearch`: choosing the step size along an update direction
+- `chisq`: computing an image's chi-squared (for the log-likelihood)
+- `spatial`: updating the index of which sources touch which images
+- `unitmodels`: rendering unit-flux models for forced photometry
+- `fitstats`: forced-photometry fit statistics
+- `variance`: forced-photometry inverse-variances
+
+Phases nest: the *time* of a phase includes the phases run within it
+(eg, `render` within `linesearch`), while *self_time* excludes them.
+
+When no profiler is attached, the instrumentation costs one attribute
+lookup per phase.
+'''
+from __future__ import print_function
+import json
+import time
+
+_timer = time.perf_counter
+
+
+def profile_phase(tractor, name, img=None, src=None):
+    '''
+    Returns a context manager that records phase *name* (for Image
+    *img* and Source *src*, if given) in *tractor*'s profiler; a no-op
+    if *tractor* has no profiler.
+    '''
+    prof = getattr(tractor, 'profiler', None)
+    if prof is None:
+        return _nullphase
+    return prof.phase(name, img, src)
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_nullphase = _NullPhase()
+
+
+class _Phase(object):
+    __slots__ = ['prof', 'key', 't0', 'child', 'mem0', 'peak']
+
+    def __init__(self, prof, key):
+        self.prof = prof
+        self.key = key
+
+    def __enter__(self):
+        self.prof._start(self)
+        return self
+
+    def __exit__(self, *args):
+        self.prof._stop(self)
+        return False
+
+
+class Profiler(object):
+    '''
+    Accumulates call counts, wall-clock time (inclusive and exclusive
+    of nested phases) and, if *memory* is set, peak allocated bytes,
+    per (phase, image, source type).
+    '''
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.reset()
+
+    def reset(self):
+        # (phase, image, source) -> [calls, time, self_time, peak_bytes]
+        self.stats = {}
+        self.imagenames = {}
+        self.stack = []
+        # all-time traced peak at the last snapshot, for Pythons
+        # without tracemalloc.reset_peak
+        self.lastpeak = 0
+
+    def phase(self, name, img=None, src=None):
+        '''
+        Returns a context manager recording phase *name*, for Image
+        *img* (or image name) and Source *src* (or source type name).
+        '''
+        return _Phase(self, (name, self._imageName(img),
+                             self._sourceType(src)))
+
+    def _imageName(self, img):
+        if img is None or isinstance(img, str):
+            return img
+        name = self.imagenames.get(id(img), None)
+        if name is None:
+            name = getattr(img, 'name', None)
+            if name is None:
+                name = '[unnamed %i]' % len(self.imagenames)
+            self.imagenames[id(img)] = name
+        return name
+
+    def _sourceType(self, src):
+        if src is None or isinstance(src, str):
+            return src
+        return type(src).__name__
+
+    def _tracedMemory(self):
+        # Returns (current, peak since the last snapshot) traced bytes.
+        import tracemalloc
+        cur, peak = tracemalloc.get_traced_memory()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+            return cur, peak
+        # Python < 3.9: *peak* is the all-time high, which only tells
+        # us about this interval if it has moved since the last snapshot.
+        if peak > self.lastpeak:
+            self.lastpeak = peak
+            return cur, peak
+        return cur, cur
+
+    def _start(self, ph):
+        ph.child = 0.
+        if self.memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            cur, peak = self._tracedMemory()
+            if len(self.stack):
+                parent = self.stack[-1]
+                parent.peak = max(parent.peak, peak)
+            ph.mem0 = ph.peak = cur
+        self.stack.append(ph)
+        ph.t0 = _timer()
+
+    def _stop(self, ph):
+        dt = _timer() - ph.t0
+        top = self.stack.pop()
+        assert(top is ph)
+        nbytes = 0
+        if self.memory:
+            cur, peak = self._tracedMemory()
+            ph.peak = max(ph.peak, peak)
+            nbytes = ph.peak - ph.mem0
+        if len(self.stack):
+            parent = self.stack[-1]
+            parent.child += dt
+            if self.memory:
+                parent.peak = max(parent.peak, ph.peak)
+        s = self.stats.get(ph.key, None)
+        if s is None:
+            s = self.stats[ph.key] = [0, 0., 0., 0]
+        s[0] += 1
+        s[1] += dt
+        s[2] += dt - ph.child
+        s[3] = max(s[3], nbytes)
+
+    def getStats(self, phase=None, image=None, source=None):
+        '''
+        Returns a list of dicts, one per (phase, image, source type),
+        with keys phase, image, source, calls, time, self_time and
+        peak_bytes; optionally selecting the given *phase*, *image*
+        name and *source* type name.
+        '''
+        rows = []
+        for (ph, im, src), (n, t, tself, nbytes) in sorted(
+                self.stats.items(), key=lambda x: [str(k) for k in x[0]]):
+            if phase is not None and ph != phase:
+                continue
+            if image is not None and im != image:
+                continue
+            if source is not None and src != source:
+                continue
+            rows.append(dict(phase=ph, image=im, source=src, calls=n,
+                             time=t, self_time=tself, peak_bytes=nbytes))
+        return rows
+
+    def summary(self, by=('phase',)):
+        '''
+        Returns the stats totalled over all but the given keys (some
+        of 'phase', 'image', 'source'), as a dict from key tuples to
+        dicts of calls, time, self_time and peak_bytes.
+        '''
+        if isinstance(by, str):
+            by = (by,)
+        S = {}
+        for row in self.getStats():
+            key = tuple(row[k] for k in by)
+            s = S.get(key, None)
+            if s is None:
+                s = S[key] = dict(calls=0, time=0., self_time=0.,
+                                  peak_bytes=0)
+            s['calls'] += row['calls']
+            s['time'] += row['time']
+            s['self_time'] += row['self_time']
+            s['peak_bytes'] = max(s['peak_bytes'], row['peak_bytes'])
+        return S
+
+    def toJson(self, **kwargs):
+        return json.dumps(dict(memory=self.memory, stats=self.getStats()),
+                          **kwargs)
+
+    def writeJson(self, fn):
+        with open(fn, 'w') as f:
+            f.write(self.toJson(indent=2))
+
+    def __str__(self):
+        lines = ['%-12s %8s %10s %10s %10s' % ('Phase', 'Calls', 'Time',
+                                               'Self', 'Peak MB')]
+        S = self.summary()
+        for (ph,), s in sorted(S.items(), key=lambda x: -x[1]['self_time']):
+            lines.append('%-12s %8i %10.4f %10.4f %10.2f' %
+                         (ph, s['calls'], s['time'], s['self_time'],
+                          s['peak_bytes'] / 2.**20))
+        return '\n'.join(lines)
@@ -3,6 +3,7 @@ from __future__ import division
 
 import sys
 import functools
+import threading
 
 import numpy as np
 
@@ -33,8 +34,7 @@ def lanczos_shift_image(img, dx, dy, inplace=False, force_python=False):
             mp_fourier = None
 
     H,W = img.shape
-    if (mp_fourier is None or force_python or W <= 8 or H <= 8
-        or H > work_corr7f.shape[0] or W > work_corr7f.shape[1]):
+    if mp_fourier is None or force_python or W <= 8 or H <= 8:
         # fallback to python:
         from scipy.ndimage import correlate1d
         from astrometry.util.miscutils import lanczos_filter
@@ -50,16 +50,51 @@ def lanczos_shift_image(img, dx, dy, inplace=False, force_python=False):
 
     outimg = np.empty(img.shape, np.float32)
     mp_fourier.lanczos_shift_3f(img.astype(np.float32), outimg, dx, dy,
-                                work_corr7f)
+                                _get_lanczos_work(H, W))
     # yuck!  (don't change this without ensuring the "restrict"
     # keyword still applies in lanczos_shift_3f!)
     if inplace:
         img[:,:] = outimg
     return outimg
 
-# GLOBAL scratch array for lanczos_shift_image!
-work_corr7f = np.zeros((4096, 4096), np.float32)
-work_corr7f = np.require(work_corr7f, requirements=['A'])
+# Per-thread scratch arrays for lanczos_shift_image, grown as needed.
+_lanczos_work = threading.local()
+
+def _get_lanczos_work(H, W):
+    '''
+    Returns an H x W float32 scratch array for lanczos_shift_3f: a
+    view of this thread's flat buffer, which is grown to the largest
+    H*W seen (lanczos_shift_3f only uses it as a flat H*W array).
+    '''
+    work = getattr(_lanczos_work, 'work', None)
+    if work is None or len(work) < H * W:
+        work = np.zeros(H * W, np.float32)
+        work = np.require(work, requirements=['A'])
+        _lanczos_work.work = work
+    return work[:H * W].reshape(H, W)
+
+# A cache that all PixelizedPSFs keep their Fourier transforms (and
+# PSF images) in, or None for a private Cache per PSF (the default);
+# see set_psf_fft_cache.
+_psffftcache = None
+
+
+def get_psf_fft_cache():
+    return _psffftcache
+
+
+def set_psf_fft_cache(cache):
+    '''
+    Makes PixelizedPSFs keep their Fourier transforms in *cache*, eg a
+    tractor.mpcache.SharedCache that the workers of a pool share,
+    rather than in a private Cache each (of fftcacheBytes bytes); None
+    restores private caches.  Applies to PSFs created (or
+    clear_cache()d) afterward.  The keys are prefixed with each PSF's
+    hashkey, so PSFs don't see each other's entries.
+    '''
+    global _psffftcache
+    _psffftcache = cache
+
 
 class HybridPSF(object):
     pass
@@ -97,7 +132,7 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         self.radius = np.hypot(H / 2., W / 2.)
         self.H, self.W = H, W
         self.Lorder = Lorder
-        self.fftcache = {}
+        self.clear_cache()
         self.sampling = sampling
         if sampling != 1.:
             # The size of PSF image we will return.
@@ -107,15 +142,56 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
     def __str__(self):
         return 'PixelizedPSF'
 
+    # Memory budget (bytes) for each PSF's cache of Fourier transforms
+    fftcacheBytes = 64 * 1024 * 1024
+
     def clear_cache(self):
-        self.fftcache = {}
+        from tractor.cache import Cache, PrefixCache
+        if _psffftcache is None:
+            self.fftcache = Cache(maxsize=None, maxbytes=self.fftcacheBytes)
+        else:
+            self.fftcache = PrefixCache(_psffftcache, self._fftcacheKey)
+        self._digest = None
+
+    def _fftcacheKey(self):
+        # The prefix of this PSF's keys in a shared FFT cache.
+        return (self.hashkey(), self.sampling)
+
+    @property
+    def img(self):
+        return self._img
+
+    @img.setter
+    def img(self, img):
+        self._img = img
+        self._digest = None
+
+    def __setstate__(self, state):
+        # Pickles from before *img* became a property hold 'img'
+        # itself (and no digest).
+        state = dict(state)
+        if 'img' in state:
+            state['_img'] = state.pop('img')
+        self.__dict__.update(state)
+        self._digest = None
 
     @property
     def shape(self):
         return (self.H, self.W)
 
     def hashkey(self):
-        return ('PixelizedPSF', tuple(self.img.ravel()))
+        '''
+        Returns a hashable key for this PSF: a digest of the PSF image.
+
+        The digest is computed once, and recomputed when *img* is set
+        (including by in-place operators, eg, psf.img /= 2); after
+        modifying the pixels any other way, call clear_cache().
+        '''
+        if self._digest is None:
+            import hashlib
+            img = np.ascontiguousarray(self.img)
+            self._digest = hashlib.sha1(img.view(np.uint8)).hexdigest()
+        return ('PixelizedPSF', self.img.shape, self._digest)
 
     def copy(self):
         return self.__class__(self.img.copy())
@@ -253,8 +329,9 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
 
         sz = self.getFourierTransformSize(radius)
         # print 'PixelizedPSF FFT size', sz
-        if sz in self.fftcache:
-            return self.fftcache[sz]
+        rtn = self.fftcache.get(('fft', sz), None)
+        if rtn is not None:
+            return rtn
 
         pad, cx, cy = self._padInImage(sz, sz)
         # cx,cy: coordinate of the PSF center in *pad*
@@ -264,7 +341,7 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         v = np.fft.rfftfreq(pW)
         w = np.fft.fftfreq(pH)
         rtn = P, (cx, cy), (pH, pW), (v, w)
-        self.fftcache[sz] = rtn
+        self.fftcache.put(('fft', sz), rtn)
         return rtn
 
     # The following routines are used when sampling != 1.0
@@ -334,9 +411,10 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
 
     def _getOversampledFourierTransform(self, px, py, radius):
         sz = self.getFourierTransformSize(radius)
-        key = (sz, px, py)
-        if key in self.fftcache:
-            return self.fftcache[key]
+        key = ('fft', sz, px, py)
+        rtn = self.fftcache.get(key, None)
+        if rtn is not None:
+            return rtn
         # shift by fractional pixel
         dx = px - int(px)
         dy = py - int(py)
@@ -351,7 +429,7 @@ class PixelizedPSF(BaseParams, ducks.ImageCalibration):
         v = np.fft.rfftfreq(pW)
         w = np.fft.fftfreq(pH)
         rtn = P, (cx, cy), (pH, pW), (v, w)
-        self.fftcache[key] = rtn
+        self.fftcache.put(key, rtn)
         return rtn
 
 class GaussianMixturePSF(MogParams, ducks.ImageCalibration):
@@ -610,6 +688,10 @@ class HybridPixelizedPSF(HybridPSF):
         return ('HybridPixelizedPSF: Gaussian sigma %.2f, Pix %s' %
                 (np.sqrt(self.gauss.mog.var[0, 0, 0]), str(self.pix)))
 
+    def hashkey(self):
+        return (('HybridPixelizedPSF',) + tuple(self.gauss.hashkey()) +
+                tuple(self.pix.hashkey()))
+
     def copy(self):
         s = self.__class__(self.pix.copy(), self.gauss.copy())
         return s
@@ -898,15 +980,15 @@ class NCircularGaussianPSF(MultiParams, ducks.ImageCalibration):
             x1 = ix + rad + 1
             y0 = iy - rad
             y1 = iy + rad + 1
-        # UGH - API question -- is the getMixtureOfGaussians() result read-only?
+        # The getMixtureOfGaussians() result is cached and shared (also
+        # between threads), so shift a new mixture rather than it.
         mix = self.getMixtureOfGaussians()
-        oldmean = mix.mean
-        mix.mean = mix.mean.copy()
-        mix.mean[:, 0] += px
-        mix.mean[:, 1] += py
+        mean = mix.mean.copy()
+        mean[:, 0] += px
+        mean[:, 1] += py
+        mix = mp.MixtureOfGaussians(mix.amp, mean, mix.var, quick=True)
         p = mp.mixture_to_patch(mix, x0, x1, y0, y1, minval=minval,
                                 exactExtent=(modelMask is not None))
-        mix.mean = oldmean
         return p
 
 def getCircularMog(amps, sigmas):
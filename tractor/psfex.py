@@ -256,6 +256,40 @@ class PsfExModel(object):
         hdr['PSF_FWHM'] = self.fwhm
         T.writeto(fn, header=hdr)
 
+    @property
+    def psfbases(self):
+        return self._psfbases
+
+    @psfbases.setter
+    def psfbases(self, bases):
+        self._psfbases = bases
+        self._digest = None
+
+    def __setstate__(self, state):
+        # Pickles from before *psfbases* became a property hold
+        # 'psfbases' itself (and no digest).
+        state = dict(state)
+        if 'psfbases' in state:
+            state['_psfbases'] = state.pop('psfbases')
+        self.__dict__.update(state)
+        self._digest = None
+
+    def hashkey(self):
+        '''
+        Returns a hashable key for this model: a digest of the
+        eigen-PSF images plus the polynomial parameters.
+
+        The digest is computed once, and recomputed when *psfbases* is
+        set (including by in-place operators); after modifying the
+        images any other way, set *psfbases* again.
+        '''
+        if self._digest is None:
+            import hashlib
+            bases = np.ascontiguousarray(self.psfbases)
+            self._digest = hashlib.sha1(bases.view(np.uint8)).hexdigest()
+        return ('PsfExModel', self.psfbases.shape, self._digest, self.degree,
+                self.x0, self.y0, self.xscale, self.yscale, self.sampling)
+
     @property
     def shape(self):
         '''
@@ -278,6 +312,8 @@ class PsfExModel(object):
         for key in ['sampling', 'psfbases', 'xscale', 'yscale', 'degree', 'radius',
                     'x0', 'y0']:
             setattr(copy, key, getattr(self, key))
+        # (sharing the eigen-PSF images, and so their digest)
+        copy._digest = self._digest
         copy.shift(dx, dy)
         return copy
 
@@ -291,31 +327,42 @@ class PsfExModel(object):
         '''
         return self.psfbases
 
-    def polynomials(self, x, y, powers=False):
-        dx = (x - self.x0) / self.xscale
-        dy = (y - self.y0) / self.yscale
-        nb, h, w = self.psfbases.shape
-        terms = np.zeros(nb)
-
-        if powers:
-            xpows = np.zeros(nb, int)
-            ypows = np.zeros(nb, int)
-
+    def powers(self):
+        '''
+        Returns (xpows, ypows), the powers of x and y in each term of
+        the polynomial.
+        '''
+        pows = getattr(self, '_powers', None)
+        if pows is not None and len(pows[0]) == self.psfbases.shape[0]:
+            return pows
+        nb = self.psfbases.shape[0]
+        xpows = np.zeros(nb, int)
+        ypows = np.zeros(nb, int)
         for d in range(self.degree + 1):
             # x polynomial degree = j
             # y polynomial degree = k
             for j in range(d + 1):
                 k = d - j
-                amp = dx**j * dy**k
                 # PSFEx manual pg. 111 ?
                 ii = j + (self.degree + 1) * k - (k * (k - 1)) // 2
-                #print('getPolynomialTerms: j=', j, 'k=', k, 'd=', d, 'ii=', ii)
                 # It goes: order 0, order 1, order 2, ...
                 # and then j=0, j=1, ...
-                terms[ii] = amp
-                if powers:
-                    xpows[ii] = j
-                    ypows[ii] = k
+                xpows[ii] = j
+                ypows[ii] = k
+        self._powers = (xpows, ypows)
+        return xpows, ypows
+
+    def polynomials(self, x, y, powers=False):
+        '''
+        Returns the polynomial terms (the amplitudes of the eigen-PSFs)
+        at pixel position *x*,*y*.  If *x* and *y* are arrays of N
+        positions, returns an N x nbases array.
+        '''
+        xpows, ypows = self.powers()
+        dx = (np.asarray(x, float) - self.x0) / self.xscale
+        dy = (np.asarray(y, float) - self.y0) / self.yscale
+        terms = (dx[..., np.newaxis] ** xpows *
+                 dy[..., np.newaxis] ** ypows)
         if powers:
             return (terms, xpows, ypows)
         return terms
@@ -327,14 +374,7 @@ class PsfExModel(object):
         '''
         Returns an image of the PSF at the given pixel coordinates.
         '''
-        psf = np.zeros_like(self.psfbases[0])
-
-        #print('Evaluating PsfEx at', x,y)
-        for term, base in zip(self.polynomials(x, y), self.psfbases):
-            #print('  polynomial', term, 'x base w/ range', base.min(), base.max())
-            #print('get PsfEx model at', (x,y), 'amp', term)
-            #print('basis image sum:', np.sum(base))
-            psf += term * base
+        psf = np.tensordot(self.polynomials(x, y), self.psfbases, axes=1)
 
         # if nativeScale and self.sampling != 1:
         #     from scipy.ndimage.interpolation import affine_transform
@@ -343,7 +383,14 @@ class PsfExModel(object):
         #                             offset=nx // 2 * (self.sampling - 1.))
         #     return spsf
 
-        return psf
+        return psf.astype(self.psfbases.dtype)
+
+    def at_many(self, x, y):
+        '''
+        Returns an N x H x W stack of images of the PSF at the N given
+        pixel coordinates (arrays *x*, *y*).
+        '''
+        return self.at(np.atleast_1d(x), np.atleast_1d(y))
 
     def plot_bases(self, autoscale=True, stampsize=None):
         import pylab as plt
@@ -443,7 +490,7 @@ class PixelizedPsfEx(PixelizedPSF):
         return 'PixelizedPsfEx'
 
     def hashkey(self):
-        return ('PixelizedPsfEx', self.fn, self.ext)
+        return ('PixelizedPsfEx', self.fn, self.ext) + self.psfex.hashkey()
 
     def copy(self):
         psfex = self.psfex.copy()
@@ -474,10 +521,76 @@ class PixelizedPsfEx(PixelizedPSF):
         return self.radius
 
     def getImage(self, px, py):
+        img = self.fftcache.get(('imageAt', px, py), None)
+        if img is not None:
+            return img
         return self.psfex.at(px, py)
 
+    def getImages(self, xx, yy):
+        '''
+        Returns an N x H x W stack of the PSF images at the N given
+        pixel positions (arrays *xx*, *yy*), computed together.
+        '''
+        return self.psfex.at_many(xx, yy)
+
+    def precomputeAt(self, xx, yy, radius=None):
+        '''
+        Computes the PSF images (and, if *radius* is given, their
+        Fourier transforms) at all the given pixel positions at once
+        and caches them, so that rendering sources at those positions
+        (via getPointSourcePatch, getImage or getFourierTransform)
+        doesn't evaluate the PSF model one source at a time.
+        '''
+        xx = np.atleast_1d(xx)
+        yy = np.atleast_1d(yy)
+        for px, py, img in zip(xx, yy, self.getImages(xx, yy)):
+            self.fftcache.put(('imageAt', px, py), img)
+        if radius is not None:
+            self.precomputeFourierTransformsAt(xx, yy, radius)
+
+    def precomputeFourierTransformsAt(self, xx, yy, radius):
+        '''
+        Computes and caches the Fourier transforms of the PSF at the
+        given pixel positions, for the given *radius* (a scalar, or an
+        array with one radius per position; positions with the same
+        transform size are computed together).
+        '''
+        if self.sampling != 1.:
+            return
+        xx = np.atleast_1d(xx)
+        yy = np.atleast_1d(yy)
+        sizes = np.array([self.getFourierTransformSize(r) for r in
+                          np.broadcast_to(radius, xx.shape)])
+        for sz in np.unique(sizes):
+            I = np.flatnonzero(sizes == sz)
+            for px, py, fft in zip(xx[I], yy[I], self.getFourierTransforms(
+                    xx[I], yy[I], sz // 2)):
+                self.fftcache.put(('fftAt', sz, px, py), fft)
+
     # getPointSourcePatch is inherited from PixelizedPSF
 
+    def _getFourierBases(self, sz):
+        # The Fourier transforms of the eigen-PSFs, padded to size
+        # *sz*: (nbases x H x W array, cx, cy, shape, v, w)
+        cached = self.fftcache.get(('fftbases', sz), None)
+        if cached is not None:
+            return cached
+        fftbases = []
+        bases = self.psfex.bases()
+        nb, h, w = bases.shape
+        for i in range(nb):
+            pad, cx, cy = self._padInImage(sz, sz, img=bases[i, :, :])
+            shape = pad.shape
+            P = np.fft.rfft2(pad)
+            fftbases.append(P)
+        fftbases = np.array(fftbases)
+        H, W = shape
+        v = np.fft.rfftfreq(W)
+        w = np.fft.fftfreq(H)
+        cached = (fftbases, cx, cy, shape, v, w)
+        self.fftcache.put(('fftbases', sz), cached)
+        return cached
+
     def getFourierTransform(self, px, py, radius):
         if self.sampling != 1.:
             # The method below assumes that the eigenPSF bases can be
@@ -487,36 +600,136 @@ class PixelizedPsfEx(PixelizedPSF):
             return super().getFourierTransform(px, py, radius)
 
         sz = self.getFourierTransformSize(radius)
-
-        if sz in self.fftcache:
-            fftbases, cx, cy, shape, v, w = self.fftcache[sz]
-        else:
-            fftbases = []
-            bases = self.psfex.bases()
-            nb, h, w = bases.shape
-            for i in range(nb):
-                pad, cx, cy = self._padInImage(sz, sz, img=bases[i, :, :])
-                shape = pad.shape
-                #print('  basis image size:', bases[i,:,:].shape, 'padded to', shape)
-
-                #print('  sum of basis image:', np.sum(bases[i,:,:]), np.sum(pad))
-                P = np.fft.rfft2(pad)
-                #print('  sum of inverse-Fourier-transformed image:', np.sum(np.fft.irfft2(P, s=shape)))
-                fftbases.append(P)
-            H, W = shape
-            v = np.fft.rfftfreq(W)
-            w = np.fft.fftfreq(H)
-            self.fftcache[sz] = (fftbases, cx, cy, shape, v, w)
-
+        rtn = self.fftcache.get(('fftAt', sz, px, py), None)
+        if rtn is not None:
+            return rtn
+        fftbases, cx, cy, shape, v, w = self._getFourierBases(sz)
         # Now sum the bases by the polynomial coefficients
-        sumfft = np.zeros(fftbases[0].shape, fftbases[0].dtype)
-        for amp, base in zip(self.psfex.polynomials(px, py), fftbases):
-            #print('getFourierTransform: px,py', (px,py), 'amp', amp)
-            sumfft += amp * base
-            #print('sum of inverse Fourier transform of component:', np.sum(np.fft.irfft2(amp * base, s=shape)))
-        #print('sum of inverse Fourier transform of PSF:', np.sum(np.fft.irfft2(sumfft, s=shape)))
+        sumfft = np.tensordot(self.psfex.polynomials(px, py), fftbases,
+                              axes=1)
         return sumfft, (cx, cy), shape, (v, w)
 
+    def getFourierTransforms(self, xx, yy, radius):
+        '''
+        Returns a list of the Fourier transforms (as returned by
+        getFourierTransform) of the PSF at the N given pixel positions
+        (arrays *xx*, *yy*), computed together.
+        '''
+        if self.sampling != 1.:
+            return [self.getFourierTransform(px, py, radius)
+                    for px, py in zip(xx, yy)]
+        sz = self.getFourierTransformSize(radius)
+        fftbases, cx, cy, shape, v, w = self._getFourierBases(sz)
+        polys = self.psfex.polynomials(np.atleast_1d(xx), np.atleast_1d(yy))
+        sumffts = np.tensordot(polys, fftbases, axes=1)
+        return [(sumfft, (cx, cy), shape, (v, w)) for sumfft in sumffts]
+
+
+def psf_precomputed_sources(img, srcs, getmask=None, minval=0., chunk=None):
+    '''
+    Iterates over the sources *srcs* that are about to be rendered in
+    Image *img*.  If the image's PSF can be evaluated at many
+    positions at once (eg, PixelizedPsfEx.precomputeAt), then before
+    each chunk of sources is yielded, the PSF is evaluated at their
+    positions together: the PSF images for point sources, and the
+    Fourier transforms for galaxies.  *getmask(src)*, if given,
+    returns the ModelMask *src* will be rendered with.
+
+    The precomputed entries must stay in the PSF's cache until they
+    are used, so each chunk's entries fit in the cache's budget
+    (psf.fftcacheBytes): a PSF image per point source, a Fourier
+    transform per galaxy (sized by the galaxy's halfsize), and the
+    transforms of the eigen-PSFs for each transform size.  *chunk*,
+    if given, also limits the number of sources per chunk.
+    '''
+    psf = img.getPsf()
+    if not hasattr(psf, 'precomputeAt'):
+        for src in srcs:
+            yield src
+        return
+    budget = psf.fftcacheBytes
+    block = []
+    points = []
+    gals = []
+    sizes = set()
+    nbytes = 0
+    for src in srcs:
+        pos = _psf_position(img, src, getmask, minval)
+        size = _psf_entry_bytes(psf, pos, sizes)
+        if block and (nbytes + size > budget or len(block) == chunk):
+            _precompute_psf(psf, points, gals)
+            for s in block:
+                yield s
+            block = []
+            points = []
+            gals = []
+            sizes = set()
+            nbytes = 0
+            size = _psf_entry_bytes(psf, pos, sizes)
+        block.append(src)
+        nbytes += size
+        if pos is None:
+            continue
+        px, py, halfsize = pos
+        if halfsize is None:
+            points.append((px, py))
+        else:
+            gals.append((px, py, halfsize))
+            sizes.add(psf.getFourierTransformSize(halfsize))
+    _precompute_psf(psf, points, gals)
+    for s in block:
+        yield s
+
+
+def _psf_position(img, src, getmask, minval):
+    # Returns (px, py, halfsize) of the PSF evaluation *src* needs:
+    # halfsize is None for a point source (a PSF image), or the
+    # Fourier-transform halfsize for a galaxy; or None for neither.
+    from tractor.pointsource import PointSource
+    from tractor.galaxy import ProfileGalaxy
+    if src is None:
+        return None
+    wcs = img.getWcs()
+    if isinstance(src, PointSource):
+        px, py = wcs.positionToPixel(src.getPosition(), src)
+        return px, py, None
+    if isinstance(src, ProfileGalaxy):
+        px, py = wcs.positionToPixel(src.getPosition(), src)
+        mask = None
+        if getmask is not None:
+            mask = getmask(src)
+        halfsize = src._getFourierHalfsize(img, px, py, minval,
+                                           modelMask=mask)
+        if halfsize is None:
+            return None
+        return px, py, halfsize
+    return None
+
+
+def _psf_entry_bytes(psf, pos, sizes):
+    # The size of the PSF-cache entries precomputed for a source at
+    # *pos* (see _psf_position), given the transform *sizes* already
+    # in its chunk: a (float64) PSF image, or a (complex128) Fourier
+    # transform plus, for a new size, those of the eigen-PSFs.
+    if pos is None:
+        return 0
+    if pos[2] is None:
+        return psf.img.size * 8
+    sz = psf.getFourierTransformSize(pos[2])
+    fftbytes = sz * (sz // 2 + 1) * 16
+    if sz in sizes:
+        return fftbytes
+    return fftbytes * (1 + psf.psfex.nbases)
+
+
+def _precompute_psf(psf, points, gals):
+    if len(points) > 1:
+        xx, yy = np.array(points, dtype=float).T
+        psf.precomputeAt(xx, yy)
+    if len(gals) > 1:
+        xx, yy, radii = np.array(gals, dtype=float).T
+        psf.precomputeFourierTransformsAt(xx, yy, radii)
+
 
 # dstn originally misnamed this class "PsfEx".  We keep that name as an alias below.
 
@@ -703,10 +916,22 @@ class CachingPsfEx(PsfEx):
         return c
 
     def __init__(self, *args, **kwargs):
-        from tractor.cache import Cache
+        '''
+        Takes the VaryingGaussianPsfEx arguments, plus *rounding* and
+        *cache*: a cache shared with other PSFs (eg, a
+        tractor.mpcache.SharedCache), in which this PSF's keys are
+        prefixed with a digest of its spline fit (see _cacheKey); by
+        default, a private Cache.
+        '''
+        from tractor.cache import Cache, PrefixCache
         rounding = kwargs.pop('rounding', 100)
+        cache = kwargs.pop('cache', None)
         super(CachingPsfEx, self).__init__(*args, **kwargs)
-        self.cache = Cache(maxsize=100)
+        if cache is None:
+            cache = Cache(maxsize=100, maxbytes=64 * 1024 * 1024)
+        else:
+            cache = PrefixCache(cache, self._cacheKey)
+        self.cache = cache
         # round pixel coordinates to the nearest...
         self.rounding = rounding
 
@@ -719,11 +944,28 @@ class CachingPsfEx(PsfEx):
         self.cache.clear()
         return self.__dict__
 
+    def _cacheKey(self):
+        # The prefix of this PSF's keys in a shared cache: a digest of
+        # the spline fit of the MoG parameters (recomputed when the
+        # splines are replaced), plus the rounding and MoG class.
+        self.ensureFit()
+        cached = getattr(self, '_splinedigest', None)
+        if cached is None or cached[0] is not self.splines:
+            import hashlib
+            h = hashlib.sha1()
+            for spl in self.splines:
+                for a in tuple(spl.get_knots()) + (spl.get_coeffs(),):
+                    a = np.ascontiguousarray(a, np.float64)
+                    h.update(a.view(np.uint8))
+            cached = self._splinedigest = (self.splines, h.hexdigest())
+        return ('CachingPsfEx', typestring(self.psfclass), self.rounding,
+                cached[1])
+
     def psfAt(self, x, y):
         # Center of rounding cell:
         cx = int(x / self.rounding) * self.rounding + self.rounding // 2
         cy = int(y / self.rounding) * self.rounding + self.rounding // 2
-        key = (cx, cy)
+        key = ('psfAt', cx, cy)
         mog = self.cache.get(key, None)
         if mog is not None:
             return mog
@@ -13,6 +13,7 @@ if __name__ == '__main__':
     import matplotlib
     matplotlib.use('Agg')
 
+import bisect
 import numpy as np
 
 from tractor import mixture_profiles as mp
@@ -24,11 +25,28 @@ from tractor.galaxy import *
 class SersicMixture(object):
     singleton = None
 
+    # Sersic-index spacing of the lookup table
+    table_step = 0.001
+
     @staticmethod
-    def getProfile(sindex):
+    def get():
         if SersicMixture.singleton is None:
             SersicMixture.singleton = SersicMixture()
-        return SersicMixture.singleton._getProfile(sindex)
+        return SersicMixture.singleton
+
+    @staticmethod
+    def getProfile(sindex):
+        return SersicMixture.get()._getProfile(sindex)
+
+    @staticmethod
+    def getProfiles(sindices):
+        '''
+        Returns a list of MixtureOfGaussians profiles, one per element
+        of the given array of Sersic indices.
+        '''
+        K,amps,varr = SersicMixture.get().evaluate(sindices)
+        return [mp.MixtureOfGaussians(a[:k], np.zeros((k, 2)), v[:k])
+                for k,a,v in zip(K, amps, varr)]
 
     def __init__(self):
         from scipy.interpolate import InterpolatedUnivariateSpline, interp1d
@@ -284,7 +302,178 @@ class SersicMixture(object):
         (lo,hi,a,v) = self.fits[-1]
         self.highest = hi
 
+        self._buildTable()
+
+    def _buildTable(self):
+        '''
+        Tabulates the profile amplitudes and variances, and their
+        derivatives with respect to Sersic index, on a dense grid.
+
+        The index range is cut into segments within which the number
+        of mixture components is constant (the fit ranges, the ramps
+        where ranges overlap, and the core that switches on at n=1).
+        Each segment gets its own uniform grid; the nodes of all
+        segments are stored in one set of arrays, padded to the
+        largest number of components, so that any set of indices can
+        be looked up (with cubic Hermite interpolation) at once.
+        '''
+        bounds = set([self.lowest, self.highest])
+        for lo,hi,a,v in self.fits:
+            bounds.update([lo, hi])
+        if self.lowest < 1. < self.highest:
+            bounds.add(1.)
+        bounds = np.array(sorted(bounds))
+        self.table_core_start = None
+
+        segs = []
+        for lo,hi in zip(bounds[:-1], bounds[1:]):
+            mid = 0.5 * (lo + hi)
+            matches = [f for f in self.fits if mid >= f[0] and mid < f[1]]
+            n = max(1, int(np.ceil((hi - lo) / self.table_step)))
+            s = np.linspace(lo, hi, n+1)
+            segs.append((lo, (hi - lo) / n, len(s)) +
+                        self._evaluateSplines(s, matches, mid > 1.))
+            if mid > 1. and lo == 1.:
+                self.table_core_start = len(segs) - 1
+        K = max(a.shape[1] for lo,h,n,a,v,da,dv in segs)
+        ntot = sum(n for lo,h,n,a,v,da,dv in segs)
+        tabs = [np.zeros((ntot, K)) for i in range(4)]
+        self.table_bounds = bounds
+        self.table_bounds_list = list(bounds)
+        self.table_lo = np.array([lo for lo,h,n,a,v,da,dv in segs])
+        self.table_step_size = np.array([h for lo,h,n,a,v,da,dv in segs])
+        self.table_nodes = np.array([n for lo,h,n,a,v,da,dv in segs])
+        self.table_offset = np.cumsum(np.append(0, self.table_nodes))[:-1]
+        self.table_ncomp = np.array([a.shape[1]
+                                     for lo,h,n,a,v,da,dv in segs])
+        for off,(lo,h,n,a,v,da,dv) in zip(self.table_offset, segs):
+            for tab,x in zip(tabs, [a, v, da, dv]):
+                tab[off:off+n, :x.shape[1]] = x
+        (self.table_amps, self.table_vars,
+         self.table_damps, self.table_dvars) = tabs
+
+    def _evaluateSplines(self, s, matches, core):
+        '''
+        Evaluates the spline fits, for an array of Sersic indices *s*
+        all in the same segment, returning (amps, vars, d(amps)/dn,
+        d(vars)/dn), each of shape (len(s), number of components).
+        '''
+        norm = []
+        for lo,hi,amp_funcs,logvar_funcs in matches:
+            a = np.array([f(s) for f in amp_funcs]).T
+            da = np.array([f(s, nu=1) for f in amp_funcs]).T
+            asum = a.sum(axis=1)[:,np.newaxis]
+            a = a / asum
+            da = (da - a * da.sum(axis=1)[:,np.newaxis]) / asum
+            norm.append((a, da))
+        if len(matches) == 2:
+            # Ramp between overlapping ranges, as in _getSplineProfile
+            (a0,da0),(a1,da1) = norm
+            ramp_lo = matches[1][0]
+            ramp_hi = matches[0][1]
+            frac = ((s - ramp_lo) / (ramp_hi - ramp_lo))[:,np.newaxis]
+            dfrac = 1. / (ramp_hi - ramp_lo)
+            amps = np.hstack(((1.-frac) * a0, frac * a1))
+            damps = np.hstack((-dfrac * a0 + (1.-frac) * da0,
+                               dfrac * a1 + frac * da1))
+        else:
+            assert(len(matches) == 1)
+            (amps,damps), = norm
+        logvar_funcs = sum([v for lo,hi,a,v in matches], [])
+        varr = np.exp(np.array([f(s) for f in logvar_funcs]).T)
+        dvarr = varr * np.array([f(s, nu=1) for f in logvar_funcs]).T
+        if core:
+            c = self.core_func(s)[:,np.newaxis]
+            dc = self.core_func(s, nu=1)[:,np.newaxis]
+            damps = np.hstack((damps * (1. - c) - amps * dc, dc))
+            amps = np.hstack((amps * (1. - c), c))
+            varr = np.hstack((varr, np.zeros_like(c)))
+            dvarr = np.hstack((dvarr, np.zeros_like(c)))
+        return amps, varr, damps, dvarr
+
+    def evaluate(self, sindices, derivs=False):
+        '''
+        Looks up the profiles for an array of Sersic indices in the
+        table.  Returns (K, amps, vars), where *K* is the number of
+        mixture components for each index and *amps*, *vars* are
+        arrays of shape (len(sindices), max(K)), zero-padded beyond K.
+        With *derivs=True*, also returns the derivatives of *amps* and
+        *vars* with respect to Sersic index.
+
+        Indices outside the supported range are clamped (with zero
+        derivatives).
+        '''
+        s = np.atleast_1d(np.asarray(sindices, dtype=float))
+        sc = np.clip(s, self.lowest, self.highest)
+        seg = np.searchsorted(self.table_bounds, sc, side='right') - 1
+        seg = np.clip(seg, 0, len(self.table_lo) - 1)
+        h = self.table_step_size[seg]
+        x = (sc - self.table_lo[seg]) / h
+        j = np.clip(np.floor(x).astype(int), 0, self.table_nodes[seg] - 2)
+        t = (x - j)[:,np.newaxis]
+        j += self.table_offset[seg]
+        hh = h[:,np.newaxis]
+        # cubic Hermite basis functions
+        t2 = t * t
+        t3 = t2 * t
+        h00 = 2.*t3 - 3.*t2 + 1.
+        h10 = t3 - 2.*t2 + t
+        h01 = -2.*t3 + 3.*t2
+        h11 = t3 - t2
+        K = self.table_ncomp[seg]
+        if self.table_core_start is not None:
+            # the core is only added for n > 1 (its amplitude is zero at 1)
+            K = K - ((seg == self.table_core_start) * (sc <= 1.))
+        res = [K]
+        for tab,dtab in [(self.table_amps, self.table_damps),
+                         (self.table_vars, self.table_dvars)]:
+            y0,y1 = tab[j], tab[j+1]
+            d0,d1 = dtab[j] * hh, dtab[j+1] * hh
+            res.append(h00 * y0 + h10 * d0 + h01 * y1 + h11 * d1)
+        if derivs:
+            # derivatives of the basis functions
+            g00 = 6.*t2 - 6.*t
+            g10 = 3.*t2 - 4.*t + 1.
+            g11 = 3.*t2 - 2.*t
+            inside = ((s > self.lowest) * (s < self.highest))[:,np.newaxis]
+            for tab,dtab in [(self.table_amps, self.table_damps),
+                             (self.table_vars, self.table_dvars)]:
+                y0,y1 = tab[j], tab[j+1]
+                d0,d1 = dtab[j] * hh, dtab[j+1] * hh
+                res.append(inside * (g00 * (y0 - y1) + g10 * d0 + g11 * d1)
+                           / hh)
+        return tuple(res)
+
     def _getProfile(self, sindex):
+        # Scalar version of evaluate(), without the array overheads.
+        sc = min(max(float(sindex), self.lowest), self.highest)
+        seg = min(max(bisect.bisect_right(self.table_bounds_list, sc) - 1, 0),
+                  len(self.table_lo) - 1)
+        h = self.table_step_size[seg]
+        x = (sc - self.table_lo[seg]) / h
+        j = min(max(int(np.floor(x)), 0), self.table_nodes[seg] - 2)
+        t = x - j
+        j += self.table_offset[seg]
+        k = self.table_ncomp[seg]
+        if seg == self.table_core_start and sc <= 1.:
+            k -= 1
+        t2 = t * t
+        t3 = t2 * t
+        h00 = 2.*t3 - 3.*t2 + 1.
+        h10 = (t3 - 2.*t2 + t) * h
+        h01 = -2.*t3 + 3.*t2
+        h11 = (t3 - t2) * h
+        amps = (h00 * self.table_amps[j,:k] + h10 * self.table_damps[j,:k] +
+                h01 * self.table_amps[j+1,:k] + h11 * self.table_damps[j+1,:k])
+        varr = (h00 * self.table_vars[j,:k] + h10 * self.table_dvars[j,:k] +
+                h01 * self.table_vars[j+1,:k] + h11 * self.table_dvars[j+1,:k])
+        return mp.MixtureOfGaussians(amps, np.zeros((k, 2)), varr)
+
+    def _getSplineProfile(self, sindex):
+        '''
+        Evaluates the profile directly from the spline fits; the lookup
+        table used by _getProfile is built from these.
+        '''
         matches = []
         # clamp
         if sindex <= self.lowest:
@@ -398,11 +587,11 @@ class SersicGalaxy(HoggGalaxy):
                             self.shape.copy(), self.sersicindex.copy())
 
     def _getUnitFluxDeps(self, img, px, py):
-        return hash(('unitpatch', self.getName(), px, py,
-                     img.getWcs().hashkey(),
-                     img.getPsf().hashkey(),
-                     self.shape.hashkey(),
-                     self.sersicindex.hashkey()))
+        return ('unitpatch', self.getName(), px, py,
+                img.getWcs().hashkey(),
+                img.getPsf().hashkey(),
+                self.shape.hashkey(),
+                self.sersicindex.hashkey())
 
     def getParamDerivatives(self, img, modelMask=None, **kwargs):
         # superclass produces derivatives wrt pos, brightness, and shape.
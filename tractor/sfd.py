@@ -3,11 +3,11 @@ import os
 
 import numpy as np
 
-import fitsio
-
 from astrometry.util.starutil_numpy import radectolb
 from astrometry.util.util import anwcs_t
 
+from tractor.imageutils import read_fits_image
+
 
 class SFDMap(object):
     # These come from Schlafly & Finkbeiner, arxiv 1012.4804v2, Table 6, Rv=3.1
@@ -58,10 +58,51 @@ class SFDMap(object):
         if not os.path.exists(sgp_filename):
             raise RuntimeError(
                 'Error: SFD map does not exist: %s' % sgp_filename)
-        self.north = fitsio.read(ngp_filename)
-        self.south = fitsio.read(sgp_filename)
-        self.northwcs = anwcs_t(ngp_filename, 0)
-        self.southwcs = anwcs_t(sgp_filename, 0)
+        self.ngp_filename = ngp_filename
+        self.sgp_filename = sgp_filename
+        # The maps are opened (memory-mapped) on first use.
+        self._maps = {}
+
+    def __getstate__(self):
+        # Don't pickle the maps; they get re-opened (and so shared,
+        # through the page cache) in each process that uses them.
+        d = self.__dict__.copy()
+        d['_maps'] = {}
+        return d
+
+    @staticmethod
+    def read_map(fn):
+        '''
+        Returns (image, header) for the SFD map in file *fn*.  The image
+        is a read-only memory map onto the file when possible, so that
+        only the pages touched by lookups get read, and processes
+        reading the same map share them.
+        '''
+        return read_fits_image(fn)
+
+    def _get_map(self, north):
+        m = self._maps.get(north, None)
+        if m is None:
+            fn = self.ngp_filename if north else self.sgp_filename
+            image, hdr = SFDMap.read_map(fn)
+            m = self._maps[north] = (image, anwcs_t(fn, 0))
+        return m
+
+    @property
+    def north(self):
+        return self._get_map(True)[0]
+
+    @property
+    def south(self):
+        return self._get_map(False)[0]
+
+    @property
+    def northwcs(self):
+        return self._get_map(True)[1]
+
+    @property
+    def southwcs(self):
+        return self._get_map(False)[1]
 
     @staticmethod
     def bilinear_interp_nonzero(image, x, y):
@@ -88,16 +129,37 @@ class SFDMap(object):
         ebv[ebv2 == 0] = ebv1[ebv2 == 0]
         return ebv
 
-    def ebv(self, ra, dec):
+    # Number of catalog rows to process at a time in ebv()
+    chunksize = 1000000
+
+    def ebv(self, ra, dec, chunksize=None):
+        '''
+        Returns the SFD E(B-V) at the given RA,Dec arrays (in degrees).
+        Large arrays are processed *chunksize* rows at a time, to
+        bound the memory used for the temporary arrays.
+        '''
+        ra = np.atleast_1d(ra)
+        dec = np.atleast_1d(dec)
+        if chunksize is None:
+            chunksize = self.chunksize
+        if len(ra) <= chunksize:
+            return self._ebv(ra, dec)
+        ebv = np.zeros(len(ra))
+        for i in range(0, len(ra), chunksize):
+            ebv[i:i + chunksize] = self._ebv(ra[i:i + chunksize],
+                                             dec[i:i + chunksize])
+        return ebv
+
+    def _ebv(self, ra, dec):
         l, b = radectolb(ra, dec)
         ebv = np.zeros_like(l)
         N = (b >= 0)
-        for wcs, image, cut in [(self.northwcs, self.north, N),
-                                (self.southwcs, self.south, np.logical_not(N))]:
+        for north, cut in [(True, N), (False, np.logical_not(N))]:
+            if not np.any(cut):
+                continue
+            image, wcs = self._get_map(north)
             # Our WCS routines are mis-named... the SFD WCSes convert
             #   X,Y <-> L,B.
-            if sum(cut) == 0:
-                continue
             ok, x, y = wcs.radec2pixelxy(l[cut], b[cut])
             #assert(np.all(ok == 0))
             H, W = image.shape
@@ -108,8 +170,8 @@ class SFDMap(object):
             ebv[cut] = SFDMap.bilinear_interp_nonzero(image, x - 1., y - 1.)
         return ebv
 
-    def extinction(self, filts, ra, dec, get_ebv=False):
-        ebv = self.ebv(ra, dec)
+    def extinction(self, filts, ra, dec, get_ebv=False, chunksize=None):
+        ebv = self.ebv(ra, dec, chunksize=chunksize)
         factors = np.array([SFDMap.extinctions[f] for f in filts])
         rtn = factors[np.newaxis, :] * ebv[:, np.newaxis]
         if get_ebv:
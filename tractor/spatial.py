@@ -0,0 +1,374 @@
+'''
+`spatial.py`
+============
+
+Spatial indexing of sources and images.
+
+By default the Tractor visits every source for every image: when
+rendering models (getModelImage), computing derivatives (getDerivs)
+and building unit-flux models for forced photometry, even though in a
+survey-sized problem each source touches only a few images, and each
+image only a small part of the catalog.
+
+A SpatialIndex records, for each image, the sources whose model
+patches can touch it, and the pixel bounding box of each.  It is built
+by querying a KD-tree of the source positions (*RaDecIndex*) with
+each image's footprint on the sky, followed by an exact check in
+pixel space of the candidates.  Sources whose positions are not
+RaDecPos, or images whose WCS does not map pixels to RaDecPos, skip
+the KD-tree and get only the exact check.
+
+The extent of a source in an image is bounded by the PSF radius, plus,
+for galaxies, the galaxy radius (*getRadius*, in arcsec); sources of
+other types are assumed to touch the whole image.  A source with a
+model mask in an image (see *Tractor.setModelMasks*) is rendered in
+exactly the mask, so the mask's extent is used instead.
+
+Like the ModelAccumulator (see incremental.py), the index keeps each
+source's hashkey: when it is updated, only the sources whose
+parameters have changed are re-checked, and it is rebuilt from scratch
+if the images, their WCS or PSF, or the list of sources changes.
+
+The bounding boxes can also be turned into model masks (see
+*SpatialIndex.getModelMasks* and *Tractor.setModelMasks*).
+
+Enable with *Tractor.useSpatialIndex = True*.
+'''
+from __future__ import print_function
+import numpy as np
+
+from .patch import ModelMask
+
+
+def radec_to_xyz(ra, dec):
+    '''
+    Converts RA,Dec (in degrees; scalars or arrays) to unit vectors, as
+    an array of shape (N, 3).
+    '''
+    ra = np.deg2rad(np.atleast_1d(ra).astype(float))
+    dec = np.deg2rad(np.atleast_1d(dec).astype(float))
+    cosd = np.cos(dec)
+    return np.vstack((cosd * np.cos(ra), cosd * np.sin(ra), np.sin(dec))).T
+
+
+def _deg_to_chord(deg):
+    return 2. * np.sin(np.deg2rad(np.clip(deg, 0., 180.)) / 2.)
+
+
+def _chord_to_deg(chord):
+    return np.rad2deg(2. * np.arcsin(np.clip(chord / 2., 0., 1.)))
+
+
+class RaDecIndex(object):
+    '''
+    A KD-tree (scipy's cKDTree) of RA,Dec positions, for finding the
+    positions near a point on the sky.
+    '''
+
+    def __init__(self, ra, dec):
+        self.xyz = radec_to_xyz(ra, dec)
+        self.tree = None
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def near(self, ra, dec, radius):
+        '''
+        Returns the (sorted) indices of the positions within *radius*
+        degrees of RA,Dec *ra*,*dec*.
+        '''
+        return self.nearXyz(radec_to_xyz(ra, dec)[0], _deg_to_chord(radius))
+
+    def nearXyz(self, xyz, chord):
+        if len(self.xyz) == 0:
+            return np.zeros(0, int)
+        if self.tree is None:
+            from scipy.spatial import cKDTree
+            self.tree = cKDTree(self.xyz)
+        I = self.tree.query_ball_point(xyz, chord)
+        return np.array(sorted(I), int)
+
+
+class SpatialIndex(object):
+    '''
+    For each of a Tractor's images, the sources that can touch it, and
+    their bounding boxes.
+    '''
+
+    # Pixels of slack added around each source's extent
+    margin = 1.
+
+    def __init__(self):
+        self.images = None
+        self.imagekeys = None
+        # the Tractor's modelMasks when the index was built
+        self.modelMasks = None
+        # list of (source, hashkey)
+        self.entries = []
+        # id(source) -> index in entries; id(image) -> index in images
+        self.srcmap = {}
+        self.imgmap = {}
+        # per image: dict from source index to (x0, x1, y0, y1)
+        self.boxes = []
+        # per image: the sources in catalog order (or None, if stale)
+        self.imagesrcs = []
+        # statistics: number of source-image pairs checked
+        self.nchecked = 0
+
+    def _getImageKeys(self, images):
+        return [(img.shape, img.getWcs().hashkey(), img.getPsf().hashkey())
+                for img in images]
+
+    def _isCurrent(self, tractor):
+        if self.images is None:
+            return False
+        images = tractor.getImages()
+        if len(images) != len(self.images):
+            return False
+        for img, i in zip(images, self.images):
+            if img is not i:
+                return False
+        srcs = tractor.getCatalog()
+        if len(srcs) != len(self.entries):
+            return False
+        for src, (s, h) in zip(srcs, self.entries):
+            if src is not s:
+                return False
+        # (setting new model masks rebuilds the index; changing the
+        # existing ones in place does not)
+        if tractor.modelMasks is not self.modelMasks:
+            return False
+        return self._getImageKeys(images) == self.imagekeys
+
+    def update(self, tractor):
+        '''
+        Brings the index up to date with the Tractor's images and the
+        current parameters of its catalog.
+        '''
+        if not self._isCurrent(tractor):
+            self.rebuild(tractor)
+            return
+        for si, (src, hashkey) in enumerate(self.entries):
+            if src is None:
+                continue
+            newkey = src.hashkey()
+            if newkey == hashkey:
+                continue
+            self.entries[si] = (src, newkey)
+            for ii, img in enumerate(self.images):
+                box = self._sourceBox(src, img,
+                                      tractor._getModelMaskFor(img, src))
+                if box is None:
+                    self.boxes[ii].pop(si, None)
+                else:
+                    self.boxes[ii][si] = box
+                self.imagesrcs[ii] = None
+
+    def rebuild(self, tractor):
+        self.images = list(tractor.getImages())
+        self.imagekeys = self._getImageKeys(self.images)
+        self.modelMasks = tractor.modelMasks
+        srcs = list(tractor.getCatalog())
+        self.entries = [(src, None if src is None else src.hashkey())
+                        for src in srcs]
+        self.srcmap = dict([(id(src), si) for si, src in enumerate(srcs)])
+        self.imgmap = dict([(id(img), ii)
+                            for ii, img in enumerate(self.images)])
+
+        # Sources placed in the KD-tree: those with RaDecPos positions
+        # and a known angular extent.
+        from .basics import RaDecPos
+        placed = []
+        radii = []
+        ra = []
+        dec = []
+        unplaced = []
+        for si, src in enumerate(srcs):
+            if src is None:
+                continue
+            pos = src.getPosition()
+            r = self._angularRadius(src)
+            if isinstance(pos, RaDecPos) and r is not None:
+                placed.append(si)
+                radii.append(r)
+                ra.append(pos.ra)
+                dec.append(pos.dec)
+            else:
+                unplaced.append(si)
+        placed = np.array(placed, int)
+        kd = RaDecIndex(ra, dec)
+        maxrad = max(radii) if len(radii) else 0.
+
+        self.boxes = []
+        for ii, img in enumerate(self.images):
+            fp = self._footprint(img)
+            if fp is None or len(kd) == 0:
+                I = placed
+            else:
+                xyz, radius = fp
+                I = placed[kd.nearXyz(xyz, _deg_to_chord(
+                    radius + maxrad / 3600.))]
+            cands = set(I) | set(unplaced)
+            if self.modelMasks is not None:
+                # a source's model mask can reach beyond its extent
+                cands.update([self.srcmap[id(src)]
+                              for src in self.modelMasks[ii]
+                              if id(src) in self.srcmap])
+            boxes = {}
+            for si in sorted(cands):
+                box = self._sourceBox(srcs[si], img,
+                                      tractor._getModelMaskFor(img, srcs[si]))
+                if box is not None:
+                    boxes[si] = box
+            self.boxes.append(boxes)
+        self.imagesrcs = [None] * len(self.images)
+
+    def _angularRadius(self, src):
+        # Returns the angular radius (in arcsec) of *src* beyond that
+        # of the PSF, or None if it is not known in angular terms.
+        from .pointsource import PointSource
+        if isinstance(src, PointSource):
+            if src.fixedRadius is not None or src.minRadius is not None:
+                return None
+            return 0.
+        if getattr(src, 'halfsize', None) is not None:
+            return None
+        if not hasattr(src, 'getRadius'):
+            return None
+        return src.getRadius()
+
+    def _pixelRadius(self, src, img, x, y):
+        # Returns the radius (in pixels) of the model patch of *src* at
+        # pixel *x*,*y* in *img*, or None if it is not known.
+        from .pointsource import PointSource
+        r = img.getPsf().getRadius()
+        if r is None:
+            return None
+        if isinstance(src, PointSource):
+            if src.fixedRadius is not None:
+                r = src.fixedRadius
+            if src.minRadius is not None:
+                r = max(r, src.minRadius)
+            return r
+        if not hasattr(src, 'getRadius'):
+            return None
+        pixscale = img.getWcs().pixscale_at(x, y)
+        r += max(1., src.getRadius() / pixscale)
+        halfsize = getattr(src, 'halfsize', None)
+        if halfsize is not None:
+            r = max(r, halfsize)
+        return r
+
+    def _footprint(self, img):
+        # Returns (unit vector, radius in degrees) of a circle on the
+        # sky containing *img*, padded by its PSF radius; or None if
+        # the image's WCS does not map pixels to RaDecPos.
+        from .basics import RaDecPos
+        H, W = img.shape
+        pad = img.getPsf().getRadius()
+        if pad is None:
+            return None
+        pad += self.margin + 1.
+        xx = np.linspace(-pad, W + pad, 5)
+        yy = np.linspace(-pad, H + pad, 5)
+        edges = ([(x, yy[0]) for x in xx] + [(x, yy[-1]) for x in xx] +
+                 [(xx[0], y) for y in yy[1:-1]] +
+                 [(xx[-1], y) for y in yy[1:-1]])
+        wcs = img.getWcs()
+        ra, dec = [], []
+        for x, y in edges:
+            pos = wcs.pixelToPosition(x, y)
+            if not isinstance(pos, RaDecPos):
+                return None
+            ra.append(pos.ra)
+            dec.append(pos.dec)
+        xyz = radec_to_xyz(ra, dec)
+        center = np.mean(xyz, axis=0)
+        norm = np.sqrt(np.sum(center**2))
+        if norm == 0:
+            return None
+        center /= norm
+        chord = np.max(np.sqrt(np.sum((xyz - center)**2, axis=1)))
+        # Allow for curvature of the edges between the sample points
+        return center, 1.1 * _chord_to_deg(chord)
+
+    def _sourceBox(self, src, img, mask=None):
+        # Returns the (x0, x1, y0, y1) bounding box of *src*'s model
+        # patch in *img*, clipped to the image, or None if it does
+        # not touch the image.  If *src* has ModelMask *mask* in
+        # *img*, the patch covers exactly the mask.
+        self.nchecked += 1
+        H, W = img.shape
+        if mask is not None:
+            x0, x1, y0, y1 = [int(v) for v in mask.extent]
+            x0 = max(0, x0)
+            x1 = min(W, x1)
+            y0 = max(0, y0)
+            y1 = min(H, y1)
+            if x0 >= x1 or y0 >= y1:
+                return None
+            return (x0, x1, y0, y1)
+        x, y = img.getWcs().positionToPixel(src.getPosition(), src)
+        r = self._pixelRadius(src, img, x, y)
+        if r is None:
+            return (0, W, 0, H)
+        r += self.margin
+        x0 = max(0, int(np.floor(x - r)))
+        x1 = min(W, int(np.ceil(x + r)) + 1)
+        y0 = max(0, int(np.floor(y - r)))
+        y1 = min(H, int(np.ceil(y + r)) + 1)
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return (x0, x1, y0, y1)
+
+    def _imageIndex(self, img):
+        return self.imgmap.get(id(img), None)
+
+    def getSources(self, img):
+        '''
+        Returns the list of sources (in catalog order) that can touch
+        Image *img*.
+        '''
+        ii = self._imageIndex(img)
+        if ii is None:
+            return [src for src, h in self.entries]
+        srcs = self.imagesrcs[ii]
+        if srcs is None:
+            srcs = [self.entries[si][0] for si in sorted(self.boxes[ii])]
+            self.imagesrcs[ii] = srcs
+        return srcs
+
+    def overlaps(self, img, src):
+        '''
+        Returns True if Source *src* can touch Image *img*.
+        '''
+        ii = self._imageIndex(img)
+        si = self.srcmap.get(id(src), None)
+        if ii is None or si is None:
+            return True
+        return si in self.boxes[ii]
+
+    def getImages(self, src):
+        '''
+        Returns the list of images that Source *src* can touch.
+        '''
+        si = self.srcmap.get(id(src), None)
+        if si is None:
+            return list(self.images)
+        return [img for img, boxes in zip(self.images, self.boxes)
+                if si in boxes]
+
+    def getModelMasks(self):
+        '''
+        Returns model masks (as for *Tractor.setModelMasks*): a list,
+        per image, of dicts from Source to a ModelMask covering its
+        bounding box.
+        '''
+        masks = []
+        for boxes in self.boxes:
+            m = {}
+            for si in sorted(boxes):
+                x0, x1, y0, y1 = boxes[si]
+                m[self.entries[si][0]] = ModelMask.fromExtent(x0, x1, y0, y1)
+            masks.append(m)
+        return masks
@@ -2,6 +2,7 @@ from __future__ import print_function
 import numpy as np
 import scipy.interpolate as interp
 from tractor.utils import ParamList
+from tractor.patch import Patch
 from tractor import ducks
 
 def median_estimator(pix, mask, min_fraction=None, **kwargs):
@@ -15,12 +16,129 @@ def median_estimator(pix, mask, min_fraction=None, **kwargs):
             return 0.
     return np.median(pix)
 
+def _median_cells(pix, shapes, min_fraction=None, **kwargs):
+    '''
+    median_estimator for many grid cells at once; see
+    SplineSky.BlantonMethod.  Gives the same results as calling
+    median_estimator on each cell.
+    '''
+    ncells = len(pix)
+    # NaN (masked) pixels get sorted to the end.
+    n = pix.shape[1] - np.sum(np.isnan(pix), axis=1)
+    pix = np.sort(pix, axis=1)
+    I = np.arange(ncells)
+    lo = pix[I, np.maximum(n - 1, 0) // 2]
+    hi = pix[I, np.minimum(n // 2, pix.shape[1] - 1)]
+    # (np.median takes the mean of the middle element(s))
+    med = np.mean([lo, hi], axis=0)
+    med[n == 0] = 0.
+    if min_fraction is not None:
+        # (as in median_estimator, N is len() of the 2-d box, ie,
+        # its height)
+        med[n <= shapes[:, 0] * min_fraction] = 0.
+    return med
+
+median_estimator.cells = _median_cells
+
+def _sigma_clipped_mean_cells(pix, shapes, nsigma=3., niter=5,
+                              min_fraction=None, **kwargs):
+    '''
+    sigma_clipped_mean_estimator for many grid cells at once; see
+    SplineSky.BlantonMethod.
+    '''
+    pix = pix.astype(np.float64)
+    good = np.logical_not(np.isnan(pix))
+    N = np.prod(shapes, axis=1)
+    n0 = np.sum(good, axis=1)
+    for i in range(niter):
+        n = np.sum(good, axis=1)
+        mu = np.sum(np.where(good, pix, 0.), axis=1) / np.maximum(n, 1)
+        dev = np.where(good, pix - mu[:, np.newaxis], 0.)
+        sig = np.sqrt(np.sum(dev**2, axis=1) / np.maximum(n, 1))
+        keep = good * (np.abs(dev) < nsigma * sig[:, np.newaxis])
+        nkeep = np.sum(keep, axis=1)
+        # Cells where the clipping converged or would reject everything
+        # are left as they are.
+        done = np.logical_or(nkeep == n, nkeep == 0)
+        if np.all(done):
+            break
+        good[np.logical_not(done)] = keep[np.logical_not(done)]
+    n = np.sum(good, axis=1)
+    mu = np.sum(np.where(good, pix, 0.), axis=1) / np.maximum(n, 1)
+    mu[n0 == 0] = 0.
+    if min_fraction is not None:
+        mu[n0 <= N * min_fraction] = 0.
+    return mu
+
+def sigma_clipped_mean_estimator(pix, mask, nsigma=3., niter=5,
+                                 min_fraction=None, **kwargs):
+    '''
+    The mean of the (unmasked) pixels, after iteratively rejecting
+    those more than *nsigma* standard deviations from the mean.
+    '''
+    pix = np.array(pix, np.float64)
+    if mask is not None:
+        pix[np.logical_not(mask)] = np.nan
+    return _sigma_clipped_mean_cells(
+        pix.reshape(1, -1), np.array([pix.shape]), nsigma=nsigma,
+        niter=niter, min_fraction=min_fraction)[0]
+
+sigma_clipped_mean_estimator.cells = _sigma_clipped_mean_cells
+
+def _gather_cells(image, mask, ylo, yhi, xboxes):
+    '''
+    Returns (pix, shapes) for the grid cells spanning rows [ylo, yhi)
+    and columns *xboxes* [(xlo, xhi), ...] of *image*: *pix* holds
+    each cell's pixels, with masked pixels (and padding) set to NaN,
+    and *shapes* each cell's (height, width).
+    '''
+    dtype = image.dtype
+    if not np.issubdtype(dtype, np.floating):
+        dtype = np.float64
+    h = yhi - ylo
+    shapes = np.array([(h, xhi - xlo) for xlo, xhi in xboxes])
+    pix = np.empty((len(xboxes), h * max(shapes[:, 1])), dtype)
+    pix[:, :] = np.nan
+    for i, (xlo, xhi) in enumerate(xboxes):
+        n = h * (xhi - xlo)
+        pix[i, :n] = image[ylo:yhi, xlo:xhi].ravel()
+        if mask is not None:
+            pix[i, :n][np.logical_not(mask[ylo:yhi, xlo:xhi].ravel())] = np.nan
+    return pix, shapes
+
+def _bspline_basis(t, k, x):
+    '''
+    Returns the (len(x), len(t)-k-1) matrix of the degree-*k*
+    B-spline basis functions with knots *t*, evaluated at *x*
+    (clamped to the knot range, as FITPACK's bispev does).
+    '''
+    x = np.clip(x, t[k], t[-k - 1])
+    n = len(t) - k - 1
+    B = np.zeros((len(x), n))
+    c = np.zeros(len(t))
+    for i in range(n):
+        c[:] = 0.
+        c[i] = 1.
+        B[:, i] = interp.splev(x, (t, c, k))
+    return B
+
 class SplineSky(ParamList, ducks.ImageCalibration):
 
     @staticmethod
-    def BlantonMethod(image, mask, gridsize, estimator=median_estimator, **kwargs):
+    def BlantonMethod(image, mask, gridsize, estimator=median_estimator,
+                      threads=None, **kwargs):
         '''
         mask: True to use pixel.  None for no masking.
+
+        estimator: computes the sky level in a grid cell:
+        estimator(pix, mask, **kwargs).  If it has a "cells"
+        attribute (as median_estimator and sigma_clipped_mean_estimator
+        do), that is used instead to compute a whole row of cells at
+        once: estimator.cells(pix, shapes, **kwargs) -- see
+        _gather_cells.
+
+        threads: if set, compute the rows of cells in a pool of this
+        many threads.
         '''
         H, W = image.shape
         halfbox = gridsize // 2
@@ -33,20 +151,35 @@ class SplineSky(ParamList, ducks.ImageCalibration):
         y0 = int((H - (ny - 2) * halfbox) // 2)
         ygrid = y0 + (halfbox * (np.arange(ny) - 0.5)).astype(int)
 
-        # Compute medians in grid cells
-        grid = np.zeros((ny, nx))
-        for iy, y in enumerate(ygrid):
+        xboxes = [(int(max(0, x - halfbox)), int(min(W, x + halfbox)))
+                  for x in xgrid]
+        cells = getattr(estimator, 'cells', None)
+
+        def gridrow(y):
             ylo, yhi = int(max(0, y - halfbox)), int(min(H, y + halfbox))
-            for ix, x in enumerate(xgrid):
-                xlo, xhi = int(max(0, x - halfbox)), int(min(W, x + halfbox))
+            if cells is not None:
+                return cells(*_gather_cells(image, mask, ylo, yhi, xboxes),
+                             **kwargs)
+            row = []
+            for xlo, xhi in xboxes:
                 im = image[ylo:yhi, xlo:xhi]
+                msk = None
                 if mask is not None:
                     msk = mask[ylo:yhi, xlo:xhi]
-                g = estimator(im, msk, **kwargs)
-                assert(np.isfinite(g))
-                grid[iy, ix] = g
-                #print('box [%4i, %4i], [%4i, %4i]: %6i/%6i (%3.0f %%) unmasked pix -> %8.3f' %
-                #(xlo, xhi, ylo, yhi, len(im), (yhi-ylo)*(xhi-xlo), 100. * len(im) / ((yhi-ylo)*(xhi-xlo)), grid[iy,ix]))
+                row.append(estimator(im, msk, **kwargs))
+            return row
+
+        # Compute medians in grid cells
+        if threads:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(threads)
+            rows = pool.map(gridrow, ygrid)
+            pool.close()
+            pool.join()
+        else:
+            rows = [gridrow(y) for y in ygrid]
+        grid = np.array(rows, np.float64).reshape(ny, nx)
+        assert(np.all(np.isfinite(grid)))
 
         return SplineSky(xgrid, ygrid, grid)
 
@@ -81,6 +214,17 @@ class SplineSky(ParamList, ducks.ImageCalibration):
         self.x0 = 0
         self.y0 = 0
 
+        # memoized basis functions and sky image; see getBasis() and
+        # evaluateImage().
+        self._basis = None
+        self._skyimage = None
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        d['_basis'] = None
+        d['_skyimage'] = None
+        return d
+
     def copy(self):
         c = type(self)(self.xgrid, self.ygrid, self.get_grid(), order=self.order)
         c.x0 = self.x0
@@ -129,10 +273,60 @@ class SplineSky(ParamList, ducks.ImageCalibration):
     def evaluateGrid(self, xvals, yvals):
         return self.spl(xvals + self.x0, yvals + self.y0).T
 
+    def getBasis(self, H, W):
+        '''
+        Returns (By, Bx), the B-spline basis functions evaluated at
+        the pixel rows (H x ny) and columns (W x nx) of an H x W image
+        (including this model's x0,y0 offset).  The spline is
+        separable: the sky image is
+
+            By.dot(C.T).dot(Bx.T)
+
+        where C = getCoefficientGrid(), and the derivative with respect
+        to C[i,j] is the outer product of By[:,j] and Bx[:,i].
+        '''
+        key = (H, W, self.x0, self.y0)
+        basis = getattr(self, '_basis', None)
+        if basis is not None and basis[0] == key:
+            return basis[1]
+        tx, ty = self.spl.get_knots()
+        By = _bspline_basis(ty, self.order, np.arange(H) + self.y0)
+        Bx = _bspline_basis(tx, self.order, np.arange(W) + self.x0)
+        self._basis = (key, (By, Bx))
+        return By, Bx
+
+    def getCoefficientGrid(self):
+        '''
+        Returns the spline coefficients (ie, the parameters) as an
+        (nx, ny) array.
+        '''
+        tx, ty = self.spl.get_knots()
+        nx = len(tx) - self.order - 1
+        return np.array(self.vals, np.float64).reshape(nx, -1)
+
+    def evaluateImage(self, H, W):
+        '''
+        Returns the H x W sky image.  The result is memoized (for the
+        current shape, offset, and parameter values), so must not be
+        modified.
+        '''
+        C = self.getCoefficientGrid()
+        key = (H, W, self.x0, self.y0, C.tobytes())
+        sky = getattr(self, '_skyimage', None)
+        if sky is not None and sky[0] == key:
+            return sky[1]
+        By, Bx = self.getBasis(H, W)
+        S = By.dot(C.T.dot(Bx.T))
+        self._skyimage = (key, S)
+        return S
+
     def addTo(self, mod, scale=1.):
         H, W = mod.shape
-        S = self.evaluateGrid(np.arange(W), np.arange(H))
-        mod += (S * scale)
+        S = self.evaluateImage(H, W)
+        if scale == 1.:
+            mod += S
+        else:
+            mod += (S * scale)
 
     def getParamGrid(self):
         arr = np.array(self.vals)
@@ -203,17 +397,25 @@ class SplineSky(ParamList, ducks.ImageCalibration):
 
         return (rA, cA, vA, pb, mub)
 
-    def getParamDerivatives(self, *args):
+    def getParamDerivatives(self, tractor, img, srcs):
+        H, W = img.shape
+        By, Bx = self.getBasis(H, W)
+        ny = By.shape[1]
         derivs = []
-        tx, ty = self.spl.get_knots()
-        print('Knots:')
-        print('x', len(tx), tx)
-        print('y', len(ty), ty)
-        print('W,H', self.W, self.H)
         for i in self.getThawedParamIndices():
-            #ix = i % self.W
-            #iy = i // self.W
-            derivs.append(False)
+            # each basis function has compact support
+            bx = Bx[:, i // ny]
+            by = By[:, i % ny]
+            X = np.flatnonzero(bx)
+            Y = np.flatnonzero(by)
+            if len(X) == 0 or len(Y) == 0:
+                derivs.append(None)
+                continue
+            xlo, xhi = X[0], X[-1] + 1
+            ylo, yhi = Y[0], Y[-1] + 1
+            p = Patch(xlo, ylo, np.outer(by[ylo:yhi], bx[xlo:xhi]))
+            p.setName('dsky%i' % i)
+            derivs.append(p)
         return derivs
 
     def to_fits_table(self):
@@ -12,6 +12,8 @@ could be useful outside the Tractor context.
 
 """
 from __future__ import print_function
+import bisect
+
 import numpy as np
 
 try:
@@ -378,6 +380,19 @@ class ScalarParam(BaseParams):
     def getMaxStep(self):
         return [self.maxstep]
 
+# Token for the current structure (frozen/thawed state and sub-Params
+# membership) of the Params objects that are part of a cached
+# ParamLayout; replaced whenever one of them changes, which invalidates
+# all the cached layouts.
+_layout_generation = object()
+
+
+def _param_structure_changed(params):
+    global _layout_generation
+    if getattr(params, '_inlayout', False):
+        _layout_generation = object()
+
+
 def _isint(i):
     # return type(i) in [int, np.int64]
     try:
@@ -541,6 +556,7 @@ class NamedParams(object):
             if i is None:
                 continue
             self.liquid[i] = False
+            _param_structure_changed(self)
         if '*' in pnames:
             self.freezeAllParams()
 
@@ -550,6 +566,7 @@ class NamedParams(object):
             if i is None:
                 continue
             self.liquid[i] = True
+            _param_structure_changed(self)
         if '*' in pnames:
             self.thawAllParams()
 
@@ -564,6 +581,7 @@ class NamedParams(object):
             i = self.getNamedParamIndex(paramname)
             assert(i is not None)
         self.liquid[i] = False
+        _param_structure_changed(self)
 
     def freezeAllBut(self, *args):
         self.freezeAllParams()
@@ -580,6 +598,8 @@ class NamedParams(object):
                 continue
             self.liquid[i] = True
             thawed = True
+        if thawed:
+            _param_structure_changed(self)
         return thawed
 
     def thawParam(self, paramname):
@@ -593,6 +613,7 @@ class NamedParams(object):
             i = self._getThings().index(paramname)
 
         self.liquid[i] = True
+        _param_structure_changed(self)
 
     def thawParams(self, *args):
         for n in args:
@@ -600,12 +621,14 @@ class NamedParams(object):
 
     def thawAllParams(self):
         self.liquid[:] = [True] * len(self.liquid)
+        _param_structure_changed(self)
     unfreezeParam = thawParam
     unfreezeParams = thawParams
     unfreezeAllParams = thawAllParams
 
     def freezeAllParams(self):
         self.liquid[:] = [False] * len(self.liquid)
+        _param_structure_changed(self)
 
     def getFrozenParams(self):
         return [self.getNamedParamName(i) for i in self.getFrozenParamIndices()]
@@ -761,6 +784,7 @@ class ParamList(GaussianPriorsMixin, NamedParams, BaseParams):
 
     def _setThings(self, vals):
         self.vals = vals
+        _param_structure_changed(self)
 
     def _numberOfThings(self):
         return len(self.vals)
@@ -920,6 +944,89 @@ class ArithmeticParams(object):
     __rdiv__ = __div__
 
 
+class ParamLayout(object):
+    '''
+    The flattened layout of the thawed parameters of a MultiParams
+    tree: the "leaf" Params objects holding them (the thawed
+    descendants that are not themselves plain MultiParams), and the
+    range of the parameter vector belonging to each one.
+
+    With the layout, getting and setting the parameters of the tree
+    takes one call per leaf, rather than a recursion through the
+    whole tree.  A MultiParams caches its layout (see
+    *MultiParams.getParamLayout*); it is rebuilt after any Params
+    object that is part of a layout is frozen, thawed, or has its
+    sub-Params replaced (via the freeze/thaw methods, named-parameter
+    setters, or the list operations).  Changing the *liquid* or *subs*
+    lists directly is not noticed.
+    '''
+    def __init__(self, params):
+        self.generation = _layout_generation
+        # (leaf, first index, number of parameters)
+        self.leaves = []
+        self.starts = []
+        self.nparams = 0
+        # cached result of MultiParams.getSharedParamMap
+        self.sharedmap = None
+        params._inlayout = True
+        self._addLeaves(params)
+
+    def _addLeaves(self, params):
+        for s in params._getActiveSubs():
+            s._inlayout = True
+            if _isPlainMultiParams(s):
+                self._addLeaves(s)
+                continue
+            n = s.numberOfParams()
+            if n == 0:
+                continue
+            self.leaves.append((s, self.nparams, n))
+            self.starts.append(self.nparams)
+            self.nparams += n
+
+    def isCurrent(self):
+        return self.generation is _layout_generation
+
+    def getParams(self):
+        '''
+        Returns the thawed parameter values of the leaves, or None if
+        one of them no longer has the expected number of parameters.
+        '''
+        p = []
+        for s, i0, n in self.leaves:
+            pp = s.getParams()
+            if len(pp) != n:
+                return None
+            p.extend(pp)
+        return p
+
+    def setParams(self, p):
+        for s, i0, n in self.leaves:
+            s.setParams(p[i0:i0 + n])
+
+    def setParam(self, i, p):
+        j = bisect.bisect_right(self.starts, i) - 1
+        s, i0, n = self.leaves[j]
+        return s.setParam(i - i0, p)
+
+
+_plain_multiparams_types = {}
+
+
+def _isPlainMultiParams(s):
+    # Is *s* a MultiParams whose thawed parameters are just those of its
+    # thawed sub-Params, so that the layout can see through it?
+    t = type(s)
+    plain = _plain_multiparams_types.get(t, None)
+    if plain is None:
+        plain = (issubclass(t, MultiParams) and
+                 all(getattr(t, m) is getattr(MultiParams, m) for m in
+                     ['getParams', 'setParams', 'setParam', 'numberOfParams',
+                      '_getActiveSubs']))
+        _plain_multiparams_types[t] = plain
+    return plain
+
+
 class MultiParams(BaseParams, NamedParams):
     '''
     An implementation of Params that combines component sub-Params.
@@ -941,19 +1048,23 @@ class MultiParams(BaseParams, NamedParams):
     def append(self, x):
         self.subs.append(x)
         self.liquid.append(True)
+        _param_structure_changed(self)
 
     def prepend(self, x):
         self.subs = [x] + self.subs
         self.liquid = [True] + self.liquid
+        _param_structure_changed(self)
 
     def extend(self, x):
         self.subs.extend(x)
         self.liquid.extend([True] * len(x))
+        _param_structure_changed(self)
 
     def remove(self, x):
         i = self.subs.index(x)
         self.subs = self.subs[:i] + self.subs[i + 1:]
         self.liquid = self.liquid[:i] + self.liquid[i + 1:]
+        _param_structure_changed(self)
         # self.subs.remove(x)
 
     def index(self, x):
@@ -967,6 +1078,7 @@ class MultiParams(BaseParams, NamedParams):
         return self.subs.__getitem__(key)
 
     def __setitem__(self, key, val):
+        _param_structure_changed(self)
         return self.subs.__setitem__(key, val)
 
     def __iter__(self):
@@ -1017,6 +1129,7 @@ class MultiParams(BaseParams, NamedParams):
     # the active/inactive state.
     def _setThing(self, i, val):
         self.subs[i] = val
+        _param_structure_changed(self)
 
     def _getThing(self, i):
         return self.subs[i]
@@ -1124,22 +1237,48 @@ class MultiParams(BaseParams, NamedParams):
 
         return n
 
+    def getParamLayout(self):
+        '''
+        Returns the (cached) ParamLayout of this object's thawed
+        parameters.
+        '''
+        layout = self.__dict__.get('_paramlayout', None)
+        if layout is None or not layout.isCurrent():
+            layout = self._paramlayout = ParamLayout(self)
+        return layout
+
+    def getSharedParamMap(self):
+        '''
+        Returns an integer array mapping each thawed parameter to the
+        index of the distinct parameter it is.  (A parameter can appear
+        more than once, if a Params object is shared, eg, between
+        sources.)  The map is cached along with the ParamLayout.
+        '''
+        layout = self.getParamLayout()
+        if layout.sharedmap is None:
+            p0 = self.getParams()
+            self.setParams(np.arange(len(p0)))
+            p1 = self.getParams()
+            self.setParams(p0)
+            U, I = np.unique(p1, return_inverse=True)
+            layout.sharedmap = I
+        return layout.sharedmap
+
     def numberOfParams(self):
         '''
         Count unpinned (active) params.
         '''
-        return sum(s.numberOfParams() for s in self._getActiveSubs())
+        return self.getParamLayout().nparams
 
     def getParams(self):
         '''
         Returns a *copy* of the current active parameter values (as a flat list)
         '''
-        p = []
-        for s in self._getActiveSubs():
-            pp = s.getParams()
-            if pp is None:
-                continue
-            p.extend(pp)
+        p = self.getParamLayout().getParams()
+        if p is None:
+            # a leaf's number of parameters changed; rebuild.
+            self._paramlayout = ParamLayout(self)
+            p = self._paramlayout.getParams()
         return p
 
     def getAllParams(self):
@@ -1159,19 +1298,12 @@ class MultiParams(BaseParams, NamedParams):
             i += n
 
     def setParams(self, p):
-        i = 0
-        for s in self._getActiveSubs():
-            n = s.numberOfParams()
-            s.setParams(p[i:i + n])
-            i += n
+        self.getParamLayout().setParams(p)
 
     def setParam(self, i, p):
-        off = 0
-        for s in self._getActiveSubs():
-            n = s.numberOfParams()
-            if i < off + n:
-                return s.setParam(i - off, p)
-            off += n
+        layout = self.getParamLayout()
+        if i < layout.nparams:
+            return layout.setParam(i, p)
         raise RuntimeError('setParam(%i,...) for a %s that only has %i elements' %
                            (i, getClassName(self), self.numberOfParams()))
 
@@ -0,0 +1,298 @@
+'''
+Performance benchmarks for the Tractor, on synthetic images and catalogs.
+
+Times model rendering (getModelImage), derivatives (getDerivs), the
+linearized update (optimizer.getUpdateDirection), full fits
+(optimize_loop) and forced photometry (optimize_forced_photometry),
+for a range of source counts, PSF models and galaxy types.  For each
+case it records the median and best wall-clock time, the throughput
+(sources per second) and the peak memory allocated (via tracemalloc).
+
+Results can be saved as a baseline and later runs compared against it:
+
+    python utils/benchmark.py --save baseline.json
+    python utils/benchmark.py --compare baseline.json
+
+A comparison exits with a non-zero status if any case got slower (or
+used more memory) than the baseline by more than the tolerance.
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import platform
+import tracemalloc
+
+import numpy as np
+
+from tractor import (Tractor, Image, PointSource, PixPos, Flux,
+                     LinearPhotoCal, ConstantSky, NullWCS,
+                     GaussianMixturePSF, PixelizedPSF, HybridPixelizedPSF)
+from tractor.galaxy import (ExpGalaxy, DevGalaxy, FixedCompositeGalaxy,
+                            SoftenedFracDev, disable_galaxy_cache)
+from tractor.sersic import SersicGalaxy, SersicIndex
+from tractor.ellipses import EllipseE
+
+all_ops = ['model', 'derivs', 'update', 'optimize', 'forced']
+all_psfs = ['gaussian', 'pixelized', 'psfex', 'hybrid']
+all_galaxies = ['point', 'exp', 'dev', 'comp', 'sersic']
+
+psfex_fn = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'test', 'psfex-decam-00392360-S31.fits')
+
+# Two-component Gaussian PSF used for the 'gaussian' and 'hybrid' models,
+# and rendered into a stamp for the 'pixelized' model.
+psf_amps = np.array([0.8, 0.2])
+psf_vars = np.array([2.0, 8.0])
+
+
+def get_psf(name):
+    K = len(psf_amps)
+    gauss = GaussianMixturePSF(psf_amps, np.zeros((K, 2)),
+                               psf_vars[:, np.newaxis, np.newaxis] *
+                               np.eye(2)[np.newaxis, :, :])
+    if name == 'gaussian':
+        return gauss
+    if name == 'psfex':
+        from tractor.psfex import PixelizedPsfEx
+        return PixelizedPsfEx(psfex_fn)
+    S = 25
+    xx, yy = np.meshgrid(np.arange(S) - S // 2, np.arange(S) - S // 2)
+    r2 = xx**2 + yy**2
+    stamp = sum(a / (2. * np.pi * v) * np.exp(-0.5 * r2 / v)
+                for a, v in zip(psf_amps, psf_vars))
+    stamp /= stamp.sum()
+    pix = PixelizedPSF(stamp.astype(np.float32))
+    if name == 'pixelized':
+        return pix
+    if name == 'hybrid':
+        return HybridPixelizedPSF(pix, gauss=gauss)
+    raise ValueError('Unknown PSF type: %s' % name)
+
+
+def get_source(galaxy, x, y, flux, rng):
+    pos = PixPos(x, y)
+    br = Flux(flux)
+    if galaxy == 'point':
+        return PointSource(pos, br)
+
+    def shape():
+        return EllipseE(rng.uniform(1., 4.), rng.uniform(-0.2, 0.2),
+                        rng.uniform(-0.2, 0.2))
+    if galaxy == 'exp':
+        return ExpGalaxy(pos, br, shape())
+    if galaxy == 'dev':
+        return DevGalaxy(pos, br, shape())
+    if galaxy == 'comp':
+        return FixedCompositeGalaxy(pos, br, SoftenedFracDev(0.4),
+                                    shape(), shape())
+    if galaxy == 'sersic':
+        return SersicGalaxy(pos, br, shape(),
+                            SersicIndex(rng.uniform(1., 4.)))
+    raise ValueError('Unknown galaxy type: %s' % galaxy)
+
+
+def make_scene(nsrcs, psf, galaxy, density=1. / 2500., noise=1., seed=42):
+    '''
+    Returns a Tractor with one synthetic image containing *nsrcs*
+    sources of the given *galaxy* type, at a fixed source *density*
+    (per pixel), so that the cost per source is comparable between
+    source counts.  The image pixels are the model plus Gaussian
+    noise; the catalog is returned at the true parameters.
+    '''
+    rng = np.random.RandomState(seed)
+    S = int(np.ceil(np.sqrt(nsrcs / density)))
+    H, W = S, S
+    tim = Image(data=np.zeros((H, W), np.float32),
+                inverr=np.ones((H, W), np.float32) / noise,
+                psf=get_psf(psf), wcs=NullWCS(),
+                photocal=LinearPhotoCal(1.), sky=ConstantSky(0.))
+    srcs = [get_source(galaxy, x, y, f, rng) for x, y, f in
+            zip(rng.uniform(0, W, nsrcs), rng.uniform(0, H, nsrcs),
+                rng.uniform(100., 1000., nsrcs))]
+    tr = Tractor([tim], srcs)
+    tim.data = (tr.getModelImage(0) +
+                rng.normal(scale=noise, size=(H, W))).astype(np.float32)
+    tr.freezeParam('images')
+    return tr
+
+
+def perturb(tr, seed=43):
+    rng = np.random.RandomState(seed)
+    p = np.array(tr.getParams())
+    tr.setParams(p + 0.01 * np.abs(p) * rng.normal(size=len(p)))
+
+
+def setup_op(op, tr):
+    '''
+    Prepares the Tractor *tr* (at its true parameters) for benchmark
+    *op*, and returns the function to time.
+    '''
+    if op == 'model':
+        return lambda: tr.getModelImage(0)
+    if op == 'derivs':
+        return lambda: tr.getDerivs()
+    if op == 'update':
+        allderivs = tr.getDerivs()
+        return lambda: tr.optimizer.getUpdateDirection(tr, allderivs)
+    if op == 'optimize':
+        perturb(tr)
+        return lambda: tr.optimize_loop(steps=10)
+    if op == 'forced':
+        tr.catalog.freezeAllRecursive()
+        tr.catalog.thawPathsTo('brightness')
+        perturb(tr)
+        return lambda: tr.optimize_forced_photometry()
+    raise ValueError('Unknown benchmark: %s' % op)
+
+
+def run_case(op, psf, galaxy, nsrcs, repeat=3):
+    times = []
+    # One warm-up run (not timed), then *repeat* timed runs, each on a
+    # freshly-built scene so that every run does the same work.
+    for i in range(repeat + 1):
+        func = setup_op(op, make_scene(nsrcs, psf, galaxy))
+        t0 = time.perf_counter()
+        func()
+        t1 = time.perf_counter()
+        if i > 0:
+            times.append(t1 - t0)
+    func = setup_op(op, make_scene(nsrcs, psf, galaxy))
+    tracemalloc.start()
+    func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    t = float(np.median(times))
+    return dict(time=t, best=min(times), throughput=nsrcs / t,
+                peak_mb=peak / 2.**20)
+
+
+def case_key(op, psf, galaxy, nsrcs):
+    return '%s/%s/%s/%i' % (op, psf, galaxy, nsrcs)
+
+
+def run_benchmarks(ops, psfs, galaxies, nsrcs, repeat=3, log=print):
+    disable_galaxy_cache()
+    results = {}
+    for n in nsrcs:
+        for galaxy in galaxies:
+            for psf in psfs:
+                for op in ops:
+                    key = case_key(op, psf, galaxy, n)
+                    r = run_case(op, psf, galaxy, n, repeat=repeat)
+                    results[key] = r
+                    log('%-32s %9.4f s  %10.1f src/s  %8.2f MB' %
+                        (key, r['time'], r['throughput'], r['peak_mb']))
+    return results
+
+
+def environment():
+    import scipy
+    return dict(python=platform.python_version(), numpy=np.__version__,
+                scipy=scipy.__version__, machine=platform.machine(),
+                platform=platform.platform(),
+                date=time.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=1e-3,
+            min_mb=1.):
+    '''
+    Compares *results* against *baseline* (both dicts as returned by
+    run_benchmarks).  Returns a list of (key, description) for the
+    cases that regressed: with a best time slower by more than the
+    fractional *tolerance* (and at least *min_seconds*), or using more
+    than that fraction (and at least *min_mb*) more peak memory.
+    '''
+    regressions = []
+    missing = 0
+    for key in sorted(results.keys()):
+        if not key in baseline:
+            missing += 1
+            continue
+        r, b = results[key], baseline[key]
+        ratio = r['best'] / b['best']
+        dmem = r['peak_mb'] - b['peak_mb']
+        flag = ''
+        if ratio > 1. + tolerance and r['best'] - b['best'] > min_seconds:
+            flag = 'SLOWER'
+            regressions.append((key, 'time %.4f s vs baseline %.4f s' %
+                                (r['best'], b['best'])))
+        if dmem > min_mb and r['peak_mb'] > b['peak_mb'] * (1. + tolerance):
+            flag += ' MEMORY'
+            regressions.append((key, 'peak memory %.2f MB vs baseline %.2f MB'
+                                % (r['peak_mb'], b['peak_mb'])))
+        print('%-32s time x %5.2f  memory %+8.2f MB  %s' %
+              (key, ratio, dmem, flag))
+    if missing:
+        print('%i case(s) not in the baseline' % missing)
+    return regressions
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('%prog [options]')
+    parser.add_option('--ops', default=','.join(all_ops),
+                      help='Comma-separated benchmarks to run, from: %s '
+                      '(default all)' % ', '.join(all_ops))
+    parser.add_option('--psfs', default=','.join(all_psfs),
+                      help='Comma-separated PSF models, from: %s '
+                      '(default all)' % ', '.join(all_psfs))
+    parser.add_option('--galaxies', default=','.join(all_galaxies),
+                      help='Comma-separated source types, from: %s '
+                      '(default all)' % ', '.join(all_galaxies))
+    parser.add_option('--nsrcs',
+                      help='Comma-separated source counts (default 10,100)')
+    parser.add_option('--repeat', type=int, default=3,
+                      help='Timed runs per case (default %default)')
+    parser.add_option('--quick', action='store_true',
+                      help='Run a small subset: point & exp sources, '
+                      'gaussian & pixelized PSFs, 10 sources by default')
+    parser.add_option('--save', help='Write results (JSON) to this file')
+    parser.add_option('--compare', help='Compare against baseline JSON file')
+    parser.add_option('--tolerance', type=float, default=0.25,
+                      help='Fractional slow-down (or memory growth) '
+                      'counted as a regression (default %default)')
+    opt, args = parser.parse_args()
+
+    ops = opt.ops.split(',')
+    psfs = opt.psfs.split(',')
+    galaxies = opt.galaxies.split(',')
+    nsrcs = opt.nsrcs
+    if opt.quick:
+        psfs = ['gaussian', 'pixelized']
+        galaxies = ['point', 'exp']
+        if nsrcs is None:
+            nsrcs = '10'
+    if nsrcs is None:
+        nsrcs = '10,100'
+    nsrcs = [int(n) for n in nsrcs.split(',')]
+
+    results = run_benchmarks(ops, psfs, galaxies, nsrcs, repeat=opt.repeat)
+
+    if opt.save:
+        with open(opt.save, 'w') as f:
+            json.dump(dict(environment=environment(), results=results), f,
+                      indent=2, sort_keys=True)
+        print('Wrote', opt.save)
+
+    if opt.compare:
+        with open(opt.compare) as f:
+            baseline = json.load(f)
+        print()
+        print('Comparing to baseline', opt.compare)
+        print('Baseline environment:', baseline['environment'])
+        regressions = compare(results, baseline['results'],
+                              tolerance=opt.tolerance)
+        if len(regressions):
+            print()
+            print('%i regression(s):' % len(regressions))
+            for key, msg in regressions:
+                print('  ', key, ':', msg)
+            return 1
+        print('No regressions.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
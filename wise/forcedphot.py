@@ -20,11 +20,39 @@ def unwise_forcedphot(cat, tiles, bands=None, roiradecbox=None,
                       use_ceres=True, ceres_block=8,
                       save_fits=False, get_models=False, ps=None,
                       psf_broadening=None,
-                      pixelized_psf=False):
+                      pixelized_psf=False,
+                      mp=None, mp_chunk=64, outfn=None, return_phot=True):
     '''
     Given a list of tractor sources *cat*
     and a list of unWISE tiles *tiles* (a fits_table with RA,Dec,coadd_id)
     runs forced photometry, returning a FITS table the same length as *cat*.
+
+    Each (tile, band) pair is an independent work unit, fitting only
+    the sources that touch that tile; the per-tile results are then
+    merged, keeping for each source the fit from the tile whose
+    center is closest.  As in the serial loop, a tile is not fit if
+    none of its sources is both within it and closer to its center
+    than to those of the tiles before it.
+
+    The units are run tile by tile (all the bands of one tile, then
+    the next), and a source's results are finished, and forgotten,
+    once the last tile it touches is done; so only the results of
+    the sources in the tiles in progress are held.
+
+    *outfn*: if given, the results are also written to a FITS table
+    in this file, in catalog order; each row is written as soon as
+    it is finished.
+
+    *return_phot*: return the full table (in catalog order)?  If
+    False, only *outfn* gets the results, and None is returned in
+    place of the table.
+
+    *mp*: an astrometry.util.multiproc object; if given, the work
+    units are run in parallel (with mp.imap).  Otherwise they are run
+    in turn, with the next tile's images being read (in a background
+    thread) while the current one is being fit.  *mp_chunk* work
+    units at a time are handed to the pool, so that only those
+    units' sources are copied (and pickled) at once.
     '''
 
     if bands is None:
@@ -42,245 +70,485 @@ def unwise_forcedphot(cat, tiles, bands=None, roiradecbox=None,
     if get_models:
         models = {}
 
-    fskeys = ['prochi2', 'pronpix', 'profracflux', 'proflux', 'npix',
-              'pronexp']
+    opts = dict(roiradecbox=roiradecbox, unwise_dir=unwise_dir,
+                use_ceres=use_ceres, ceres_block=ceres_block,
+                save_fits=save_fits, get_models=get_models, ps=ps,
+                psf_broadening=psf_broadening, pixelized_psf=pixelized_psf,
+                wantims=wantims)
+
+    tilesrcs, finishing, untouched = _unwise_tile_sources(cat, tiles)
+
+    merges = dict([(band, _ForcedPhotMerge(wanyband)) for band in bands])
+
+    def tiledists(unit):
+        # The closest tile-center distances so far of the unit's
+        # sources.  For mp, these are taken when the unit is handed
+        # out, so may be larger than the final ones: a few tiles that
+        # the serial loop skips may get fit, but their results are not
+        # kept.
+        return merges[unit[3]].getTileDists(unit[4])
+
+    units = _unwise_forcedphot_units(cat, tiles, tilesrcs, bands, opts)
+    if mp is None:
+        results = _prefetch_map(
+            lambda X: _unwise_forcedphot_tile(X + (tiledists(X[0]),)),
+            units, _read_unwise_forcedphot_tile)
+    else:
+        results = _chunked_imap(mp, _unwise_forcedphot_tile,
+                                ((unit, None, tiledists(unit))
+                                 for unit in units), mp_chunk)
+
+    # Merge the per-tile results, in the order of the work units,
+    # writing out the sources finished by each tile.
+    out = _ForcedPhotOutput(len(cat), fn=outfn, keep=return_phot)
+    for n, (coadd_id, band, R, model) in enumerate(results):
+        if R is not None:
+            if get_models and model is not None:
+                models[(coadd_id, band)] = model
+            merges[band].add(coadd_id, R)
+        if (n + 1) % len(bands) == 0:
+            I = finishing[n // len(bands)]
+            out.write(_forcedphot_rows(cat, I, bands, merges))
+    out.write(_forcedphot_rows(cat, untouched, bands, merges))
+    phot = out.close()
+
+    if get_models:
+        return phot,models
+    return phot
+
+
+# Fit statistics saved for each source
+_fskeys = ['prochi2', 'pronpix', 'profracflux', 'proflux', 'npix',
+           'pronexp']
 
-    Nsrcs = len(cat)
-    phot = fits_table()
-    phot.tile = np.array(['        '] * Nsrcs)
 
+def _unwise_tile_sources(cat, tiles):
+    '''
+    Finds the sources in *cat* that could touch each of the *tiles*
+    (within the margin; the exact cut is made once the image is
+    read).  Returns (tilesrcs, finishing, untouched): for each tile,
+    the indices of the sources touching it, and of the sources for
+    which it is the last tile they touch; and the indices of the
+    sources touching no tile.
+    '''
+    from tractor.spatial import RaDecIndex
+    # Sources within this many pixels of the full tile
+    margin = 12.
     ra = np.array([src.getPosition().ra for src in cat])
     dec = np.array([src.getPosition().dec for src in cat])
+    index = RaDecIndex(ra, dec)
+    last = np.empty(len(cat), int)
+    last[:] = -1
+    tilesrcs = []
+    for k, tile in enumerate(tiles):
+        tilewcs = unwise_tile_wcs(tile.ra, tile.dec)
+        H, W = tilewcs.shape
+        # tile center-to-corner distance, plus margin, in degrees
+        radius = ((np.hypot(W, H) / 2. + margin) *
+                  tilewcs.pixel_scale() / 3600.)
+        J = index.near(tile.ra, tile.dec, radius)
+        if len(J) == 0:
+            I = J
+        else:
+            ok, x, y = tilewcs.radec2pixelxy(ra[J], dec[J])
+            I = J[np.flatnonzero(ok * (x >= 1 - margin) *
+                                 (x < W + margin) *
+                                 (y >= 1 - margin) * (y < H + margin))]
+        tilesrcs.append(I)
+        last[I] = k
+    order = np.argsort(last, kind='stable')
+    bounds = np.searchsorted(last[order], np.arange(-1, len(tiles) + 1))
+    finishing = [order[bounds[k + 1]:bounds[k + 2]]
+                 for k in range(len(tiles))]
+    untouched = order[bounds[0]:bounds[1]]
+    return tilesrcs, finishing, untouched
+
+
+def _unwise_forcedphot_units(cat, tiles, tilesrcs, bands, opts):
+    '''
+    Yields the (tile, band) work units for unwise_forcedphot, tile by
+    tile:
 
-    for band in bands:
-        print('Photometering WISE band', band)
-        wband = 'w%i' % band
-
-        # The tiles have some overlap, so for each source, keep the
-        # fit in the tile whose center is closest to the source.
-        tiledists = np.empty(Nsrcs)
-        tiledists[:] = 1e100
-        flux_invvars = np.zeros(Nsrcs, np.float32)
-        fitstats = dict([(k, np.zeros(Nsrcs, np.float32)) for k in fskeys])
-        nexp = np.zeros(Nsrcs, np.int16)
-        mjd = np.zeros(Nsrcs, np.float64)
-
-        for tile in tiles:
-            print('Reading tile', tile.coadd_id)
-
-            tim = get_unwise_tractor_image(unwise_dir, tile.coadd_id, band,
-                                           bandname=wanyband, roiradecbox=roiradecbox)
+    (coadd_id, tile_ra, tile_dec, band, I, srcs, opts)
+
+    where *I* are the indices in *cat* of the sources that could touch
+    the tile (see _unwise_tile_sources), and *srcs* are copies of
+    those sources.
+    '''
+    for tile, I in zip(tiles, tilesrcs):
+        for band in bands:
+            srcs = [cat[i].copy() for i in I]
+            yield (tile.coadd_id, tile.ra, tile.dec, band, I, srcs, opts)
+
+
+def _read_unwise_forcedphot_tile(unit):
+    '''
+    Reads the unWISE tile for a work unit (see
+    _unwise_forcedphot_units), setting up its PSF model; returns None
+    if it does not overlap the ROI.
+    '''
+    (coadd_id, tile_ra, tile_dec, band, I, srcs, opts) = unit
+    print('Reading tile', coadd_id)
+
+    tim = get_unwise_tractor_image(opts['unwise_dir'], coadd_id, band,
+                                   bandname='w',
+                                   roiradecbox=opts['roiradecbox'])
+    if tim is None:
+        return None
+
+    psf_broadening = opts['psf_broadening']
+    if opts['pixelized_psf']:
+        import unwise_psf
+        psfimg = unwise_psf.get_unwise_psf(band, coadd_id)
+        print('PSF postage stamp', psfimg.shape, 'sum', psfimg.sum())
+        from tractor.psf import PixelizedPSF
+        psfimg /= psfimg.sum()
+        tim.psf = PixelizedPSF(psfimg)
+        print('### HACK ### normalized PSF to 1.0')
+        print('Set PSF to', tim.psf)
+
+        if False:
+            ph,pw = psfimg.shape
+            px,py = np.meshgrid(np.arange(ph), np.arange(pw))
+            cx = np.sum(psfimg * px)
+            cy = np.sum(psfimg * py)
+            print('PSF center of mass: %.2f, %.2f' % (cx, cy))
+
+            for sz in range(1, 11):
+                middle = pw//2
+                sub = (slice(middle-sz, middle+sz+1),
+                       slice(middle-sz, middle+sz+1))
+                cx = np.sum((psfimg * px)[sub]) / np.sum(psfimg[sub])
+                cy = np.sum((psfimg * py)[sub]) / np.sum(psfimg[sub])
+                print('Size', sz, ': PSF center of mass: %.2f, %.2f' % (cx, cy))
+
+            import fitsio
+            fitsio.write('psfimg-%s-w%i.fits' % (coadd_id, band), psfimg,
+                     clobber=True)
+
+    elif psf_broadening is not None:
+        # psf_broadening is a factor by which the PSF FWHMs
+        # should be scaled; the PSF is a little wider
+        # post-reactivation.
+        psf = tim.getPsf()
+        from tractor import GaussianMixturePSF
+        if isinstance(psf, GaussianMixturePSF):
+            #
+            print('Broadening PSF: from', psf)
+            p0 = psf.getParams()
+            #print('Params:', p0)
+            pnames = psf.getParamNames()
+            #print('Param names:', pnames)
+            p1 = [p * psf_broadening**2 if 'var' in name else p
+                  for (p, name) in zip(p0, pnames)]
+            #print('Broadened:', p1)
+            psf.setParams(p1)
+            print('Broadened PSF:', psf)
+        else:
+            print(
+                'WARNING: cannot apply psf_broadening to WISE PSF of type', type(psf))
+
+    print('Read image with shape', tim.shape)
+    return tim
+
+
+def _unwise_forcedphot_tile(X):
+    '''
+    Runs forced photometry for one work unit (see
+    _unwise_forcedphot_units).
+
+    *X* = (unit, tim, tiledists), where *tim* is the unit's
+    already-read image, or None to read it here, and *tiledists* are
+    the distances to the closest tile centers so far of the unit's
+    sources, or None.
+
+    Returns (coadd_id, band, R, model): R is None if no sources touch the image, or
+    else a fits_table with a row per source within the image + margin
+    ("I": index in the catalog, "td": distance to the tile center,
+    "inbox": strictly within the image), and, if the tile was fit,
+    for the sources in the box, their fit results.  *model* is the
+    model image (and ROI) if get_models.
+    '''
+    unit, tim, tiledists = X
+    (coadd_id, tile_ra, tile_dec, band, I0, subcat, opts) = unit
+    wanyband = 'w'
+    if tim is None:
+        tim = _read_unwise_forcedphot_tile(unit)
+    if tim is None:
+        print('Actually, no overlap with tile', coadd_id)
+        return coadd_id, band, None, None
+
+    use_ceres = opts['use_ceres']
+    wantims = opts['wantims']
+    ps = opts['ps']
+
+    # Select sources in play.
+    wcs = tim.wcs.wcs
+    H, W = tim.shape
+    ra = np.array([src.getPosition().ra for src in subcat])
+    dec = np.array([src.getPosition().dec for src in subcat])
+    ok, x, y = wcs.radec2pixelxy(ra, dec)
+    x = (x - 1.).astype(np.float32)
+    y = (y - 1.).astype(np.float32)
+    margin = 10.
+    J = np.flatnonzero((x >= -margin) * (x < W + margin) *
+                       (y >= -margin) * (y < H + margin))
+    print(len(J), 'within the image + margin')
+    if len(J) == 0:
+        return coadd_id, band, None, None
+
+    inbox = ((x[J] >= -0.5) * (x[J] < (W - 0.5)) *
+             (y[J] >= -0.5) * (y[J] < (H - 0.5)))
+    print(sum(inbox), 'strictly within the image')
+
+    # Compute L_inf distance to (full) tile center.
+    tilewcs = unwise_tile_wcs(tile_ra, tile_dec)
+    cx, cy = tilewcs.crpix
+    ok, tx, ty = tilewcs.radec2pixelxy(ra[J], dec[J])
+    td = np.maximum(np.abs(tx - cx), np.abs(ty - cy))
+
+    R = fits_table()
+    R.I = I0[J]
+    R.td = td
+    R.inbox = inbox
+
+    # Skip the tile if none of its results would be kept.
+    keep = inbox
+    if tiledists is not None:
+        keep = inbox * (td < tiledists[J])
+    if not np.any(keep):
+        print('No sources to be kept; skipping.')
+        return coadd_id, band, R, None
+
+    model = None
+    srci = np.flatnonzero(inbox)
+    # sources in the box -- at the start of the subcat list.
+    K = np.append(J[srci], J[np.logical_not(inbox)])
+    subcat = [subcat[k] for k in K]
+
+    # FIXME -- set source radii, ...?
+
+    minsb = 0.
+    fitsky = False
+
+    # Look in image and set radius based on peak height??
+
+    tractor = Tractor([tim], subcat)
+    if use_ceres:
+        from tractor.ceres_optimizer import CeresOptimizer
+        tractor.optimizer = CeresOptimizer(BW=opts['ceres_block'],
+                                           BH=opts['ceres_block'])
+    tractor.freezeParamsRecursive('*')
+    tractor.thawPathsTo(wanyband)
+
+    kwa = dict(fitstat_extras=[('pronexp', [tim.nims])])
+    t0 = Time()
+
+    Rfit = tractor.optimize_forced_photometry(
+        minsb=minsb, mindlnp=1., sky=fitsky, fitstats=True,
+        variance=True, shared_params=False,
+        wantims=wantims, **kwa)
+    print('unWISE forced photometry took', Time() - t0)
+
+    if use_ceres:
+        term = Rfit.ceres_status['termination']
+        print('Ceres termination status:', term)
+        # Running out of memory can cause failure to converge
+        # and term status = 2.
+        # Fail completely in this case.
+        if term != 0:
+            raise RuntimeError(
+                'Ceres terminated with status %i' % term)
+
+    if wantims:
+        ims1 = Rfit.ims1
+    IV, fs = Rfit.IV, Rfit.fitstats
+
+    if opts['save_fits']:
+        import fitsio
+        (dat, mod, ie, chi, roi) = ims1[0]
+        wcshdr = fitsio.FITSHDR()
+        tim.wcs.wcs.add_to_header(wcshdr)
+
+        tag = 'fit-%s-w%i' % (coadd_id, band)
+        fitsio.write('%s-data.fits' %
+                     tag, dat, clobber=True, header=wcshdr)
+        fitsio.write('%s-mod.fits' % tag,  mod,
+                     clobber=True, header=wcshdr)
+        fitsio.write('%s-chi.fits' % tag,  chi,
+                     clobber=True, header=wcshdr)
+
+    if opts['get_models']:
+        (dat, mod, ie, chi, roi) = ims1[0]
+        model = (mod, tim.roi)
+
+    if ps:
+        import pylab as plt
+        tag = '%s W%i' % (coadd_id, band)
+        (dat, mod, ie, chi, roi) = ims1[0]
+
+        sig1 = tim.sig1
+        plt.clf()
+        plt.imshow(dat, interpolation='nearest', origin='lower',
+                   cmap='gray', vmin=-3 * sig1, vmax=10 * sig1)
+        plt.colorbar()
+        plt.title('%s: data' % tag)
+        ps.savefig()
+
+        plt.clf()
+        plt.imshow(mod, interpolation='nearest', origin='lower',
+                   cmap='gray', vmin=-3 * sig1, vmax=10 * sig1)
+        plt.colorbar()
+        plt.title('%s: model' % tag)
+        ps.savefig()
+
+        plt.clf()
+        plt.imshow(chi, interpolation='nearest', origin='lower',
+                   cmap='gray', vmin=-5, vmax=+5)
+        plt.colorbar()
+        plt.title('%s: chi' % tag)
+        ps.savefig()
+
+    # Save results for this tile.
+    # the "inbox" sources are at the beginning of the "subcat" list
+    N = len(R)
+    nb = len(srci)
+    R.flux = np.zeros(N, np.float32)
+    R.flux[srci] = [src.getBrightness().getBand(wanyband)
+                    for src in subcat[:nb]]
+    R.flux_ivar = np.zeros(N, np.float32)
+    R.flux_ivar[srci] = IV[:nb].astype(np.float32)
+    R.nexp = np.zeros(N, np.int16)
+    R.nexp[srci] = tim.nuims[
+        np.clip(np.round(y[J[srci]]).astype(int), 0, H - 1),
+        np.clip(np.round(x[J[srci]]).astype(int), 0, W - 1)]
+    R.mjd = np.zeros(N, np.float64)
+    if hasattr(tim, 'mjdmin') and hasattr(tim, 'mjdmax'):
+        R.mjd[srci] = (tim.mjdmin + tim.mjdmax) / 2.
+    if fs is not None:
+        for k in _fskeys:
+            v = np.zeros(N, np.float32)
+            # fitstats are returned only for un-frozen sources
+            v[srci] = np.array(getattr(fs, k)).astype(np.float32)[:nb]
+            R.set('fs_' + k, v)
+
+    return coadd_id, band, R, model
+
+
+def _prefetch_map(func, units, read):
+    '''
+    Yields func((unit, read(unit))) for each of the *units* (an
+    iterable), in order, calling read() on the next unit in a
+    background thread while func() runs on the current one.
+    '''
+    from multiprocessing.pool import ThreadPool
+    units = iter(units)
+    unit = next(units, None)
+    if unit is None:
+        return
+    pool = ThreadPool(1)
+    try:
+        nextim = pool.apply_async(read, (unit,))
+        while unit is not None:
+            tim = nextim.get()
+            nextunit = next(units, None)
+            if nextunit is not None:
+                nextim = pool.apply_async(read, (nextunit,))
             if tim is None:
-                print('Actually, no overlap with tile', tile.coadd_id)
-                continue
+                print('Actually, no overlap with tile', unit[0])
+                yield unit[0], unit[3], None, None
+            else:
+                yield func((unit, tim))
+            unit = nextunit
+    finally:
+        pool.close()
+        pool.join()
 
-            if pixelized_psf:
-                import unwise_psf
-                psfimg = unwise_psf.get_unwise_psf(band, tile.coadd_id)
-                print('PSF postage stamp', psfimg.shape, 'sum', psfimg.sum())
-                from tractor.psf import PixelizedPSF
-                psfimg /= psfimg.sum()
-                tim.psf = PixelizedPSF(psfimg)
-                print('### HACK ### normalized PSF to 1.0')
-                print('Set PSF to', tim.psf)
-
-                if False:
-                    ph,pw = psfimg.shape
-                    px,py = np.meshgrid(np.arange(ph), np.arange(pw))
-                    cx = np.sum(psfimg * px)
-                    cy = np.sum(psfimg * py)
-                    print('PSF center of mass: %.2f, %.2f' % (cx, cy))
-        
-                    for sz in range(1, 11):
-                        middle = pw//2
-                        sub = (slice(middle-sz, middle+sz+1),
-                               slice(middle-sz, middle+sz+1))
-                        cx = np.sum((psfimg * px)[sub]) / np.sum(psfimg[sub])
-                        cy = np.sum((psfimg * py)[sub]) / np.sum(psfimg[sub])
-                        print('Size', sz, ': PSF center of mass: %.2f, %.2f' % (cx, cy))
-                    
-                    import fitsio
-                    fitsio.write('psfimg-%s-w%i.fits' % (tile.coadd_id, band), psfimg,
-                             clobber=True)
-            
-            if psf_broadening is not None and not pixelized_psf:
-                # psf_broadening is a factor by which the PSF FWHMs
-                # should be scaled; the PSF is a little wider
-                # post-reactivation.
-                psf = tim.getPsf()
-                from tractor import GaussianMixturePSF
-                if isinstance(psf, GaussianMixturePSF):
-                    #
-                    print('Broadening PSF: from', psf)
-                    p0 = psf.getParams()
-                    #print('Params:', p0)
-                    pnames = psf.getParamNames()
-                    #print('Param names:', pnames)
-                    p1 = [p * psf_broadening**2 if 'var' in name else p
-                          for (p, name) in zip(p0, pnames)]
-                    #print('Broadened:', p1)
-                    psf.setParams(p1)
-                    print('Broadened PSF:', psf)
-                else:
-                    print(
-                        'WARNING: cannot apply psf_broadening to WISE PSF of type', type(psf))
-
-            print('Read image with shape', tim.shape)
-
-            # Select sources in play.
-            wcs = tim.wcs.wcs
-            H, W = tim.shape
-            ok, x, y = wcs.radec2pixelxy(ra, dec)
-            x = (x - 1.).astype(np.float32)
-            y = (y - 1.).astype(np.float32)
-            margin = 10.
-            I = np.flatnonzero((x >= -margin) * (x < W + margin) *
-                               (y >= -margin) * (y < H + margin))
-            print(len(I), 'within the image + margin')
-
-            inbox = ((x[I] >= -0.5) * (x[I] < (W - 0.5)) *
-                     (y[I] >= -0.5) * (y[I] < (H - 0.5)))
-            print(sum(inbox), 'strictly within the image')
-
-            # Compute L_inf distance to (full) tile center.
-            tilewcs = unwise_tile_wcs(tile.ra, tile.dec)
-            cx, cy = tilewcs.crpix
-            ok, tx, ty = tilewcs.radec2pixelxy(ra[I], dec[I])
-            td = np.maximum(np.abs(tx - cx), np.abs(ty - cy))
-            closest = (td < tiledists[I])
-            tiledists[I[closest]] = td[closest]
-
-            keep = inbox * closest
-
-            # Source indices (in the full "cat") to keep (the fit values for)
-            srci = I[keep]
-
-            if not len(srci):
-                print('No sources to be kept; skipping.')
-                continue
 
-            phot.tile[srci] = tile.coadd_id
-            nexp[srci] = tim.nuims[np.clip(np.round(y[srci]).astype(int), 0, H - 1),
-                                   np.clip(np.round(x[srci]).astype(int), 0, W - 1)]
-
-            # Source indices in the margins
-            margi = I[np.logical_not(keep)]
-
-            # sources in the box -- at the start of the subcat list.
-            subcat = [cat[i] for i in srci]
-
-            # include *copies* of sources in the margins
-            # (that way we automatically don't save the results)
-            subcat.extend([cat[i].copy() for i in margi])
-            assert(len(subcat) == len(I))
-
-            # FIXME -- set source radii, ...?
-
-            minsb = 0.
-            fitsky = False
-
-            # Look in image and set radius based on peak height??
-
-            tractor = Tractor([tim], subcat)
-            if use_ceres:
-                from tractor.ceres_optimizer import CeresOptimizer
-                tractor.optimizer = CeresOptimizer(BW=ceres_block,
-                                                   BH=ceres_block)
-            tractor.freezeParamsRecursive('*')
-            tractor.thawPathsTo(wanyband)
-
-            kwa = dict(fitstat_extras=[('pronexp', [tim.nims])])
-            t0 = Time()
-
-            R = tractor.optimize_forced_photometry(
-                minsb=minsb, mindlnp=1., sky=fitsky, fitstats=True,
-                variance=True, shared_params=False,
-                wantims=wantims, **kwa)
-            print('unWISE forced photometry took', Time() - t0)
-
-            if use_ceres:
-                term = R.ceres_status['termination']
-                print('Ceres termination status:', term)
-                # Running out of memory can cause failure to converge
-                # and term status = 2.
-                # Fail completely in this case.
-                if term != 0:
-                    raise RuntimeError(
-                        'Ceres terminated with status %i' % term)
-
-            if wantims:
-                ims0 = R.ims0
-                ims1 = R.ims1
-            IV, fs = R.IV, R.fitstats
-
-            if save_fits:
-                import fitsio
-                (dat, mod, ie, chi, roi) = ims1[0]
-                wcshdr = fitsio.FITSHDR()
-                tim.wcs.wcs.add_to_header(wcshdr)
-
-                tag = 'fit-%s-w%i' % (tile.coadd_id, band)
-                fitsio.write('%s-data.fits' %
-                             tag, dat, clobber=True, header=wcshdr)
-                fitsio.write('%s-mod.fits' % tag,  mod,
-                             clobber=True, header=wcshdr)
-                fitsio.write('%s-chi.fits' % tag,  chi,
-                             clobber=True, header=wcshdr)
-
-            if get_models:
-                (dat, mod, ie, chi, roi) = ims1[0]
-                models[(tile.coadd_id, band)] = (mod, tim.roi)
-
-            if ps:
-                tag = '%s W%i' % (tile.coadd_id, band)
-                (dat, mod, ie, chi, roi) = ims1[0]
-
-                sig1 = tim.sig1
-                plt.clf()
-                plt.imshow(dat, interpolation='nearest', origin='lower',
-                           cmap='gray', vmin=-3 * sig1, vmax=10 * sig1)
-                plt.colorbar()
-                plt.title('%s: data' % tag)
-                ps.savefig()
-
-                plt.clf()
-                plt.imshow(mod, interpolation='nearest', origin='lower',
-                           cmap='gray', vmin=-3 * sig1, vmax=10 * sig1)
-                plt.colorbar()
-                plt.title('%s: model' % tag)
-                ps.savefig()
-
-                plt.clf()
-                plt.imshow(chi, interpolation='nearest', origin='lower',
-                           cmap='gray', vmin=-5, vmax=+5)
-                plt.colorbar()
-                plt.title('%s: chi' % tag)
-                ps.savefig()
-
-            # Save results for this tile.
-            # the "keep" sources are at the beginning of the "subcat" list
-            flux_invvars[srci] = IV[:len(srci)].astype(np.float32)
-            if hasattr(tim, 'mjdmin') and hasattr(tim, 'mjdmax'):
-                mjd[srci] = (tim.mjdmin + tim.mjdmax) / 2.
-            if fs is None:
-                continue
-            for k in fskeys:
-                x = getattr(fs, k)
-                # fitstats are returned only for un-frozen sources
-                fitstats[k][srci] = np.array(x).astype(np.float32)[:len(srci)]
+def _chunked_imap(mp, func, args, chunk):
+    '''
+    Yields mp.imap(func, args), in order, but taking only *chunk*
+    elements of the iterable *args* at a time.
+    '''
+    from itertools import islice
+    args = iter(args)
+    while True:
+        batch = list(islice(args, chunk))
+        if len(batch) == 0:
+            break
+        for r in mp.imap(func, batch):
+            yield r
+
 
-        # Note, this is *outside* the loop over tiles.
-        # The fluxes are saved in the source objects, and will be set based on
-        # the 'tiledists' logic above.
-        nm = np.array([src.getBrightness().getBand(wanyband) for src in cat])
-        nm_ivar = flux_invvars
+class _ForcedPhotMerge(object):
+    '''
+    Merges the per-tile results for one band: the tiles have some
+    overlap, so for each source, keep the fit in the tile whose
+    center is closest to the source.  Only the sources seen, and not
+    yet finished (see *finish*), are held.
+    '''
+    def __init__(self, wanyband):
+        self.wanyband = wanyband
+        # source index -> distance to the closest tile center so far
+        self.tiledists = {}
+        # source index -> (coadd_id, flux, flux_ivar, nexp, mjd,
+        #                  fitstats (or None))
+        self.kept = {}
+
+    def getTileDists(self, I):
+        '''
+        Returns the distances to the closest tile centers so far of
+        the sources *I*.
+        '''
+        return np.array([self.tiledists.get(i, 1e100) for i in I])
+
+    def add(self, coadd_id, R):
+        I = R.I
+        closest = (R.td < self.getTileDists(I))
+        for i, td in zip(I[closest], R.td[closest]):
+            self.tiledists[i] = td
+        keep = np.flatnonzero(R.inbox * closest)
+        if not len(keep):
+            print('No sources to be kept from tile', coadd_id)
+            return
+        fs = None
+        if ('fs_' + _fskeys[0]) in R.get_columns():
+            fs = np.vstack([R.get('fs_' + k)[keep] for k in _fskeys]).T
+        for j, k in enumerate(keep):
+            self.kept[I[k]] = (coadd_id, R.flux[k], R.flux_ivar[k],
+                               R.nexp[k], R.mjd[k],
+                               None if fs is None else fs[j])
+
+    def finish(self, cat, I, wband, T):
+        '''
+        Sets the *wband* columns of fits_table *T* (whose rows are the
+        sources *I* in *cat*) from the merged results, and forgets
+        those sources.  The fluxes are also saved in the source
+        objects, and the tiles they came from in T.tile.
+        '''
+        N = len(I)
+        nm = np.zeros(N)
+        nm_ivar = np.zeros(N, np.float32)
+        fitstats = dict([(k, np.zeros(N, np.float32)) for k in _fskeys])
+        nexp = np.zeros(N, np.int16)
+        mjd = np.zeros(N, np.float64)
+        for j, i in enumerate(I):
+            self.tiledists.pop(i, None)
+            r = self.kept.pop(i, None)
+            if r is None:
+                continue
+            (T.tile[j], nm[j], nm_ivar[j], nexp[j], mjd[j], fs) = r
+            cat[i].getBrightness().setBand(self.wanyband, nm[j])
+            if fs is not None:
+                for k, v in zip(_fskeys, fs):
+                    fitstats[k][j] = v
 
         # Sources out of bounds, eg, never change from their default
         # (1-sigma or whatever) initial fluxes.  Zero them out instead.
         nm[nm_ivar == 0] = 0.
 
-        phot.set(wband + '_nanomaggies', nm.astype(np.float32))
-        phot.set(wband + '_nanomaggies_ivar', nm_ivar)
+        T.set(wband + '_nanomaggies', nm.astype(np.float32))
+        T.set(wband + '_nanomaggies_ivar', nm_ivar)
         dnm = np.zeros(len(nm_ivar), np.float32)
         okiv = (nm_ivar > 0)
         dnm[okiv] = (1. / np.sqrt(nm_ivar[okiv])).astype(np.float32)
@@ -295,18 +563,131 @@ def unwise_forcedphot(cat, tiles, bands=None, roiradecbox=None,
         mag[np.logical_not(okflux)] = np.nan
         dmag[np.logical_not(ok)] = np.nan
 
-        phot.set(wband + '_mag', mag)
-        phot.set(wband + '_mag_err', dmag)
-        for k in fskeys:
-            phot.set(wband + '_' + k, fitstats[k])
-        phot.set(wband + '_nexp', nexp)
+        T.set(wband + '_mag', mag)
+        T.set(wband + '_mag_err', dmag)
+        for k in _fskeys:
+            T.set(wband + '_' + k, fitstats[k])
+        T.set(wband + '_nexp', nexp)
+        T.set(wband + '_mjd', mjd)
 
-        if not np.all(mjd == 0):
-            phot.set(wband + '_mjd', mjd)
 
-    if get_models:
-        return phot,models
-    return phot
+def _forcedphot_rows(cat, I, bands, merges):
+    '''
+    Returns a fits_table of the (finished) results for the sources *I*
+    in *cat*, from the _ForcedPhotMerge of each band in *merges*.
+    '''
+    T = fits_table()
+    T.catindex = np.asarray(I, np.int64)
+    T.tile = np.array(['        '] * len(I), 'U8')
+    for band in bands:
+        merges[band].finish(cat, I, 'w%i' % band, T)
+    return T
+
+
+class _ForcedPhotOutput(object):
+    '''
+    Collects the rows of unwise_forcedphot results as they are
+    finished, putting them in catalog order into a table of *N* rows:
+    in a FITS table in file *fn* (if given), and (if *keep*) in
+    memory.  As in the serial loop, the _mjd columns are dropped
+    (from both) if there are no MJDs.
+
+    The file is created full-size, of zeros, and the finished rows
+    are written in place through a memory map of its data, so only
+    the rows of one chunk are held at once.
+    '''
+    # rows written at a time when creating (or rewriting) the file
+    chunk = 100000
+
+    def __init__(self, N, fn=None, keep=True):
+        self.N = N
+        self.fn = fn
+        self.keep = keep
+        self.phot = None
+        self.rows = None
+        self.cols = None
+        # _mjd columns that have any MJDs
+        self.hasmjd = set()
+
+    def _create(self, T):
+        self.cols = [c for c in T.get_columns() if c != 'catindex']
+        if self.keep:
+            self.phot = fits_table()
+            for c in self.cols:
+                v = T.get(c)
+                self.phot.set(c, np.zeros((self.N,) + v.shape[1:], v.dtype))
+        if self.fn is None:
+            return
+        import fitsio
+        # FITS table rows: big-endian, unpadded.
+        dt = []
+        for c in self.cols:
+            v = T.get(c)
+            if v.dtype.kind == 'U':
+                t = np.dtype('S%i' % (v.dtype.itemsize // 4))
+            else:
+                t = v.dtype.newbyteorder('>')
+            dt.append((c, t, v.shape[1:]))
+        dtype = np.dtype(dt)
+        with fitsio.FITS(self.fn, 'rw', clobber=True) as F:
+            F.write(np.zeros(min(self.N, self.chunk), dtype))
+            for i in range(self.chunk, self.N, self.chunk):
+                F[-1].append(np.zeros(min(self.chunk, self.N - i), dtype))
+            offset = F[-1].get_offsets()['data_start']
+        if self.N:
+            self.rows = np.memmap(self.fn, dtype=dtype, mode='r+',
+                                  offset=offset, shape=(self.N,))
+
+    def write(self, T):
+        if self.cols is None:
+            self._create(T)
+        if not len(T):
+            return
+        I = T.catindex
+        for c in self.cols:
+            v = T.get(c)
+            if c.endswith('_mjd') and np.any(v != 0):
+                self.hasmjd.add(c)
+            if self.rows is not None:
+                self.rows[c][I] = v
+            if self.keep:
+                self.phot.get(c)[I] = v
+
+    def close(self):
+        '''
+        Finishes the output file, and returns the table (or None).
+        '''
+        if self.rows is not None:
+            self.rows.flush()
+            self.rows = None
+        if self.cols is None:
+            return None
+        drop = [c for c in self.cols
+                if c.endswith('_mjd') and not c in self.hasmjd]
+        if self.fn is not None and len(drop):
+            self._rewrite([c for c in self.cols if not c in drop])
+        phot = self.phot
+        if phot is not None:
+            for c in drop:
+                phot.delete_column(c)
+        return phot
+
+    def _rewrite(self, cols):
+        # Rewrites the output file with only columns *cols*.
+        import os
+        import fitsio
+        tmpfn = self.fn + '.tmp'
+        with fitsio.FITS(self.fn) as F, \
+                fitsio.FITS(tmpfn, 'rw', clobber=True) as out:
+            hdu = F[-1]
+            for i in range(0, max(self.N, 1), self.chunk):
+                rows = hdu.read(columns=cols, rows=np.arange(
+                    i, min(i + self.chunk, self.N)))
+                if i == 0:
+                    out.write(rows)
+                else:
+                    out[-1].append(rows)
+        os.rename(tmpfn, self.fn)
 
 
 def main():
@@ -339,6 +720,9 @@ def main():
                       default=8,
                       help='Ceres image block size (default: %default)')
 
+    parser.add_option('--threads', type=int, default=1,
+                      help='Number of processes to use (default: %default)')
+
     parser.add_option('--plots', dest='plots',
                       default=False, action='store_true')
     parser.add_option('--save-fits', dest='save_fits',
@@ -492,11 +876,16 @@ def main():
             t.about()
             assert(False)
 
-    W = unwise_forcedphot(cat, tiles, roiradecbox=roiradecbox,
-                          bands=opt.bands, unwise_dir=opt.unwise_dir,
-                          use_ceres=opt.ceres, ceres_block=opt.ceresblock,
-                          save_fits=opt.save_fits, ps=ps)
-    W.writeto(outfn)
+    mp = None
+    if opt.threads > 1:
+        from astrometry.util.multiproc import multiproc
+        mp = multiproc(opt.threads)
+
+    unwise_forcedphot(cat, tiles, roiradecbox=roiradecbox,
+                      bands=opt.bands, unwise_dir=opt.unwise_dir,
+                      use_ceres=opt.ceres, ceres_block=opt.ceresblock,
+                      save_fits=opt.save_fits, ps=ps, mp=mp,
+                      outfn=outfn, return_phot=False)
 
 
 if __name__ == '__main__':
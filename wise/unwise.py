@@ -9,6 +9,7 @@ from astrometry.util.miscutils import polygons_intersect
 from astrometry.util.fits import fits_table
 from tractor import (ConstantFitsWcs, interpret_roi, GaussianMixturePSF,
                      ConstantSky, LinearPhotoCal, Image)
+from tractor.imageutils import read_fits_image
 
 
 def unwise_tile_wcs(ra, dec, W=2048, H=2048, pixscale=2.75):
@@ -69,6 +70,81 @@ def get_unwise_tile_dir(basedir, coadd_id):
     return os.path.join(basedir, coadd_id[:3], coadd_id)
 
 
+# Decompressed unWISE images (from the gzipped invvar and n-map
+# files), keyed by filename; see read_unwise_pixels().  None if
+# disabled (the default; enable with set_unwise_tile_cache_size).
+_tilecache = None
+
+
+def set_unwise_tile_cache_size(N=64, maxbytes=512 * 1024 * 1024):
+    '''
+    Creates (or replaces) the cache of decompressed unWISE images, a
+    tractor.cache.Cache holding at most *N* images and *maxbytes*
+    bytes.  The cache is disabled by default; each process (including
+    each pool worker) that enables it holds up to *maxbytes* (by
+    default 512 MB).
+    '''
+    from tractor.cache import Cache
+    global _tilecache
+    _tilecache = Cache(maxsize=N, maxbytes=maxbytes)
+
+
+def disable_unwise_tile_cache():
+    global _tilecache
+    _tilecache = None
+
+
+def read_unwise_pixels(fn, roislice=None):
+    '''
+    Reads the image in the primary HDU of FITS file *fn*, or just its
+    *roislice* (a tuple of (y, x) slices), returning a new array.
+
+    Uncompressed, unscaled images are memory-mapped, so only the
+    pixels in the ROI get read; other uncompressed images are read
+    (just the ROI) with fitsio.  Gzipped files must be decompressed
+    in full; if the tile cache is enabled (see
+    set_unwise_tile_cache_size), the image is kept so that reading
+    other ROIs of the same tile does not decompress it again.
+    '''
+    if fn.endswith('.gz'):
+        key = ('unwise', fn, os.path.getmtime(fn))
+        cache = _tilecache
+        pix = None
+        if cache is not None:
+            pix = cache.get(key, None)
+        if pix is None:
+            pix = fitsio.read(fn)
+            if cache is not None:
+                cache.put(key, pix)
+        if roislice is not None:
+            pix = pix[roislice]
+        return pix.copy()
+
+    pix, hdr = read_fits_image(fn, roislice=roislice)
+    if isinstance(pix, np.memmap):
+        pix = np.array(pix, dtype=pix.dtype.newbyteorder('='))
+    return pix
+
+
+# The average PSF models (from wise-psf-avg.fits), per band.
+_avg_psfs = {}
+
+
+def get_unwise_avg_psf(band):
+    '''
+    Returns (a copy of) the average PSF model for the given WISE band,
+    generated by wise_psf.py; the PSF table is read only once.
+    '''
+    psf = _avg_psfs.get(band)
+    if psf is None:
+        psffn = os.path.join(os.path.dirname(__file__), 'wise-psf-avg.fits')
+        print('Reading', psffn)
+        P = fits_table(psffn, hdu=band)
+        psf = GaussianMixturePSF(P.amp, P.mean, P.var)
+        _avg_psfs[band] = psf
+    return psf.copy()
+
+
 def get_unwise_tractor_image(basedir, tile, band, bandname=None, masked=True,
                              **kwargs):
     '''
@@ -119,7 +195,6 @@ def get_unwise_tractor_image(basedir, tile, band, bandname=None, masked=True,
         wcs = wcs.get_subimage(x0, y0, x1 - x0, y1 - y0)
         twcs = ConstantFitsWcs(wcs)
         roislice = (slice(y0, y1), slice(x0, x1))
-        img = img[roislice]
 
         if not os.path.exists(ivfn) and os.path.exists(ivfn.replace('.fits.gz', '.fits')):
             ivfn = ivfn.replace('.fits.gz', '.fits')
@@ -139,8 +214,10 @@ def get_unwise_tractor_image(basedir, tile, band, bandname=None, masked=True,
         raise IOError('unWISE files not found in ' +
                       str(basedirs) + ' for tile ' + tile)
 
+    img = read_unwise_pixels(imfn, roislice)
+
     print('Reading', ivfn)
-    invvar = fitsio.FITS(ivfn)[0][roislice]
+    invvar = read_unwise_pixels(ivfn, roislice)
 
     if band == 4:
         # due to upsampling, effective invvar is smaller (the pixels
@@ -150,24 +227,21 @@ def get_unwise_tractor_image(basedir, tile, band, bandname=None, masked=True,
     # print 'Reading', ppfn
     #pp = fitsio.FITS(ppfn)[0][roislice]
     print('Reading', nifn)
-    nims = fitsio.FITS(nifn)[0][roislice]
+    nims = read_unwise_pixels(nifn, roislice)
 
     if nufn == nifn:
         nuims = nims
     else:
         print('Reading', nufn)
-        nuims = fitsio.FITS(nufn)[0][roislice]
+        nuims = read_unwise_pixels(nufn, roislice)
 
     # print 'Median # ims:', np.median(nims)
     good = (nims > 0)
     invvar[np.logical_not(good)] = 0.
     sig1 = 1. / np.sqrt(np.median(invvar[good]))
 
-    # Load the average PSF model (generated by wise_psf.py)
-    psffn = os.path.join(os.path.dirname(__file__), 'wise-psf-avg.fits')
-    print('Reading', psffn)
-    P = fits_table(psffn, hdu=band)
-    psf = GaussianMixturePSF(P.amp, P.mean, P.var)
+    # The average PSF model (generated by wise_psf.py)
+    psf = get_unwise_avg_psf(band)
 
     sky = 0.
     tsky = ConstantSky(sky)